@@ -0,0 +1,56 @@
+import threading
+from collections import deque
+
+# Admission control for client sessions. A session holds its slot (a worker
+# thread in the threads engine) from login until it exits, so the server only
+# starts as many as it has slots for. Clients beyond that wait in a bounded
+# FIFO queue and are told so ("Server busy, position 3 in queue.") instead of
+# sitting unanswered in the listen backlog; once the queue is full new clients
+# get "Server busy, try again later." and are disconnected.
+#
+# The controller only does the bookkeeping. The engines send the replies and
+# start a waiting session when release() hands it a freed slot.
+
+DEFAULT_MAX_QUEUE = 64
+
+BUSY_QUEUED = "Server busy, position {position} in queue."
+BUSY_REJECTED = "Server busy, try again later."
+
+
+class AdmissionController:
+    def __init__(self, capacity=None, max_queue=DEFAULT_MAX_QUEUE):
+        # None: no session limit, everyone is admitted straight away
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, session):
+        """0 if session may start now, its 1-based queue position if it has to wait, None if turned away."""
+        with self._lock:
+            if self.capacity is None or (self.running < self.capacity and not self.waiting):
+                self.running += 1
+                return 0
+            if len(self.waiting) < self.max_queue:
+                self.waiting.append(session)
+                return len(self.waiting)
+            return None
+
+    def release(self):
+        """A running session ended. Returns the waiting session that takes over its slot, if any."""
+        with self._lock:
+            if self.waiting:
+                return self.waiting.popleft()
+            self.running -= 1
+            return None
+
+    def clear(self):
+        """Take every waiting session off the queue, e.g. when the server stops; returns them."""
+        with self._lock:
+            waiting = list(self.waiting)
+            self.waiting.clear()
+            return waiting
+
+    def queue_length(self):
+        return len(self.waiting)
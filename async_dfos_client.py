@@ -0,0 +1,413 @@
+import io
+import os
+import json
+import asyncio
+import contextlib
+from collections import deque
+
+import protocol
+import compress
+from dfos_client import (PIPELINE_DEPTH, DEFAULT_POOL_SIZE, PROMPT, UPLOAD_DONE, BUSY, ClientError,
+                         AuthenticationError, RemoteFileNotFound, ServerBusy, hash_prefix, kept_source, _from)
+
+# asyncio version of dfos_client.Client, for applications that already run an
+# event loop:
+#
+#   async with AsyncClient('127.0.0.1', 5000, 'user1', 'password123') as dfos:
+#       await dfos.upload_many(['a.txt', 'b.txt'])
+#       heads = await dfos.preview_many(['a.txt', 'b.txt'])
+#
+# Same pool and pipelining as the threaded client; file reads and writes run
+# on `executor` (the loop's default one when None). Uploads are plain resumable
+# uploads: the dedup, delta and striped methods are only in dfos_client.
+# With tls (a tls.ClientTLS) connections run over TLS, each with a full
+# handshake: asyncio cannot offer a saved session to resume.
+
+
+class AsyncSession:
+    """One authenticated connection. Every method starts and ends at the server's command prompt."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.conn.executor, func, *args)
+
+    @classmethod
+    async def connect(cls, host, port, username, password, codecs=(), timeout=None, executor=None, tls=None):
+        secure = {'ssl': tls.context, 'server_hostname': host} if tls is not None else {}
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, **secure), timeout)
+        try:
+            conn = await protocol.async_client_handshake(reader, writer, codecs=codecs, executor=executor)
+            reply = await conn.recv_msg()
+            while reply.startswith(BUSY):
+                if 'position' not in reply:
+                    raise ServerBusy(reply)
+                reply = await conn.recv_msg()
+            await conn.send_msg(username)
+            await conn.recv_msg()
+            await conn.send_msg(password)
+            response = await conn.recv_msg()
+            if response != "Authentication successful.":
+                raise AuthenticationError(response)
+            await conn.recv_msg()  # command prompt
+        except BaseException:
+            writer.close()
+            raise
+        return cls(conn)
+
+    async def close(self):
+        try:
+            await self.conn.send_msg('exit')
+        except OSError:
+            pass
+        await self.conn.close()
+
+    async def _prompt(self):
+        reply = await self.conn.recv_msg()
+        if not reply.startswith(PROMPT):
+            raise protocol.ProtocolError(f"Expected the command prompt, got {reply!r}")
+
+    async def _refused(self, reply, error=ClientError):
+        await self._prompt()
+        return error(reply)
+
+    async def resumable_upload(self, path, name, progress=None):
+        """Upload path as name, continuing an interrupted earlier attempt; returns the file bytes sent."""
+        stat = os.stat(path)
+        await self.conn.send_msg('resume_upload')
+        await self.conn.recv_msg()
+        await self.conn.send_msg(f"{stat.st_size} {stat.st_mtime_ns} {name}")
+        reply = await self.conn.recv_msg()
+        if not reply.startswith("OFFSET "):
+            raise await self._refused(reply)
+        offset = int(reply.split()[1])
+
+        try:
+            with open(path, 'rb') as file:
+                hasher = None
+                if self.conn.digests:
+                    hasher = await self._run_io(hash_prefix, file, offset)
+                file.seek(offset)
+                sent = await self.conn.send_stream(
+                    file, progress=progress and (lambda done: progress(offset + done, stat.st_size)),
+                    hasher=hasher)
+        except ConnectionError:
+            raise
+        except OSError:
+            await self.conn.send_error("UPLOAD_ERROR")
+            await self._prompt()
+            raise
+
+        reply = await self.conn.recv_msg()
+        await self._prompt()
+        if reply != UPLOAD_DONE:
+            raise ClientError(reply)
+        return sent
+
+    async def pipeline(self, requests):
+        """Send requests back to back and collect their results in order (see dfos_client.Session.pipeline)."""
+        requests = iter(requests)
+        in_flight = deque()
+        results = []
+
+        async def send_next():
+            request = next(requests, None)
+            if request is None:
+                return False
+            messages, read_reply = request
+            for message in messages:
+                await self.conn.send_msg(message)
+            in_flight.append(read_reply)
+            return True
+
+        while len(in_flight) < PIPELINE_DEPTH and await send_next():
+            pass
+        while in_flight:
+            read_reply = in_flight.popleft()
+            try:
+                results.append(await read_reply())
+            except ClientError as e:
+                results.append(e)
+            await self._prompt()
+            await send_next()
+        return results
+
+    async def _one(self, request):
+        result, = await self.pipeline([request])
+        if isinstance(result, ClientError):
+            raise result
+        return result
+
+    def _file_reply(self, reply, name):
+        if reply == "FILE_NOT_FOUND":
+            return RemoteFileNotFound(f"File not found on server: {name}")
+        if reply == "INVALID_RANGE":
+            return ClientError("Offset is beyond the end of the file.")
+        return protocol.ProtocolError(f"Unexpected server response: {reply}")
+
+    def range_request(self, name, offset, length, sink, source=None):
+        async def read_reply():
+            reply = await self.conn.recv_msg()
+            if not reply.startswith("RANGE_MODE "):
+                raise self._file_reply(reply, name)
+            return await self.conn.recv_stream(sink), int(reply.split()[3])
+        return ['download', _from(source, f"RANGE {offset} {length} {name}")], read_reply
+
+    def preview_request(self, name):
+        async def read_reply():
+            reply = await self.conn.recv_msg()
+            if reply != "PREVIEW_MODE":
+                raise self._file_reply(reply, name)
+            data = io.BytesIO()
+            await self.conn.recv_stream(data)
+            return data.getvalue()
+        return ['download', f"PREVIEW {name}"], read_reply
+
+    def delete_request(self, name):
+        async def read_reply():
+            await self.conn.recv_msg()  # filename prompt
+            reply = await self.conn.recv_msg()
+            if reply == "FILE_NOT_FOUND":
+                return False
+            if reply != "FILE_DELETED":
+                raise ClientError(reply)
+            return True
+        return ['delete', name], read_reply
+
+    def list_request(self, query):
+        async def read_reply():
+            await self.conn.recv_msg()
+            reply = await self.conn.recv_msg()
+            if reply != "LISTING":
+                raise ClientError(reply)
+            listing = io.BytesIO()
+            await self.conn.recv_stream(listing)
+            return json.loads(listing.getvalue())
+        return ['list', json.dumps(query)], read_reply
+
+    def versions_request(self, name):
+        async def read_reply():
+            await self.conn.recv_msg()
+            reply = await self.conn.recv_msg()
+            if reply != "VERSIONS":
+                raise self._file_reply(reply, name)
+            listing = io.BytesIO()
+            await self.conn.recv_stream(listing)
+            return json.loads(listing.getvalue())['versions']
+        return ['versions', name], read_reply
+
+    def restore_request(self, request):
+        async def read_reply():
+            await self.conn.recv_msg()
+            reply = await self.conn.recv_msg()
+            if reply == "FILE_NOT_FOUND":
+                raise RemoteFileNotFound(f"Nothing to restore: {request}")
+            if not reply.startswith("RESTORED "):
+                raise ClientError(reply)
+            return int(reply.split()[1])
+        return ['restore', json.dumps(request)], read_reply
+
+    async def read_range(self, name, offset, length, sink, source=None):
+        return await self._one(self.range_request(name, offset, length, sink, source))
+
+    async def preview(self, name):
+        return await self._one(self.preview_request(name))
+
+    async def delete(self, name):
+        return await self._one(self.delete_request(name))
+
+    async def list(self, query):
+        return await self._one(self.list_request(query))
+
+    async def download(self, name, dest, source=None):
+        """Download name into dest through dest + '.part', resuming from what an earlier attempt left."""
+        part_name = dest + ".part"
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        hasher = None
+        if self.conn.digests:
+            with open(part_name, 'rb') if offset else contextlib.nullcontext() as file:
+                hasher = await self._run_io(hash_prefix, file, offset)
+        with open(part_name, 'ab') as file:
+            try:
+                sink = file if hasher is None else protocol.HashingWriter(file, hasher)
+                _, total = await self.read_range(name, offset, -1, sink, source)
+            except ClientError as e:
+                if not isinstance(e, RemoteFileNotFound) and offset:
+                    os.remove(part_name)
+                    raise ClientError("Partial download is larger than the file on the server; discarded it, please retry.")
+                raise
+        if os.path.getsize(part_name) != total:
+            raise ClientError("Download incomplete; run it again to resume.")
+        if hasher is not None and self.conn.end_digest and self.conn.end_digest != hasher.hexdigest():
+            os.remove(part_name)
+            raise ClientError("Download failed: checksum mismatch; discarded it, please retry.")
+        os.replace(part_name, dest)
+        return total
+
+
+class AsyncClient:
+    """Pool of authenticated sessions to one server, with the file operations on top."""
+
+    def __init__(self, host='127.0.0.1', port=5000, username=None, password=None, compression='auto',
+                 pool_size=DEFAULT_POOL_SIZE, timeout=None, executor=None, tls=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.codecs = compress.offer(compression)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.executor = executor
+        self.tls = tls
+        self._idle = []
+        self._open = 0
+        self._available = asyncio.Condition()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        async with self.session():
+            pass
+        return self
+
+    async def close(self):
+        async with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for session in idle:
+            await session.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Borrow a session from the pool. It is dropped, not returned, if anything but a ClientError escapes."""
+        session = await self._acquire()
+        try:
+            yield session
+        except ClientError:
+            await self._release(session)
+            raise
+        except BaseException:
+            await self._discard(session)
+            raise
+        await self._release(session)
+
+    async def _acquire(self):
+        while True:
+            async with self._available:
+                await self._available.wait_for(lambda: self._idle or self._open < self.pool_size)
+                if not self._idle:
+                    self._open += 1
+                    break
+                session = self._idle.pop()
+            # Pooled sessions may have been closed by a server shutting down
+            if not session.conn.reader.at_eof() and not session.conn.writer.is_closing():
+                return session
+            await self._discard(session)
+        try:
+            return await AsyncSession.connect(self.host, self.port, self.username, self.password,
+                                              self.codecs, self.timeout, self.executor, self.tls)
+        except BaseException:
+            async with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+
+    async def _release(self, session):
+        async with self._available:
+            self._idle.append(session)
+            self._available.notify()
+
+    async def _discard(self, session):
+        session.conn.writer.close()
+        async with self._available:
+            self._open -= 1
+            self._available.notify()
+
+    async def upload(self, path, name=None, progress=None):
+        """Upload path (as name, default its basename); returns the file bytes sent.
+
+        Counted from any resume point and before transfer compression: with a
+        codec negotiated, fewer bytes cross the wire.
+        """
+        async with self.session() as session:
+            return await session.resumable_upload(path, name or os.path.basename(path), progress)
+
+    async def download(self, name, dest=None, version=None, snapshot=None):
+        """Download name to dest (default: its basename in the current directory); returns the file size.
+
+        version or snapshot downloads that copy of the file instead of the current one.
+        """
+        async with self.session() as session:
+            return await session.download(name, dest or name.split('/')[-1], kept_source(version, snapshot))
+
+    async def versions(self, name):
+        """[version, size, sha256] of the earlier versions the server keeps of name, newest first."""
+        async with self.session() as session:
+            return await session._one(session.versions_request(name))
+
+    async def restore(self, name, version):
+        """Make a version of name the current one again (the current one becomes a version)."""
+        async with self.session() as session:
+            return await session._one(session.restore_request({'name': name, 'version': version}))
+
+    async def preview(self, name):
+        async with self.session() as session:
+            return await session.preview(name)
+
+    async def read_range(self, name, offset, length):
+        """Bytes [offset, offset + length) of name, and the file's size."""
+        data = io.BytesIO()
+        async with self.session() as session:
+            _, total = await session.read_range(name, offset, length, data)
+        return data.getvalue(), total
+
+    async def delete(self, name):
+        async with self.session() as session:
+            return await session.delete(name)
+
+    async def list(self, prefix=None, glob=None, min_size=None, max_size=None, since=None, limit=None, after=None):
+        query = {key: value for key, value in (('prefix', prefix), ('glob', glob), ('min_size', min_size),
+                                               ('max_size', max_size), ('since', since), ('limit', limit),
+                                               ('after', after)) if value is not None}
+        async with self.session() as session:
+            return await session.list(query)
+
+    async def iter_files(self, **filters):
+        after = None
+        while True:
+            page = await self.list(after=after, **filters)
+            for row in page['files']:
+                yield row
+            after = page['next']
+            if not after:
+                return
+
+    async def preview_many(self, names):
+        async with self.session() as session:
+            return await session.pipeline([session.preview_request(name) for name in names])
+
+    async def delete_many(self, names):
+        async with self.session() as session:
+            return await session.pipeline([session.delete_request(name) for name in names])
+
+    async def upload_many(self, paths):
+        """Upload paths concurrently over the pool."""
+        return await self._gather(self.upload(path) for path in paths)
+
+    async def download_many(self, names, dest_dir='.'):
+        return await self._gather(self.download(name, os.path.join(dest_dir, name.split('/')[-1]))
+                                  for name in names)
+
+    async def _gather(self, calls):
+        async def run(call):
+            try:
+                return await call
+            except ClientError as e:
+                return e
+
+        return await asyncio.gather(*(run(call) for call in calls))
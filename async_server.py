@@ -0,0 +1,969 @@
+import asyncio
+import io
+import json
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+import chunkstore
+import delta
+import logpipe
+import protocol
+import quota
+import server
+import storage
+import tls
+
+# asyncio engine for server.py (`python3 server.py --engine asyncio`).
+#
+# Every session is a coroutine instead of a pool thread, so clients idling at
+# the command prompt cost no worker. Blocking filesystem calls are handed to a
+# bounded ThreadPoolExecutor; downloads use loop.sendfile() on the transport.
+
+io_executor = None
+
+
+async def run_io(func, *args):
+    queued_at = time.monotonic()
+
+    def call():
+        server.performance_tracker.log_queue_wait('io', time.monotonic() - queued_at)
+        return func(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(io_executor, call)
+
+
+async def authenticate(conn, client_address):
+    client_ip = client_address[0]
+    count = 1
+    username = None
+    while count <= 3:
+        await conn.send_msg("Username: ")
+        username = await conn.recv_msg()
+        await conn.send_msg("Password: ")
+        password = await conn.recv_msg()
+        retry_after = server.login_throttle.retry_after(client_ip, username)
+        if retry_after:
+            await conn.send_msg(server.throttle_message(retry_after))
+            logpipe.event("Login throttled for user %(user)s from %(client)s", logging.WARNING,
+                          user=username, op='auth', client=client_ip, outcome='throttled')
+            return None
+        started = time.monotonic()
+        verified = await run_io(server.verify_login, username, password)
+        server.performance_tracker.log_operation('auth', time.monotonic() - started)
+        if verified:
+            server.login_throttle.record_success(client_ip, username)
+            await conn.send_msg("Authentication successful.")
+            logpipe.event("Authentication successful for user %(user)s", user=username, op='auth',
+                          client=client_ip, outcome='ok')
+            return username
+        server.login_throttle.record_failure(client_ip, username)
+        await conn.send_msg("Authentication failed.")
+        logpipe.event("Authentication failed for user %(user)s", logging.WARNING, user=username,
+                      op='auth', client=client_ip, outcome='failed')
+        count += 1
+
+    logpipe.event("Multiple failed authentication attempts for user %(user)s", logging.ERROR,
+                  user=username, op='auth', client=client_ip, outcome='locked_out')
+    return None
+
+
+async def refuse_over_quota(conn, user, op, filename, error):
+    logpipe.event("Upload of %(file)s by %(user)s refused: %(error)s", logging.WARNING, user=user, op=op,
+                  file=filename, error=str(error), outcome='over_quota')
+    await conn.send_msg(str(error))
+
+
+async def refuse_corrupt_upload(conn, user, op, filename, error):
+    logpipe.event("Upload of %(file)s by %(user)s does not match the client's checksum; discarded",
+                  logging.ERROR, user=user, op=op, file=filename, outcome='checksum_mismatch')
+    await conn.send_msg(str(error))
+
+
+async def receive_upload(conn, user, filename, file, reservation):
+    try:
+        with server.bandwidth_scheduler.pace(conn, user, 'upload'):
+            return await conn.recv_stream(reservation.writer(file))
+    except quota.QuotaExceeded as e:
+        await run_io(storage.discard_upload, user, filename)
+        await refuse_over_quota(conn, user, 'upload', filename, e)
+    except protocol.TransferAborted:
+        logpipe.event("Upload error reported by client %(user)s", logging.ERROR,
+                      user=user, op='upload', file=filename, outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Client %(user)s disconnected during upload of %(file)s.", logging.WARNING,
+                      user=user, op='upload', file=filename, outcome='disconnected')
+    finally:
+        await run_io(file.close)
+    return None
+
+
+async def handle_file_upload(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        filename = await conn.recv_msg()
+
+        if filename == "CANCEL_UPLOAD":
+            logpipe.event("Upload cancelled by user %(user)s", user=user, op='upload', outcome='cancelled')
+            return
+
+        try:
+            storage.resolve(user, filename)
+        except storage.StorageError:
+            await conn.send_msg("Invalid filename.")
+            return
+        try:
+            reservation = await run_io(server.quota_manager.reserve, user, filename)
+        except quota.QuotaExceeded as e:
+            await refuse_over_quota(conn, user, 'upload', filename, e)
+            return
+
+        started = time.monotonic()
+        with reservation:
+            file, _ = await run_io(storage.open_upload, user, filename)
+            await conn.send_msg("Ready to receive file data.")
+
+            total_bytes = await receive_upload(conn, user, filename, file, reservation)
+            if total_bytes is None:
+                await run_io(storage.discard_upload, user, filename)
+                return
+            try:
+                await run_io(storage.commit_upload, user, filename, None, file.hexdigest(), conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                await refuse_corrupt_upload(conn, user, 'upload', filename, e)
+                return
+
+        duration = time.monotonic() - started
+        server.performance_tracker.log_file_transfer()
+        server.performance_tracker.log_operation('upload', duration, total_bytes)
+        logpipe.event("File upload completed: %(file)s, User: %(user)s, Size: %(bytes)s bytes",
+                      user=user, op='upload', file=filename, bytes=total_bytes, duration=duration, outcome='ok')
+        await conn.send_msg("File upload completed successfully.")
+
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='upload',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to receive file data.")
+        except Exception:
+            pass
+
+
+async def handle_resume_upload(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        header = await conn.recv_msg()
+
+        if header == "CANCEL_UPLOAD":
+            logpipe.event("Upload cancelled by user %(user)s", user=user, op='upload', outcome='cancelled')
+            return
+
+        started = time.monotonic()
+        try:
+            total, token, filename = storage.parse_resume_header(header)
+            reservation = await run_io(server.quota_manager.reserve, user, filename, total)
+        except quota.QuotaExceeded as e:
+            await refuse_over_quota(conn, user, 'upload', filename, e)
+            return
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+
+        with reservation:
+            file, offset = await run_io(storage.open_upload, user, filename, total, token)
+            await conn.send_msg(f"OFFSET {offset}")
+            received = await receive_upload(conn, user, filename, file, reservation)
+            if received is None:
+                return
+
+            try:
+                committed = await run_io(storage.commit_upload, user, filename, total, file.hexdigest(),
+                                         conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                await refuse_corrupt_upload(conn, user, 'upload', filename, e)
+                return
+            if not committed:
+                size = await run_io(storage.partial_size, user, filename)
+                await conn.send_msg(f"Upload incomplete: {size} of {total} bytes received.")
+                return
+
+        duration = time.monotonic() - started
+        server.performance_tracker.log_file_transfer()
+        server.performance_tracker.log_operation('upload', duration, received)
+        logpipe.event("File upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes (%(bytes)s sent this session)",
+                      user=user, op='upload', file=filename, bytes=received, total=total, duration=duration,
+                      outcome='ok')
+        await conn.send_msg("File upload completed successfully.")
+
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='upload',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to receive file data.")
+        except Exception:
+            pass
+
+
+async def handle_delta_upload(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        header = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            total, digest, filename = storage.parse_resume_header(header)
+            has_base = await run_io(storage.file_exists, user, filename)
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+
+        if not has_base:
+            await conn.send_msg("NO_BASE")
+            return
+        try:
+            reservation = await run_io(server.quota_manager.reserve, user, filename, total)
+        except quota.QuotaExceeded as e:
+            await refuse_over_quota(conn, user, 'delta_upload', filename, e)
+            return
+
+        with reservation:
+            base, base_size = await run_io(storage.open_file, user, filename)
+            try:
+                block_size = delta.choose_block_size(base_size)
+                signatures = await run_io(delta.file_signatures, base, block_size)
+                await conn.send_msg(f"SIGNATURES {block_size}")
+                await conn.send_stream(io.BytesIO(signatures))
+
+                file, _ = await run_io(storage.open_upload, user, filename)
+                applier = delta.DeltaApplier(base, reservation.writer(file))
+                try:
+                    with server.bandwidth_scheduler.pace(conn, user, 'delta_upload'):
+                        received = await conn.recv_stream(applier)
+                except quota.QuotaExceeded as e:
+                    await run_io(storage.discard_upload, user, filename)
+                    await refuse_over_quota(conn, user, 'delta_upload', filename, e)
+                    return
+                except (protocol.TransferAborted, ConnectionError, OSError):
+                    await run_io(storage.discard_upload, user, filename)
+                    raise
+                finally:
+                    await run_io(file.close)
+            finally:
+                await run_io(base.close)
+
+            if not applier.verify(total, digest):
+                await run_io(storage.discard_upload, user, filename)
+                logpipe.event("Delta upload of %(file)s for user %(user)s failed verification", logging.WARNING,
+                              user=user, op='delta_upload', file=filename, outcome='mismatch')
+                await conn.send_msg("DELTA_MISMATCH")
+                return
+            await run_io(storage.commit_upload, user, filename, None, digest)
+
+        duration = time.monotonic() - started
+        server.performance_tracker.log_file_transfer()
+        server.performance_tracker.log_operation('delta_upload', duration, total)
+        logpipe.event("Delta upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes (%(bytes)s delta bytes)",
+                      user=user, op='delta_upload', file=filename, bytes=received, total=total, duration=duration,
+                      outcome='ok')
+        await conn.send_msg("File upload completed successfully.")
+
+    except protocol.TransferAborted:
+        logpipe.event("Upload error reported by client %(user)s", logging.ERROR, user=user, op='delta_upload',
+                      outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='delta_upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Delta upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='delta_upload',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to receive file data.")
+        except Exception:
+            pass
+
+
+async def handle_dedup_upload(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        header = await conn.recv_msg()
+        started = time.monotonic()
+        if storage.BACKEND != 'dedup':
+            await conn.send_msg("DEDUP_DISABLED")
+            return
+        try:
+            total, count, filename = storage.parse_resume_header(header)
+            reservation = await run_io(server.quota_manager.reserve, user, filename, total)
+        except quota.QuotaExceeded as e:
+            await refuse_over_quota(conn, user, 'dedup_upload', filename, e)
+            return
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+
+        with reservation:
+            store = storage.chunk_store()
+            await conn.send_msg("SEND_MANIFEST")
+            manifest = io.BytesIO()
+            await conn.recv_stream(manifest)
+            entries = chunkstore.decode_manifest(manifest.getvalue())
+            if len(entries) != int(count) or sum(length for _, length in entries) != total:
+                await conn.send_msg("Invalid manifest.")
+                return
+
+            missing = await run_io(store.missing, entries)
+            await conn.send_msg(f"MISSING {len(missing)}")
+            await conn.send_stream(io.BytesIO(b''.join(chunkstore.INDEX.pack(index) for index in missing)))
+            sink = chunkstore.ChunkSink(store, [entries[index] for index in missing])
+            with server.bandwidth_scheduler.pace(conn, user, 'dedup_upload'):
+                received = await conn.recv_stream(sink)
+            if not sink.complete():
+                await conn.send_msg("Upload incomplete: chunks missing.")
+                return
+            try:
+                await run_io(storage.commit_chunks, user, filename, entries)
+            except chunkstore.ChunkStoreError as e:
+                await conn.send_msg(str(e))
+                return
+
+        duration = time.monotonic() - started
+        server.performance_tracker.log_file_transfer()
+        server.performance_tracker.log_operation('dedup_upload', duration, total)
+        logpipe.event("Dedup upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes, %(chunks_sent)s/%(chunks)s chunks sent (%(bytes)s bytes)",
+                      user=user, op='dedup_upload', file=filename, bytes=received, total=total,
+                      chunks_sent=len(missing), chunks=len(entries), duration=duration, outcome='ok')
+        await conn.send_msg("File upload completed successfully.")
+
+    except protocol.TransferAborted:
+        logpipe.event("Upload error reported by client %(user)s", logging.ERROR, user=user, op='dedup_upload',
+                      outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='dedup_upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Dedup upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='dedup_upload',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to receive file data.")
+        except Exception:
+            pass
+
+
+async def handle_stripe_command(conn, user, command):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        header = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            if command == 'stripe_begin':
+                total, token, filename = storage.parse_resume_header(header)
+                # Checked again at commit; the stripes arrive on other connections
+                (await run_io(server.quota_manager.reserve, user, filename, total)).release()
+                await run_io(storage.begin_striped_upload, user, filename, total, token)
+                logpipe.event("Striped upload of %(file)s (%(total)s bytes) started for user %(user)s",
+                              user=user, op='upload_stripe', file=filename, total=total)
+                await conn.send_msg("READY")
+
+            elif command == 'stripe_put':
+                offset, token, filename = storage.parse_stripe_header(header)
+                fd, total = await run_io(storage.open_stripe, user, filename, token)
+                try:
+                    await conn.send_msg("READY")
+                    with server.bandwidth_scheduler.pace(conn, user, 'upload_stripe'):
+                        received = await conn.recv_stream(protocol.PositionalWriter(fd, offset, total))
+                finally:
+                    os.close(fd)
+                await run_io(storage.record_stripe, user, filename, offset, received)
+                duration = time.monotonic() - started
+                server.performance_tracker.log_operation('upload_stripe', duration, received)
+                logpipe.event("Stripe at %(offset)s of %(file)s received for user %(user)s", user=user,
+                              op='upload_stripe', file=filename, offset=offset, bytes=received,
+                              duration=duration, outcome='ok')
+                await conn.send_msg(f"STRIPE_DONE {received}")
+
+            else:
+                _, token, filename = storage.parse_resume_header(header)
+                total = await run_io(storage.striped_upload_total, user, filename, token)
+                missing = await run_io(storage.missing_stripe_bytes, user, filename, total)
+                if missing:
+                    await conn.send_msg(f"Upload incomplete: {missing} of {total} bytes missing.")
+                    return
+                try:
+                    reservation = await run_io(server.quota_manager.reserve, user, filename, total)
+                except quota.QuotaExceeded:
+                    await run_io(storage.discard_upload, user, filename)
+                    raise
+                with reservation:
+                    await run_io(storage.commit_upload, user, filename)
+                server.performance_tracker.log_file_transfer()
+                logpipe.event("Striped upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes",
+                              user=user, op='upload', file=filename, total=total, outcome='ok')
+                await conn.send_msg("File upload completed successfully.")
+        except quota.QuotaExceeded as e:
+            await refuse_over_quota(conn, user, 'upload_stripe', filename, e)
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+    except protocol.TransferAborted:
+        logpipe.event("Stripe upload error reported by client %(user)s", logging.ERROR,
+                      user=user, op='upload_stripe', outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op=command,
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("%(op)s error for user %(user)s: %(error)s", logging.ERROR, user=user, op=command,
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to receive file data.")
+        except Exception:
+            pass
+
+
+async def handle_file_download(conn, user):
+    mode = 'download'
+    try:
+        request = await conn.recv_msg()
+        started = time.monotonic()
+
+        try:
+            mode, filename, offset, length, source = storage.parse_download_request(request, server.PREVIEW_SIZE)
+            if mode == 'preview':
+                file, size = await run_io(storage.open_preview, user, filename, server.PREVIEW_SIZE, source)
+            else:
+                file, size = await run_io(storage.open_file, user, filename, source,
+                                          server.sends_zero_copy(conn))
+        except (storage.StorageError, FileNotFoundError, IsADirectoryError):
+            await conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("File not found: %(file)s for user %(user)s", logging.WARNING,
+                          user=user, op=mode, file=request, outcome='not_found')
+            return
+
+        zero_copy = server.ZERO_COPY_DOWNLOADS and storage.has_descriptor(file)
+        try:
+            with server.bandwidth_scheduler.pace(conn, user, mode):
+                if mode == 'download':
+                    await conn.send_msg("FILE_FOUND")
+                    digest = await run_io(server.download_digest, conn, user, filename, mode, 0, size, size, source)
+                    await conn.send_file(file, 0, size, zero_copy=zero_copy, digest=digest)
+                    count = size
+                else:
+                    try:
+                        count = storage.clamp_range(offset, length, size)
+                    except storage.StorageError as e:
+                        await conn.send_msg(str(e))
+                        return
+                    if mode == 'preview':
+                        await conn.send_msg("PREVIEW_MODE")
+                    else:
+                        await conn.send_msg(f"RANGE_MODE {offset} {count} {size}")
+                    digest = await run_io(server.download_digest, conn, user, filename, mode, offset, count, size,
+                                          source)
+                    if count > server.MMAP_RANGE_LIMIT and mode != 'preview':
+                        await conn.send_file(file, offset, count, zero_copy=zero_copy, digest=digest)
+                    else:
+                        await conn.send_preview(await run_io(storage.read_range, file, offset, count), digest)
+        finally:
+            await run_io(file.close)
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation(mode, duration, count)
+        logpipe.event("Successfully completed %(op)s for %(file)s by user %(user)s",
+                      user=user, op=mode, file=filename, bytes=count, duration=duration, outcome='ok')
+
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op=mode,
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File %(op)s error for user %(user)s: %(error)s", logging.ERROR, user=user, op=mode,
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("ERROR")
+        except Exception:
+            pass
+
+
+async def handle_list_files(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the listing query.")
+        query = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            page = await run_io(storage.list_files, user, storage.parse_list_query(query))
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+        await conn.send_msg("LISTING")
+        await conn.send_preview(json.dumps(page).encode())
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('list', duration)
+        logpipe.event("Listed %(files)s files for user %(user)s", user=user, op='list',
+                      files=len(page['files']), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='list',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File listing error for user %(user)s: %(error)s", logging.ERROR, user=user, op='list',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to list files.")
+        except Exception:
+            pass
+
+
+async def handle_manifest(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the manifest query.")
+        query = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            rows = await run_io(storage.manifest, user, storage.parse_list_query(query).get('prefix'))
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+        await conn.send_msg("MANIFEST")
+        await conn.send_stream(io.BytesIO(json.dumps({'files': rows}).encode()))
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('manifest', duration)
+        logpipe.event("Sent manifest of %(files)s files to user %(user)s", user=user, op='manifest',
+                      files=len(rows), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='manifest',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Manifest error for user %(user)s: %(error)s", logging.ERROR, user=user, op='manifest',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to build the manifest.")
+        except Exception:
+            pass
+
+
+async def handle_versions(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the filename.")
+        filename = await conn.recv_msg()
+        try:
+            rows = await run_io(storage.list_versions, user, filename)
+        except storage.StorageError:
+            await conn.send_msg("FILE_NOT_FOUND")
+            return
+        await conn.send_msg("VERSIONS")
+        await conn.send_preview(json.dumps({'versions': [row[:3] for row in rows]}).encode())
+        logpipe.event("Listed %(versions)s versions of %(file)s for user %(user)s", user=user, op='versions',
+                      file=filename, versions=len(rows), outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='versions',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Version listing error for user %(user)s: %(error)s", logging.ERROR, user=user,
+                      op='versions', error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to list versions.")
+        except Exception:
+            pass
+
+
+async def handle_restore(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the restore request.")
+        request = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            filename, source = storage.parse_restore_request(request)
+            restored = await run_io(server.restore_files, user, filename, source)
+        except (storage.StorageError, quota.QuotaExceeded) as e:
+            await conn.send_msg(str(e))
+            logpipe.event("Restore for user %(user)s refused: %(error)s", logging.WARNING, user=user, op='restore',
+                          error=str(e), outcome='refused')
+            return
+        except (FileNotFoundError, IsADirectoryError):
+            await conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("Nothing to restore for user %(user)s: %(request)s", logging.WARNING, user=user,
+                          op='restore', request=request, outcome='not_found')
+            return
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('restore', duration)
+        await conn.send_msg(f"RESTORED {restored}")
+        logpipe.event("Restored %(files)s files from %(source)s for user %(user)s", user=user, op='restore',
+                      files=restored, source=f"{source[0]} {source[1]}", duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='restore',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Restore error for user %(user)s: %(error)s", logging.ERROR, user=user, op='restore',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to restore.")
+        except Exception:
+            pass
+
+
+async def handle_snapshot(conn, user):
+    op = 'snapshot'
+    try:
+        await conn.send_msg("Ready to receive the snapshot request.")
+        request = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            op, snapshot = storage.parse_snapshot_request(request)
+            reply = await run_io(server.snapshot_operation, user, op, snapshot)
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+        except FileNotFoundError:
+            await conn.send_msg("SNAPSHOT_NOT_FOUND")
+            return
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('snapshot', duration)
+        await conn.send_msg("SNAPSHOT")
+        await conn.send_preview(json.dumps(reply).encode())
+        logpipe.event("Snapshot %(action)s for user %(user)s", user=user, op='snapshot', action=op,
+                      snapshot=reply.get('snapshot', snapshot), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='snapshot',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Snapshot %(action)s error for user %(user)s: %(error)s", logging.ERROR, user=user,
+                      op='snapshot', action=op, error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Snapshot request failed.")
+        except Exception:
+            pass
+
+
+async def handle_purge(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the ticket.")
+        ticket = await conn.recv_msg()
+        if not server.authorize_coordinator(user, ticket):
+            await conn.send_msg("Purge refused.")
+            logpipe.event("Purge for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='purge', outcome='refused')
+            return
+        started = time.monotonic()
+        files, kept, snapshots = await run_io(storage.purge_user, user)
+        duration = time.monotonic() - started
+        await conn.send_msg(f"PURGED {files} {kept} {snapshots}")
+        logpipe.event("Purged %(files)s files, %(versions)s versions and %(snapshots)s snapshots of %(user)s",
+                      user=user, op='purge', files=files, versions=kept, snapshots=snapshots, duration=duration,
+                      outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='purge',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Purge error for user %(user)s: %(error)s", logging.ERROR, user=user, op='purge',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Purge failed.")
+        except Exception:
+            pass
+
+
+async def handle_history(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the ticket.")
+        ticket = await conn.recv_msg()
+        if not server.authorize_coordinator(user, ticket):
+            await conn.send_msg("History refused.")
+            logpipe.event("History for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='history', outcome='refused')
+            return
+        history = await run_io(storage.user_history, user)
+        await conn.send_msg("HISTORY")
+        await conn.send_preview(json.dumps(history).encode())
+        logpipe.event("Listed %(versions)s versions and %(snapshots)s snapshots of %(user)s", user=user,
+                      op='history', versions=len(history['versions']), snapshots=len(history['snapshots']),
+                      outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='history',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("History error for user %(user)s: %(error)s", logging.ERROR, user=user, op='history',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to list history.")
+        except Exception:
+            pass
+
+
+async def handle_keep(conn, user):
+    try:
+        await conn.send_msg("Ready to receive the header.")
+        header = await conn.recv_msg()
+        started = time.monotonic()
+        try:
+            entry = storage.parse_keep_header(header)
+        except storage.StorageError as e:
+            await conn.send_msg(str(e))
+            return
+        if not server.authorize_coordinator(user, entry.get('ticket')):
+            await conn.send_msg("Keep refused.")
+            logpipe.event("Keep for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='keep', outcome='refused')
+            return
+        received = 0
+        if not await run_io(storage.link_kept, user, entry):
+            if not entry.get('data'):
+                await conn.send_msg("MISSING")
+                return
+            await conn.send_msg("SEND")
+            file = await run_io(storage.open_kept_upload, user, entry)
+            try:
+                received = await conn.recv_stream(file)
+            finally:
+                await run_io(file.close)
+            try:
+                await run_io(storage.commit_kept, user, entry, file.hexdigest(), conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                await refuse_corrupt_upload(conn, user, 'keep', entry['name'], e)
+                return
+        await conn.send_msg("KEPT")
+        logpipe.event("Kept %(file)s from %(source)s for user %(user)s", user=user, op='keep', file=entry.get('name'),
+                      source=f"version {entry['version']}" if 'version' in entry else f"snapshot {entry['snapshot']}",
+                      bytes=received, duration=time.monotonic() - started, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='keep',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Keep error for user %(user)s: %(error)s", logging.ERROR, user=user, op='keep',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to keep the entry.")
+        except Exception:
+            pass
+
+
+async def handle_file_deletion(conn, user):
+    try:
+        await conn.send_msg("Enter the filename to delete: ")
+        filename = await conn.recv_msg()
+        started = time.monotonic()
+
+        try:
+            deleted = await run_io(storage.delete_file, user, filename)
+        except storage.StorageError:
+            deleted = False
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('delete', duration)
+
+        if deleted:
+            await conn.send_msg("FILE_DELETED")
+            logpipe.event("File %(file)s deleted for user %(user)s", user=user, op='delete', file=filename,
+                          duration=duration, outcome='ok')
+        else:
+            await conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("File not found for deletion: %(file)s for user %(user)s", logging.WARNING,
+                          user=user, op='delete', file=filename, outcome='not_found')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='delete',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File deletion error for user %(user)s: %(error)s", logging.ERROR, user=user, op='delete',
+                      error=str(e), outcome='error')
+        try:
+            await conn.send_error("Error: Failed to delete file.")
+        except Exception:
+            pass
+
+
+async def handle_client(reader, writer):
+    client_address = writer.get_extra_info('peername')
+    server.performance_tracker.increment_connections()
+    logpipe.event("New connection from %(client)s (%(active)s active)", op='connect', client=client_address,
+                  active=server.performance_tracker.active_connections)
+    conn = None
+    user = None
+    admitted = False
+    try:
+        sock = writer.get_extra_info('socket')
+        if sock is not None and server.KEEPALIVE_IDLE:
+            protocol.enable_keepalive(sock, server.KEEPALIVE_IDLE)
+        conn = await protocol.async_server_handshake(reader, writer, io_executor)
+        server.log_handshake(conn, client_address)
+        server.session_registry.add(conn)
+        conn.set_timeout(server.OP_TIMEOUT)
+        admitted = await admit(conn, client_address)
+        if not admitted:
+            return
+        user = await authenticate(conn, client_address)
+        if not user:
+            return
+
+        while True:
+            try:
+                await conn.send_msg("Enter command (upload/download/list/delete/exit): ")
+                if not server.session_registry.wait_for_command(conn):
+                    server.log_drained(user, client_address)
+                    break
+                conn.set_timeout(server.IDLE_TIMEOUT)
+                try:
+                    command = await conn.recv_msg()
+                except protocol.SessionTimeout:
+                    server.log_reaped(user, client_address, 'idle')
+                    break
+                except ConnectionError:
+                    if not server.session_registry.draining:
+                        raise
+                    server.log_drained(user, client_address)
+                    break
+                finally:
+                    server.session_registry.got_command(conn)
+                conn.set_timeout(server.OP_TIMEOUT)
+
+                if command == 'upload':
+                    await handle_file_upload(conn, user)
+                elif command == 'resume_upload' and conn.framed:
+                    await handle_resume_upload(conn, user)
+                elif command == 'delta_upload' and conn.framed:
+                    await handle_delta_upload(conn, user)
+                elif command == 'dedup_upload' and conn.framed:
+                    await handle_dedup_upload(conn, user)
+                elif command in server.STRIPE_COMMANDS and conn.framed:
+                    await handle_stripe_command(conn, user, command)
+                elif command == 'download':
+                    await handle_file_download(conn, user)
+                elif command == 'list':
+                    await handle_list_files(conn, user)
+                elif command == 'manifest' and conn.framed:
+                    await handle_manifest(conn, user)
+                elif command == 'versions' and conn.framed:
+                    await handle_versions(conn, user)
+                elif command == 'restore' and conn.framed:
+                    await handle_restore(conn, user)
+                elif command == 'snapshot' and conn.framed:
+                    await handle_snapshot(conn, user)
+                elif command == 'purge' and conn.framed:
+                    await handle_purge(conn, user)
+                elif command == 'history' and conn.framed:
+                    await handle_history(conn, user)
+                elif command == 'keep' and conn.framed:
+                    await handle_keep(conn, user)
+                elif command == 'delete':
+                    await handle_file_deletion(conn, user)
+                elif command == 'exit':
+                    logpipe.event("User %(user)s exited.", user=user, op='exit', client=client_address)
+                    break
+                else:
+                    await conn.send_msg("Invalid command.")
+                if conn.expired:
+                    server.log_reaped(user, client_address, 'stalled')
+                    break
+            except protocol.SessionTimeout:
+                server.log_reaped(user, client_address, 'stalled')
+                break
+            except ConnectionError:
+                logpipe.event("Connection lost with client %(client)s", logging.ERROR, user=user, op='session',
+                              client=client_address, outcome='disconnected')
+                break
+            except Exception as e:
+                logpipe.event("Error handling command for %(client)s: %(error)s", logging.ERROR, user=user,
+                              op='session', client=client_address, error=str(e), outcome='error')
+                break
+
+    except protocol.SessionTimeout:
+        server.log_reaped(user, client_address, 'login')
+    except Exception as e:
+        logpipe.event("Error with client %(client)s: %(error)s", logging.ERROR, user=user, op='session',
+                      client=client_address, error=str(e), outcome='error')
+    finally:
+        if conn is not None:
+            server.session_registry.remove(conn)
+        if admitted:
+            hand_over_slot()
+        server.performance_tracker.decrement_connections()
+        logpipe.event("Connection from %(client)s closed.", user=user, op='disconnect', client=client_address)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def admit(conn, client_address):
+    """Wait for a session slot (see admission.py); False if the client was turned away."""
+    waiter = asyncio.get_running_loop().create_future()
+    position = server.admission_controller.admit(waiter)
+    if position is None:
+        server.performance_tracker.log_session('rejected')
+        logpipe.event("Rejected %(client)s: session limit reached and the queue is full", logging.WARNING,
+                      op='admission', client=client_address, outcome='rejected')
+        await conn.send_msg(admission.BUSY_REJECTED)
+        return False
+    if position:
+        server.performance_tracker.log_session('queued')
+        logpipe.event("Queued %(client)s at position %(position)s", op='admission', client=client_address,
+                      position=position, outcome='queued')
+        await conn.send_msg(admission.BUSY_QUEUED.format(position=position))
+        started = time.monotonic()
+        await waiter
+        server.performance_tracker.log_queue_wait('sessions', time.monotonic() - started)
+    return True
+
+
+def hand_over_slot():
+    """Pass a finished session's slot to the first waiter still there."""
+    while True:
+        waiter = server.admission_controller.release()
+        if waiter is None:
+            return
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+
+
+def tls_options():
+    """start_server() arguments for --tls-cert; the handshake runs in the event loop."""
+    if server.TLS_CONTEXT is None:
+        return {}
+    return {'ssl': server.TLS_CONTEXT, 'ssl_handshake_timeout': tls.HANDSHAKE_TIMEOUT}
+
+
+async def serve(server_socket, signals=None):
+    listener = await asyncio.start_server(handle_client, sock=server_socket, **tls_options())
+    if signals is None:
+        async with listener:
+            await listener.serve_forever()
+        return
+
+    loop = asyncio.get_running_loop()
+    signalled = asyncio.Event()
+    loop.add_reader(signals.fileno(), signalled.set)
+    # Keeps accepting while a restart starts the new process
+    while True:
+        await signalled.wait()
+        signalled.clear()
+        if await loop.run_in_executor(None, server.stop_accepting, server_socket, signals.take()):
+            break
+    loop.remove_reader(signals.fileno())
+    # Closes only this process's copy of the socket; running sessions carry on
+    listener.close()
+    await drain()
+    server.finish_shutdown()
+
+
+async def drain():
+    for waiter in server.admission_controller.clear():
+        waiter.cancel()
+    server.drain_sessions()
+    while len(server.session_registry) and time.monotonic() < server.drain_deadline:
+        await asyncio.sleep(0.1)
+    server.close_remaining_sessions()
+    # Give the closed sessions a moment to unwind and log
+    for _ in range(10):
+        if not len(server.session_registry):
+            break
+        await asyncio.sleep(0.1)
+
+
+def run(server_socket, io_workers=16, signals=None):
+    global io_executor
+    logging.info(f"asyncio engine using {io_workers} I/O workers.")
+    io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='dfos-io')
+    try:
+        asyncio.run(serve(server_socket, signals))
+    finally:
+        io_executor.shutdown(wait=False)
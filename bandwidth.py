@@ -0,0 +1,176 @@
+import time
+import logging
+import itertools
+import threading
+import contextlib
+from collections import defaultdict
+
+# Bandwidth scheduling for server.py. Every upload and download registers a
+# Transfer for the length of its byte loop, and the loop calls
+# transfer.consume(n) after each chunk and sleeps for the delay it returns.
+#
+# Each transfer is paced by its own token bucket. The scheduler recomputes the
+# bucket rates whenever a transfer starts or ends, as a weighted max-min fair
+# split:
+#   - the global limit (--bandwidth-limit) is shared between the active users
+#     in proportion to their weight, then split evenly between that user's
+#     transfers;
+#   - a user's own limit ("rate=" in id_passwd.txt, else --user-bandwidth)
+#     caps what their transfers get together, and capacity a capped user
+#     cannot use goes to the others.
+# With no limits configured the buckets never run dry and consume() only
+# counts bytes for the metrics.
+
+UNLIMITED = float('inf')
+# Bytes a transfer may send ahead of its rate, as seconds' worth of its rate
+BURST_SECONDS = 0.1
+MIN_BURST = 64 * 1024
+# Interval over which the current rate shown in the metrics is measured
+RATE_WINDOW = 1.0
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """'512K', '10M' or '1G' (bytes per second) -> float; '0', 'none' or '' -> None."""
+    text = str(text).strip().upper().removesuffix('/S').removesuffix('B')
+    if text in ('', '0', 'NONE'):
+        return None
+    unit = text[-1] if text[-1] in _UNITS else ''
+    value = float(text[:len(text) - len(unit)]) * _UNITS[unit]
+    if value <= 0:
+        raise ValueError(f"Invalid rate {text!r}")
+    return value
+
+
+class Transfer:
+    """One upload or download in progress. Only its own handler calls consume()."""
+
+    def __init__(self, scheduler, transfer_id, user, op, user_rate, user_weight):
+        self.scheduler = scheduler
+        self.id = transfer_id
+        self.user = user
+        self.op = op
+        self.user_rate = user_rate
+        self.user_weight = user_weight
+        self.rate = UNLIMITED
+        self.burst = UNLIMITED
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.started = self.stamp
+        self.bytes = 0
+        self.window_start = self.stamp
+        self.window_bytes = 0
+        self.current_rate = 0.0
+
+    def set_rate(self, rate):
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST) if rate != UNLIMITED else UNLIMITED
+        self.tokens = min(self.tokens, self.burst)
+        self.rate = rate
+
+    def consume(self, count):
+        """Account for count bytes moved; returns how many seconds to wait before the next chunk."""
+        now = time.monotonic()
+        self.bytes += count
+        self.window_bytes += count
+        if now - self.window_start >= RATE_WINDOW:
+            self.current_rate = self.window_bytes / (now - self.window_start)
+            self.window_start, self.window_bytes = now, 0
+        rate = self.rate
+        if rate == UNLIMITED:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * rate) - count
+        self.stamp = now
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+    def measured_rate(self):
+        """Bytes per second over the last full window (since the start, during the first)."""
+        if self.current_rate:
+            return self.current_rate
+        elapsed = time.monotonic() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+class BandwidthScheduler:
+    def __init__(self, global_rate=None, user_rate=None, user_options=None):
+        self.global_rate = global_rate
+        self.user_rate = user_rate
+        # user -> {'rate': '10M', 'weight': '2'}, e.g. CredentialStore.options
+        self.user_options = user_options or (lambda user: {})
+        self.active = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def configure(self, global_rate=None, user_rate=None, user_options=None):
+        self.global_rate = global_rate
+        self.user_rate = user_rate
+        if user_options is not None:
+            self.user_options = user_options
+
+    def _user_limits(self, user):
+        options = self.user_options(user)
+        rate, weight = self.user_rate, 1.0
+        try:
+            if 'rate' in options:
+                rate = parse_rate(options['rate'])
+            if 'weight' in options:
+                weight = max(float(options['weight']), 0.001)
+        except ValueError:
+            logging.warning(f"Ignoring invalid bandwidth options for user {user}: {options}")
+        return rate, weight
+
+    def open(self, user, op):
+        rate, weight = self._user_limits(user)
+        with self._lock:
+            transfer = Transfer(self, next(self._ids), user, op, rate, weight)
+            self.active[transfer.id] = transfer
+            self._reallocate()
+        return transfer
+
+    def close(self, transfer):
+        with self._lock:
+            if self.active.pop(transfer.id, None) is not None:
+                self._reallocate()
+
+    @contextlib.contextmanager
+    def pace(self, conn, user, op):
+        """Pace conn's byte loops as one transfer of user's for the duration of the block."""
+        transfer = self.open(user, op)
+        conn.pacer = transfer
+        try:
+            yield transfer
+        finally:
+            conn.pacer = None
+            transfer.close()
+
+    def _reallocate(self):
+        by_user = defaultdict(list)
+        for transfer in self.active.values():
+            by_user[transfer.user].append(transfer)
+        # Per transfer: (cap from the user's own limit, weight in the global split)
+        shares = {}
+        for group in by_user.values():
+            cap = group[0].user_rate / len(group) if group[0].user_rate else UNLIMITED
+            for transfer in group:
+                shares[transfer] = (cap, transfer.user_weight / len(group))
+
+        capacity = self.global_rate or UNLIMITED
+        weight_left = sum(weight for _, weight in shares.values())
+        # Most constrained (cap per unit of weight) first, so what they leave is shared out
+        for transfer in sorted(shares, key=lambda t: shares[t][0] / shares[t][1]):
+            cap, weight = shares[transfer]
+            fair = capacity * weight / weight_left if capacity != UNLIMITED else UNLIMITED
+            rate = min(cap, fair)
+            transfer.set_rate(rate)
+            if capacity != UNLIMITED:
+                capacity -= rate
+            weight_left -= weight
+
+    def snapshot(self):
+        with self._lock:
+            transfers = list(self.active.values())
+        return [{'id': t.id, 'user': t.user, 'op': t.op, 'bytes': t.bytes, 'rate': t.measured_rate(),
+                 'allocated': None if t.rate == UNLIMITED else t.rate} for t in transfers]
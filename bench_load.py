@@ -0,0 +1,365 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import bench_striped
+import compress
+import protocol
+
+# Headless load generator: N simulated users each hold a session and run a
+# weighted mix of upload, download, preview and delete operations until the
+# time is up. Reports per-operation throughput, p50/p95/p99 latency and error
+# rate, and writes the results as JSON so runs can be compared across versions.
+#
+#   python3 bench_load.py --users 32 --duration 60 --mix upload=30,download=40,preview=20,delete=10 \
+#       --sizes 4K=50,256K=30,8M=15,64M=5 --output results.json
+#
+# By default a server is started in a scratch directory (see bench_striped.py);
+# --target host:port points the load at a running server instead.
+
+DEFAULT_ACCOUNTS = ['user1:password123', 'user2:mysecurepass', 'user3:testpassword']
+OPERATIONS = ('upload', 'download', 'preview', 'delete')
+PROMPT = "Enter command"
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# Pause after a failed operation before reconnecting, so errors do not spin
+ERROR_BACKOFF = 0.2
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def parse_weights(text, parse_key=str):
+    """'a=3,b=1' -> ([a, b], [3, 1])."""
+    keys, weights = [], []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        keys.append(parse_key(key.strip()))
+        weights.append(float(weight or 1))
+    if not keys or sum(weights) <= 0:
+        raise argparse.ArgumentTypeError(f"No positive weights in '{text}'")
+    return keys, weights
+
+
+def parse_size(text):
+    text = text.upper().rstrip('B').rstrip('I')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def parse_mix(text):
+    operations, weights = parse_weights(text)
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown operations: {', '.join(sorted(unknown))}")
+    return operations, weights
+
+
+class PatternReader:
+    """size bytes of incompressible data for send_stream(), cycled from one shared block."""
+
+    BLOCK = os.urandom(1024 * 1024)
+
+    def __init__(self, size, seed):
+        self.remaining = size
+        self.position = seed % len(self.BLOCK)
+
+    def read(self, size):
+        size = min(size, self.remaining, len(self.BLOCK) - self.position)
+        data = self.BLOCK[self.position:self.position + size]
+        self.position = (self.position + size) % len(self.BLOCK)
+        self.remaining -= size
+        return data
+
+
+class NullSink:
+    def write(self, data):
+        return len(data)
+
+
+class VirtualUser:
+    """One simulated client: a framed session and the files it has uploaded."""
+
+    def __init__(self, number, args, results):
+        self.number = number
+        self.args = args
+        self.results = results
+        self.username, self.password = args.accounts[number % len(args.accounts)].split(':', 1)
+        self.random = random.Random(args.seed * 1000003 + number)
+        self.files = []
+        self.counter = 0
+        self.conn = None
+
+    def connect(self):
+        sock = socket.create_connection((self.args.host, self.args.port), timeout=self.args.timeout)
+        self.conn = protocol.client_handshake(sock, codecs=compress.offer(self.args.compress))
+        self.conn.recv_msg()
+        self.conn.send_msg(self.username)
+        self.conn.recv_msg()
+        self.conn.send_msg(self.password)
+        response = self.conn.recv_msg()
+        if response != "Authentication successful.":
+            raise BenchmarkError(f"Login failed for {self.username}: {response}")
+        self.expect_prompt()
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.send_msg('exit')
+            except OSError:
+                pass
+            self.conn.sock.close()
+            self.conn = None
+
+    def expect(self, expected):
+        response = self.conn.recv_msg()
+        if not response.startswith(expected):
+            raise BenchmarkError(f"Expected '{expected}', got '{response}'")
+        return response
+
+    def expect_prompt(self):
+        self.expect(PROMPT)
+
+    def run(self, deadline):
+        operations, weights = self.args.mix
+        while time.monotonic() < deadline:
+            operation = self.random.choices(operations, weights)[0]
+            if operation != 'upload' and not self.files:
+                operation = 'upload'
+            started = time.perf_counter()
+            try:
+                if self.conn is None:
+                    self.connect()
+                    started = time.perf_counter()
+                size = getattr(self, operation)()
+                self.results.record(operation, time.perf_counter() - started, size)
+            except (BenchmarkError, OSError, ConnectionError, protocol.TransferAborted) as e:
+                self.results.record(operation, time.perf_counter() - started, 0, error=str(e))
+                if self.conn:
+                    self.conn.sock.close()
+                    self.conn = None
+                time.sleep(ERROR_BACKOFF)
+        self.close()
+
+    def upload(self):
+        sizes, weights = self.args.sizes
+        size = self.random.choices(sizes, weights)[0]
+        self.counter += 1
+        filename = f"bench-{self.number}-{self.counter}.bin"
+        self.conn.send_msg('upload')
+        self.expect("Ready to receive the filename.")
+        self.conn.send_msg(filename)
+        self.expect("Ready to receive file data.")
+        self.conn.send_stream(PatternReader(size, self.counter))
+        self.expect("File upload completed successfully.")
+        self.expect_prompt()
+        self.files.append((filename, size))
+        return size
+
+    def download(self):
+        filename, size = self.random.choice(self.files)
+        self.conn.send_msg('download')
+        self.conn.send_msg(filename)
+        self.expect("FILE_FOUND")
+        received = self.conn.recv_stream(NullSink())
+        if received != size:
+            raise BenchmarkError(f"Downloaded {received} of {size} bytes of {filename}")
+        self.expect_prompt()
+        return received
+
+    def preview(self):
+        filename, _ = self.random.choice(self.files)
+        self.conn.send_msg('download')
+        self.conn.send_msg(f"PREVIEW {filename}")
+        self.expect("PREVIEW_MODE")
+        received = self.conn.recv_stream(NullSink())
+        self.expect_prompt()
+        return received
+
+    def delete(self):
+        filename, _ = self.files.pop(self.random.randrange(len(self.files)))
+        self.conn.send_msg('delete')
+        self.expect("Enter the filename to delete")
+        self.conn.send_msg(filename)
+        self.expect("FILE_DELETED")
+        self.expect_prompt()
+        return 0
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {operation: [] for operation in OPERATIONS}
+        self.bytes = dict.fromkeys(OPERATIONS, 0)
+        self.errors = dict.fromkeys(OPERATIONS, 0)
+        self.error_messages = {}
+        self.recording = False
+
+    def record(self, operation, seconds, size, error=None):
+        with self.lock:
+            if not self.recording:
+                return
+            if error:
+                self.errors[operation] += 1
+                self.error_messages[error] = self.error_messages.get(error, 0) + 1
+            else:
+                self.samples[operation].append(seconds)
+                self.bytes[operation] += size
+
+    def summary(self, elapsed):
+        operations = {}
+        for operation in OPERATIONS:
+            latencies = sorted(self.samples[operation])
+            attempts = len(latencies) + self.errors[operation]
+            if not attempts:
+                continue
+            operations[operation] = {
+                'ops': len(latencies),
+                'errors': self.errors[operation],
+                'error_rate': self.errors[operation] / attempts,
+                'ops_per_second': len(latencies) / elapsed,
+                'mib_per_second': self.bytes[operation] / elapsed / (1024 * 1024),
+                'latency_seconds': {
+                    'mean': sum(latencies) / len(latencies) if latencies else None,
+                    'p50': percentile(latencies, 50),
+                    'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99),
+                    'max': latencies[-1] if latencies else None,
+                },
+            }
+        ops = sum(result['ops'] for result in operations.values())
+        errors = sum(result['errors'] for result in operations.values())
+        return {
+            'elapsed_seconds': elapsed,
+            'ops': ops,
+            'errors': errors,
+            'error_rate': errors / (ops + errors) if ops + errors else 0.0,
+            'ops_per_second': ops / elapsed,
+            'mib_per_second': sum(self.bytes.values()) / elapsed / (1024 * 1024),
+            'operations': operations,
+            'error_messages': dict(sorted(self.error_messages.items(), key=lambda item: -item[1])[:10]),
+        }
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(summary):
+    def ms(value):
+        return f"{value * 1000:9.1f}" if value is not None else f"{'-':>9}"
+
+    print(f"\n{'operation':<10} {'ops':>7} {'ops/s':>8} {'MiB/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for operation, result in summary['operations'].items():
+        latency = result['latency_seconds']
+        print(f"{operation:<10} {result['ops']:>7} {result['ops_per_second']:>8.1f} {result['mib_per_second']:>8.1f} "
+              f"{ms(latency['p50'])} {ms(latency['p95'])} {ms(latency['p99'])} {result['error_rate']:>6.1%}")
+    print(f"{'total':<10} {summary['ops']:>7} {summary['ops_per_second']:>8.1f} {summary['mib_per_second']:>8.1f} "
+          f"{'':>29} {summary['error_rate']:>6.1%}")
+    for message, count in summary['error_messages'].items():
+        print(f"  {count} x {message}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent load benchmark for the DFOS server")
+    parser.add_argument('--users', type=int, default=8, help="concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=30, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds of load before measuring starts")
+    parser.add_argument('--mix', type=parse_mix, default='upload=30,download=40,preview=20,delete=10',
+                        help="operation weights")
+    parser.add_argument('--sizes', type=lambda text: parse_weights(text, parse_size),
+                        default='4K=50,256K=30,4M=15,32M=5', help="upload size distribution as size=weight")
+    parser.add_argument('--account', dest='accounts', action='append',
+                        help="user:password to log in with (repeatable; users are spread across them)")
+    parser.add_argument('--compress', choices=['auto', 'none'] + sorted(compress.CODECS), default='none',
+                        help="transfer compression the simulated clients offer")
+    parser.add_argument('--timeout', type=float, default=60, help="socket timeout per operation")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--target', help="host:port of a running server (default: start one locally)")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--workers', type=int, help="server client workers (default: --users + 2)")
+    parser.add_argument('--server-arg', dest='server_args', action='append', default=[],
+                        help="extra argument for the local server, e.g. --server-arg=--processes=4")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+    args.accounts = args.accounts or DEFAULT_ACCOUNTS
+    return args
+
+
+def main():
+    args = parse_args()
+    server = workdir = None
+    if args.target:
+        args.host, _, port = args.target.rpartition(':')
+        args.port = int(port)
+    else:
+        workdir = tempfile.mkdtemp(prefix='dfos_load_')
+        args.host, args.port = '127.0.0.1', bench_striped.free_port()
+        server = bench_striped.start_server(workdir, args.port, args.engine, args.workers or args.users + 2,
+                                            args.server_args)
+
+    results = Results()
+    users = [VirtualUser(number, args, results) for number in range(args.users)]
+    deadline = time.monotonic() + args.warmup + args.duration
+    threads = [threading.Thread(target=user.run, args=(deadline,), daemon=True) for user in users]
+    try:
+        print(f"{args.users} users, {args.warmup:g}s warm-up + {args.duration:g}s against {args.host}:{args.port}...")
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        with results.lock:
+            results.recording = True
+        started = time.monotonic()
+        for thread in threads:
+            thread.join()
+        with results.lock:
+            results.recording = False
+            summary = results.summary(time.monotonic() - started)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(summary)
+    if args.output:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {
+                'users': args.users, 'duration': args.duration, 'warmup': args.warmup,
+                'mix': dict(zip(*args.mix)), 'sizes': dict(zip(*args.sizes)), 'compress': args.compress,
+                'target': args.target, 'engine': None if args.target else args.engine,
+                'server_args': args.server_args, 'seed': args.seed,
+            },
+            'results': summary,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import dfos_client
+
+# Measures striped upload and download throughput against a local server for
+# increasing stream counts. The server runs in a scratch directory with a
+# copy of id_passwd.txt, so the repository's server_storage is left alone.
+#
+#   python3 bench_striped.py --size-mb 1024 --streams 1 2 4 8
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(workdir, port, engine, workers, extra_args=()):
+    here = os.path.dirname(os.path.abspath(__file__))
+    shutil.copy(os.path.join(here, 'id_passwd.txt'), workdir)
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'server.py'), '--port', str(port),
+         '--engine', engine, '--workers', str(workers), '--backlog', '128', *extra_args],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Striped transfer scaling benchmark")
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--stripe-mb', type=int, default=8)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--username', default='user1')
+    parser.add_argument('--password', default='password123')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='dfos_stripes_')
+    port = free_port()
+    server = start_server(workdir, port, args.engine, max(args.streams) * 2 + 2)
+    source = os.path.join(workdir, 'source.bin')
+    with open(source, 'wb') as file:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            file.write(block)
+    size = args.size_mb * 1024 * 1024
+
+    try:
+        print(f"{'streams':>7} {'upload MiB/s':>13} {'download MiB/s':>15}")
+        for streams in args.streams:
+            target = os.path.join(workdir, f'download_{streams}.bin')
+            with dfos_client.Client('127.0.0.1', port, args.username, args.password, compression='none',
+                                    streams=streams, stripe_size=args.stripe_mb * 1024 * 1024) as dfos:
+                start = time.perf_counter()
+                dfos.upload(source)
+                upload_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                dfos.download('source.bin', target)
+                download_time = time.perf_counter() - start
+            os.remove(target)
+            mib = size / (1024 * 1024)
+            print(f"{streams:>7} {mib / upload_time:>13.1f} {mib / download_time:>15.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import protocol
+import tls
+from bench_download import NullSink, create_test_file
+
+# Cost of TLS on the wire protocol over loopback: handshake latency (TCP
+# connect, TLS handshake and protocol hello, until the first frame can be
+# sent) and bulk download throughput, for plaintext, full TLS handshakes and
+# resumed ones. Both sides use protocol.FramedConnection and tls.py as
+# server.py and dfos_client.py do. The certificate is a throwaway self-signed
+# one made with the openssl command in a temporary directory.
+#
+#   python3 bench_tls.py --handshakes 500 --size-mb 1024 --runs 3
+
+MODES = ('plaintext', 'tls', 'tls-resumed')
+
+
+def make_certificate(directory):
+    """Self-signed P-256 certificate for localhost/127.0.0.1; returns (certfile, keyfile)."""
+    if shutil.which('openssl') is None:
+        raise SystemExit("bench_tls.py needs the openssl command to create a test certificate.")
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-keyout', keyfile, '-out', certfile, '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class Server:
+    """Loopback listener that runs handler(conn) for each connection on its own thread."""
+
+    def __init__(self, context, handler):
+        self.context = context
+        self.handler = handler
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.result = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.context is not None:
+                sock = tls.wrap_server(self.context, sock)
+            try:
+                conn = protocol.server_handshake(sock)
+                self.handler(self, conn)
+            except (OSError, protocol.ProtocolError):
+                pass
+            finally:
+                sock.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def connect(port, client_tls, resume):
+    sock = socket.create_connection(('127.0.0.1', port))
+    if client_tls is not None:
+        if not resume:
+            client_tls.forget('127.0.0.1', port)
+        sock = client_tls.wrap(sock, '127.0.0.1', port)
+    conn = protocol.client_handshake(sock)
+    if client_tls is not None:
+        client_tls.remember(sock, '127.0.0.1', port)
+    return conn
+
+
+def measure_handshakes(mode, server_context, client_tls, count):
+    server = Server(server_context if mode != 'plaintext' else None, lambda server, conn: None)
+    client = client_tls if mode != 'plaintext' else None
+    try:
+        # Untimed: primes the session cache for tls-resumed
+        connect(server.port, client, False).close()
+        timings = []
+        for _ in range(count):
+            start = time.perf_counter()
+            conn = connect(server.port, client, mode == 'tls-resumed')
+            timings.append(time.perf_counter() - start)
+            conn.close()
+    finally:
+        server.close()
+    timings.sort()
+    return timings
+
+
+def measure_transfer(mode, server_context, client_tls, path):
+    def send(server, conn):
+        server.result['ktls'] = tls.kernel_send(conn.sock)
+        with open(path, 'rb') as file:
+            server.result['sent'] = conn.send_file(file)
+
+    server = Server(server_context if mode != 'plaintext' else None, send)
+    try:
+        conn = connect(server.port, client_tls if mode != 'plaintext' else None, mode == 'tls-resumed')
+        start = time.perf_counter()
+        received = conn.recv_stream(NullSink())
+        elapsed = time.perf_counter() - start
+        conn.close()
+    finally:
+        server.close()
+    if received != os.path.getsize(path):
+        raise RuntimeError(f"Short transfer: {received} of {os.path.getsize(path)} bytes")
+    return received, elapsed, server.result.get('ktls', False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS handshake and throughput benchmark")
+    parser.add_argument('--handshakes', type=int, default=200, help="connections timed per mode")
+    parser.add_argument('--size-mb', type=int, default=512, help="test file size in MiB")
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='dfos_bench_tls_') as directory:
+        certfile, keyfile = make_certificate(directory)
+        server_context = tls.server_context(certfile, keyfile)
+        client_tls = tls.ClientTLS(tls.client_context(certfile))
+
+        print(f"Handshake latency over {args.handshakes} connections:")
+        for mode in MODES:
+            timings = measure_handshakes(mode, server_context, client_tls, args.handshakes)
+            median = timings[len(timings) // 2] * 1000
+            p99 = timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000
+            print(f"{mode:>12}: median {median:7.3f} ms, p99 {p99:7.3f} ms")
+        print(f"  (client handshakes: {client_tls.full} full, {client_tls.resumed} resumed)")
+
+        path = os.path.join(directory, 'payload')
+        print(f"Creating {args.size_mb} MiB test file...")
+        create_test_file(path, args.size_mb * 1024 * 1024)
+        with open(path, 'rb') as file:
+            while file.read(protocol.FALLBACK_BUFFER_SIZE):
+                pass
+        for mode in MODES:
+            rates = []
+            for _ in range(args.runs):
+                size, elapsed, ktls = measure_transfer(mode, server_context, client_tls, path)
+                rates.append(size / elapsed / (1024 * 1024))
+            send_path = 'sendfile' if protocol.SENDFILE_AVAILABLE and (mode == 'plaintext' or ktls) else 'buffered'
+            print(f"{mode:>12}: best {max(rates):8.1f} MiB/s, mean {sum(rates) / len(rates):8.1f} MiB/s "
+                  f"over {args.runs} runs ({send_path})")
+
+
+if __name__ == "__main__":
+    main()
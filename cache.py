@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+# In-memory cache of hot file contents and previews, shared by every
+# connection in a server process.
+#
+# Entries are keyed on (path, mtime_ns, size, kind) of the stored file (or
+# its manifest, with the dedup backend), so a file replaced by an upload, or
+# by another pre-forked worker, is never served stale: its new stat simply
+# misses. Uploads and deletes also drop the old entries straight away to give
+# the memory back. Small files are cached whole; larger ones only have their
+# preview block cached.
+
+
+class ContentCache:
+    """Byte-bounded LRU cache. Values are (data, logical file size) pairs."""
+
+    def __init__(self, capacity, max_entry, tracker=None):
+        self.capacity = capacity
+        # One large file must not be able to flush everything else
+        self.max_entry = min(max_entry, capacity)
+        self.tracker = tracker
+        self.entries = OrderedDict()
+        self.paths = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def fits(self, size):
+        return size <= self.max_entry
+
+    def get(self, *keys):
+        """Value of the first of keys present, or None; counts one hit or one miss."""
+        value = None
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                    break
+        if self.tracker:
+            if value is None:
+                self.tracker.log_cache(misses=1)
+            else:
+                self.tracker.log_cache(hits=1)
+        return value
+
+    def put(self, key, data, size):
+        if len(data) > self.max_entry:
+            return
+        evicted = 0
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (data, size)
+            self.paths.setdefault(key[0], set()).add(key)
+            self.size += len(data)
+            while self.size > self.capacity:
+                self._drop(next(iter(self.entries)))
+                evicted += 1
+        if evicted and self.tracker:
+            self.tracker.log_cache(evictions=evicted)
+
+    def invalidate(self, path):
+        with self.lock:
+            for key in list(self.paths.get(path, ())):
+                self._drop(key)
+
+    def _drop(self, key):
+        value = self.entries.pop(key, None)
+        if value is None:
+            return
+        self.size -= len(value[0])
+        keys = self.paths[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[0]]
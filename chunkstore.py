@@ -0,0 +1,397 @@
+import io
+import os
+import bisect
+import mmap
+import json
+import struct
+import sqlite3
+import hashlib
+import threading
+
+# Content-addressed, deduplicated storage backend (`server.py --storage dedup`).
+#
+# Files are cut into content-defined chunks (FastCDC-style Gear hash, so an
+# insertion only changes the chunks around it) and every chunk is stored once
+# under its SHA-256:
+#
+#   server_storage/.dfos/chunks/ab/cd/<sha256>      chunk data
+#   server_storage/.dfos/chunks.db                  chunk sizes and reference counts
+#   server_storage/.dfos/manifests/<user>/<name>    JSON list of a file's chunks
+#
+# A chunk's reference count is the number of manifest entries pointing at it;
+# deleting or replacing a file releases its references and removes chunks that
+# drop to zero. Counts live in SQLite so pre-forked workers can share them.
+# Kept versions and snapshots of a file (versions.py) are copies of its
+# manifest that hold references of their own, so old data stays shared.
+
+MIN_CHUNK = 2 * 1024
+AVG_CHUNK = 8 * 1024
+MAX_CHUNK = 64 * 1024
+
+# 30-bit Gear hash: small ints keep the per-byte loop cheap in CPython. The
+# top bits depend on the last ~30 bytes, which is the effective window.
+_HASH_MASK = 0x3fffffff
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') & _HASH_MASK for i in range(256)]
+# Normalised chunking: a stricter mask before AVG_CHUNK, a looser one after
+_MASK_STRICT = ((1 << 15) - 1) << 15
+_MASK_LOOSE = ((1 << 11) - 1) << 19
+
+# Manifest entry on the wire: raw SHA-256 and chunk length
+ENTRY = struct.Struct('!32sI')
+INDEX = struct.Struct('!I')
+
+
+def _cut_point(data, start, end):
+    remaining = end - start
+    if remaining <= MIN_CHUNK:
+        return end
+    normal = start + min(remaining, AVG_CHUNK)
+    limit = start + min(remaining, MAX_CHUNK)
+    position = start + MIN_CHUNK
+    h = 0
+    gear = _GEAR
+    for byte in data[position:normal]:
+        h = ((h << 1) + gear[byte]) & _HASH_MASK
+        position += 1
+        if not h & _MASK_STRICT:
+            return position
+    for byte in data[position:limit]:
+        h = ((h << 1) + gear[byte]) & _HASH_MASK
+        position += 1
+        if not h & _MASK_LOOSE:
+            return position
+    return limit
+
+
+def chunk_boundaries(data):
+    """Yield (offset, length) of each content-defined chunk of data."""
+    start, end = 0, len(data)
+    while start < end:
+        cut = _cut_point(data, start, end)
+        yield start, cut - start
+        start = cut
+
+
+def file_chunks(path):
+    """[(sha256 digest, offset, length)] for the file at path."""
+    if not os.path.getsize(path):
+        return []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return [(hashlib.sha256(data[offset:offset + length]).digest(), offset, length)
+                for offset, length in chunk_boundaries(data)]
+
+
+def encode_manifest(chunks):
+    return b''.join(ENTRY.pack(digest, length) for digest, _, length in chunks)
+
+
+def decode_manifest(data):
+    return [(digest.hex(), length) for digest, length in ENTRY.iter_unpack(data)]
+
+
+class ChunkReader:
+    """read() over the given (digest, offset, length) chunks of a file, in order."""
+
+    def __init__(self, file, chunks):
+        self.file = file
+        self.chunks = iter(chunks)
+        self.remaining = 0
+
+    def read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            if not self.remaining:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                _, offset, self.remaining = chunk
+                self.file.seek(offset)
+            piece = self.file.read(min(size - len(data), self.remaining))
+            if not piece:
+                raise OSError("File changed while uploading.")
+            data += piece
+            self.remaining -= len(piece)
+        return bytes(data)
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+class ChunkStore:
+    def __init__(self, root):
+        self.chunk_root = os.path.join(root, "chunks")
+        self.manifest_root = os.path.join(root, "manifests")
+        self.db_path = os.path.join(root, "chunks.db")
+        os.makedirs(self.chunk_root, exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER)")
+
+    def _db(self):
+        return _Transaction(sqlite3.connect(self.db_path, timeout=30, isolation_level=None))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_root, digest[:2], digest[2:4], digest)
+
+    def manifest_path(self, user, filename):
+        return os.path.join(self.manifest_root, user, filename)
+
+    def missing(self, entries):
+        """Indices into entries of the chunks the store lacks, each digest listed once."""
+        wanted = list({digest for digest, _ in entries})
+        present = set()
+        with self._db() as db:
+            for start in range(0, len(wanted), 500):
+                batch = wanted[start:start + 500]
+                rows = db.execute(f"SELECT hash FROM chunks WHERE hash IN ({','.join('?' * len(batch))})", batch)
+                present.update(row[0] for row in rows)
+        indices = []
+        for index, (digest, _) in enumerate(entries):
+            if digest not in present:
+                present.add(digest)
+                indices.append(index)
+        return indices
+
+    def write_chunk(self, digest, data):
+        """Put chunk data on disk. It only counts as stored once a commit() references it."""
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, 'wb') as file:
+            file.write(data)
+        os.replace(temp, path)
+
+    def ingest(self, path):
+        """Chunk a local file into the store; returns its manifest entries."""
+        entries = []
+        if not os.path.getsize(path):
+            return entries
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, length in chunk_boundaries(data):
+                chunk = data[offset:offset + length]
+                digest = hashlib.sha256(chunk).hexdigest()
+                self.write_chunk(digest, chunk)
+                entries.append((digest, length))
+        return entries
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return None
+        return [(digest, length) for digest, length in manifest['chunks']]
+
+    def read_manifest(self, user, filename):
+        return self._read(self.manifest_path(user, filename))
+
+    def exists(self, user, filename):
+        return os.path.isfile(self.manifest_path(user, filename))
+
+    def commit(self, user, filename, entries, sync=None):
+        """Point user/filename at entries: reference its chunks, then release the previous version's.
+
+        sync, if given, is called with the new manifest's temp path before it
+        is renamed into place.
+        """
+        path = self.manifest_path(user, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Chunk files are only removed while this write lock is held, so a
+        # chunk that exists here cannot disappear before the commit lands.
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            for digest, (count, size) in _reference_counts(entries).items():
+                if db.execute("UPDATE chunks SET refs = refs + ? WHERE hash = ?", (count, digest)).rowcount:
+                    continue
+                if not os.path.exists(self.chunk_path(digest)):
+                    raise ChunkStoreError("Chunks were removed during the upload; please retry.")
+                db.execute("INSERT INTO chunks VALUES (?, ?, ?)", (digest, size, count))
+            old = self.read_manifest(user, filename)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, 'w') as file:
+                json.dump({'size': sum(length for _, length in entries), 'chunks': entries}, file)
+            if sync is not None:
+                sync(temp)
+            os.replace(temp, path)
+            self._release(db, old or [])
+
+    def delete(self, user, filename):
+        """Remove a file's manifest and garbage-collect chunks nothing references any more."""
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            entries = self.read_manifest(user, filename)
+            if entries is None:
+                return False
+            os.remove(self.manifest_path(user, filename))
+            self._release(db, entries)
+        return True
+
+    def retain_copy(self, user, filename, dest):
+        """Copy a file's manifest to dest (which must not exist) and reference its chunks again.
+
+        Returns False if the file has no manifest.
+        """
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            entries = self.read_manifest(user, filename)
+            if entries is None:
+                return False
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, 'x') as file:
+                json.dump({'size': sum(length for _, length in entries), 'chunks': entries}, file)
+            for digest, (count, _) in _reference_counts(entries).items():
+                db.execute("UPDATE chunks SET refs = refs + ? WHERE hash = ?", (count, digest))
+        return True
+
+    def release_copy(self, path):
+        """Remove a manifest copy made by retain_copy() and drop its references."""
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            entries = self._read(path)
+            if entries is None:
+                return False
+            os.remove(path)
+            self._release(db, entries)
+        return True
+
+    def read_copy(self, path):
+        return self._read(path)
+
+    def open_copy(self, path):
+        entries = self._read(path)
+        if entries is None:
+            raise FileNotFoundError(path)
+        return ManifestReader(self, entries)
+
+    def _release(self, db, entries):
+        for digest, (count, _) in _reference_counts(entries).items():
+            db.execute("UPDATE chunks SET refs = refs - ? WHERE hash = ?", (count, digest))
+            row = db.execute("SELECT refs FROM chunks WHERE hash = ?", (digest,)).fetchone()
+            if row and row[0] <= 0:
+                db.execute("DELETE FROM chunks WHERE hash = ?", (digest,))
+                try:
+                    os.remove(self.chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def open(self, user, filename):
+        entries = self.read_manifest(user, filename)
+        if entries is None:
+            raise FileNotFoundError(filename)
+        return ManifestReader(self, entries)
+
+
+def _reference_counts(entries):
+    counts = {}
+    for digest, length in entries:
+        count, _ = counts.get(digest, (0, length))
+        counts[digest] = (count + 1, length)
+    return counts
+
+
+class _Transaction:
+    """sqlite3 connection context that commits or rolls back, then closes."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.close()
+
+
+class ChunkSink:
+    """File-like sink for the chunks a client sends: splits the stream by the
+    expected lengths, checks each chunk's hash and writes it to the store."""
+
+    def __init__(self, store, expected):
+        self.store = store
+        self.expected = list(expected)
+        self.index = 0
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+        while self.index < len(self.expected):
+            digest, length = self.expected[self.index]
+            if len(self.pending) < length:
+                break
+            chunk = bytes(self.pending[:length])
+            del self.pending[:length]
+            if hashlib.sha256(chunk).hexdigest() != digest:
+                raise OSError(f"Chunk {self.index} does not match its hash.")
+            self.store.write_chunk(digest, chunk)
+            self.index += 1
+        if self.index == len(self.expected) and self.pending:
+            raise OSError("More chunk data than announced.")
+        return len(data)
+
+    def complete(self):
+        return self.index == len(self.expected) and not self.pending
+
+
+class ManifestReader(io.RawIOBase):
+    """Seekable read-only view of a deduplicated file, reassembled from its chunks.
+
+    It has no fileno(), so downloads of deduplicated files use buffered reads
+    instead of sendfile() and mmap.
+    """
+
+    def __init__(self, store, entries):
+        self.store = store
+        self.entries = entries
+        self.offsets = []
+        position = 0
+        for _, length in entries:
+            self.offsets.append(position)
+            position += length
+        self.size = position
+        self.position = 0
+        self._cached = (None, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def _chunk(self, index):
+        digest = self.entries[index][0]
+        if self._cached[0] != digest:
+            with open(self.store.chunk_path(digest), 'rb') as file:
+                self._cached = (digest, file.read())
+        return self._cached[1]
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.size:
+            index = bisect.bisect_right(self.offsets, self.position) - 1
+            chunk = self._chunk(index)
+            start = self.position - self.offsets[index]
+            count = min(len(chunk) - start, len(view) - written)
+            view[written:written + count] = chunk[start:start + count]
+            written += count
+            self.position += count
+        return written
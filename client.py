@@ -1,8 +1,12 @@
-import socket
 import os
 import time
 import signal
 import sys
+import argparse
+import protocol
+import compress
+import dfos_client
+import tls
 
 #Captures (Ctrl+C) signals and gracefully terminates the client program to avoid abrupt exits.
 def handle_sigint(signum, frame):
@@ -88,12 +92,9 @@ def browse_for_file():
             else:
                 print("Invalid path or selection.")
 
-#Allows the users to upload a file to the server by navigating to the desired file, ensuring it exists and is accessible, and then sending it over in chunks.
-def upload_file(client_socket):
+#Allows the users to upload a file to the server by navigating to the desired file, ensuring it exists and is accessible, and then streaming it over without waiting for per-chunk acknowledgements.
+def upload_file(client):
     try:
-        initial_response = client_socket.recv(1024).decode()
-        print(initial_response)
-        
         print("\nFile Browser - Navigate to your file:")
         print("Current working directory:", os.getcwd())
         print("Type '..' to go up one directory")
@@ -105,12 +106,10 @@ def upload_file(client_socket):
         selected_path = browse_for_file()
         if selected_path is None:  # User chose to exit
             print("Returning to main menu...")
-            client_socket.sendall(b"CANCEL_UPLOAD")
             return False
             
         if os.path.isdir(selected_path):
             print("Please select a file, not a directory.")
-            client_socket.sendall(b"CANCEL_UPLOAD")
             return False
             
         abs_path = os.path.abspath(selected_path)
@@ -118,222 +117,379 @@ def upload_file(client_socket):
         
         if not os.path.exists(abs_path):
             print(f"File does not exist at path: {abs_path}")
-            client_socket.sendall(b"CANCEL_UPLOAD")
             return False
         
         if not os.access(abs_path, os.R_OK):
             print(f"File exists but is not readable: {abs_path}")
-            client_socket.sendall(b"CANCEL_UPLOAD")
-            return False
-            
-        # Send just the basename, not the full path
-        client_socket.sendall(os.path.basename(abs_path).encode())
-        response = client_socket.recv(1024).decode()
-        print(response)
-        
-        if response != "Ready to receive file data.":
-            return False
-        
-        try:
-            file_size = os.path.getsize(abs_path)
-            print(f"Starting upload of {file_size} bytes...")
-            
-            with open(abs_path, 'rb') as file:
-                bytes_sent = 0
-                while chunk := file.read(1024):
-                    client_socket.sendall(chunk)
-                    ack = client_socket.recv(1024).decode()
-                    bytes_sent += len(chunk)
-                    print(f"Progress: {bytes_sent}/{file_size} bytes ({(bytes_sent/file_size)*100:.1f}%)")
-                    if ack != "Chunk received.":
-                        print("Error in transmission, retrying...")
-                        client_socket.sendall(chunk)
-        except Exception as e:
-            print(f"Error during file upload: {e}")
-            client_socket.sendall(b'UPLOAD_ERROR')
             return False
-        
-        client_socket.sendall(b'END_OF_FILE')
-        final_response = client_socket.recv(1024).decode()
-        print(final_response)
+
+        client.upload(abs_path, progress=show_progress)
+        print(dfos_client.UPLOAD_DONE)
         return True
-        
+
+    except dfos_client.ClientError as e:
+        print(e)
+        return False
+    except ConnectionError:
+        raise
     except Exception as e:
         print(f"Error in upload process: {e}")
         return False
 
+def show_progress(done, total):
+    if total:
+        print(f"Progress: {done}/{total} bytes ({(done/total)*100:.1f}%)")
+
+def print_preview(title, data):
+    print(f"\n--- {title} ---")
+    try:
+        print(data.decode('utf-8'))
+    except UnicodeDecodeError:
+        print("[Binary data preview]")
+    print("\n--- End of Preview ---")
+
 #Allows users to download a file from the server and enables them to preview the first few bytes of the file if requested.
-def download_file(client_socket):
+def download_file(client):
     try:
-        filename = input("Enter the filename to download or type 'PREVIEW <filename>' for a byte preview: ").strip()
-        
-        # Send the request to server
-        client_socket.sendall(filename.encode())
-        
-        # Get initial response from server
-        response = client_socket.recv(1024).decode()
+        request = input("Enter the filename to download, 'PREVIEW <filename>' for a byte preview or 'RANGE <offset> <length> <filename>': ").strip()
         
-        if response == "FILE_NOT_FOUND":
-            print("Error: File not found on server.")
-            return False
-            
-        elif response == "PREVIEW_MODE":
-            print("\n--- Preview of the file's first 1024 bytes ---")
-            preview_data = b""
-            
-            while True:
-                chunk = client_socket.recv(1024)
-                if chunk.endswith(b"END_OF_PREVIEW"):
-                    preview_data += chunk[:-14]  # Remove END_OF_PREVIEW marker
-                    break
-                preview_data += chunk
-            
+        if request.startswith("PREVIEW "):
+            data = client.preview(request[len("PREVIEW "):])
+            print_preview(f"Preview of the file's first {dfos_client.PREVIEW_SIZE} bytes", data)
+        elif request.startswith("RANGE "):
             try:
-                print(preview_data.decode('utf-8'))
-            except UnicodeDecodeError:
-                print("[Binary data preview]")
-            print("\n--- End of Preview ---")
-            return True
-            
-        elif response == "FILE_FOUND":
-            print(f"Downloading file: {filename}")
-            save_name = filename.split('/')[-1]  # Get just the filename part
-            
-            with open(save_name, 'wb') as file:
-                while True:
-                    chunk = client_socket.recv(1024)
-                    if chunk.endswith(b"END_OF_FILE"):
-                        file.write(chunk[:-11])  # Remove END_OF_FILE marker
-                        break
-                    file.write(chunk)
-            
-            print(f"File {save_name} downloaded successfully.")
-            return True
-            
-        elif response == "ERROR":
-            print("Server encountered an error while processing the request.")
-            return False
-            
+                _, offset, length, filename = request.split(' ', 3)
+                offset, length = int(offset), int(length)
+            except ValueError:
+                print("Usage: RANGE <offset> <length> <filename>")
+                return False
+            data, total = client.read_range(filename, offset, length)
+            print_preview(f"Bytes {offset}-{offset + len(data)} of {total}", data)
         else:
-            print(f"Unexpected server response: {response}")
-            return False
+            save_name = request.split('/')[-1]  # Get just the filename part
+            print(f"Downloading file: {request}")
+            client.download(request, save_name)
+            print(f"File {save_name} downloaded successfully.")
+        return True
             
+    except dfos_client.ClientError as e:
+        print(f"Error: {e}")
+        return False
+    except protocol.TransferAborted:
+        print("Server encountered an error while processing the request.")
+        return False
+    except ConnectionError:
+        raise
     except Exception as e:
         print(f"Error during download: {e}")
         return False
 
-# Handles the file deletion process by communicating with the server and managing user input and server responses.
-def delete_file(client_socket):
+# Asks for a filename and deletes it from the server.
+def delete_file(client):
     try:
-        # Receive the prompt from server
-        prompt = client_socket.recv(1024).decode()
-        print(prompt, end='')
-        
-        # Request the filename to delete
-        filename = input().strip()
-        
-        # Send the filename to the server for deletion
-        client_socket.sendall(filename.encode())
-        
-        # Receive server response
-        server_response = client_socket.recv(1024).decode()
+        filename = input("Enter the filename to delete: ").strip()
+        if client.delete(filename):
+            print(f"File '{filename}' deleted successfully.")
+            return True
+        print("Error: File not found on server.")
+        return False
         
-        if server_response == "FILE_NOT_FOUND":
-            print("Error: File not found on server.")
+    except dfos_client.ClientError as e:
+        print(f"Server response: {e}")
+        return False
+    except protocol.TransferAborted as e:
+        print(f"Server response: {e}")
+        return False
+    except ConnectionError:
+        raise
+    except Exception as e:
+        print(f"Error during file deletion: {e}")
+        return False
+
+LIST_PAGE_SIZE = 20
+
+# Turns "prefix=log glob=*.txt min=1024 max=1048576 days=7" into a list query for the server.
+def parse_list_filters(text):
+    query = {'limit': LIST_PAGE_SIZE}
+    for token in text.split():
+        key, _, value = token.partition('=')
+        try:
+            if key in ('prefix', 'glob'):
+                query[key] = value
+            elif key in ('min', 'max'):
+                query[f"{key}_size"] = int(value)
+            elif key == 'days':
+                query['since'] = time.time() - float(value) * 86400
+            else:
+                raise ValueError
+        except ValueError:
+            print(f"Ignoring filter '{token}'.")
+    return query
+
+# Lists the user's files one page at a time, optionally filtered by name prefix, glob pattern, size or age.
+def list_files(client):
+    try:
+        query = parse_list_filters(input("Filter (blank for all, e.g. 'prefix=log glob=*.txt min=1024 max=1048576 days=7'): "))
+        while True:
+            page = client.list(**query)
+
+            if not page['files'] and 'after' not in query:
+                print("No files found.")
+                return True
+            print(f"\n{'Size':>12}  {'Modified':<19}  Name")
+            for name, size, mtime, _ in page['files']:
+                print(f"{size:>12}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))}  {name}")
+            if not page['next']:
+                return True
+            if input("Press Enter for the next page or 'q' to stop: ").strip().lower() == 'q':
+                return True
+            query['after'] = page['next']
+
+    except dfos_client.ClientError as e:
+        print(f"Server response: {e}")
+        return False
+    except protocol.TransferAborted as e:
+        print(f"Server response: {e}")
+        return False
+    except ConnectionError:
+        raise
+    except Exception as e:
+        print(f"Error while listing files: {e}")
+        return False
+
+# Makes a server directory match a local one: shows the dry-run plan first, then applies it if confirmed.
+def sync_directory(client):
+    try:
+        local_dir = os.path.expanduser(input("Local directory to sync: ").strip())
+        if not os.path.isdir(local_dir):
+            print(f"Not a directory: {local_dir}")
             return False
-        elif server_response == "FILE_DELETED":
-            print(f"File '{filename}' deleted successfully.")
+        remote_dir = input("Server directory (blank for the top level): ").strip()
+        where = f"'{remote_dir}'" if remote_dir else "the top level (all your files)"
+        delete = input(f"Also delete files in {where} that are not in {local_dir}? (y/n): ").strip().lower() == 'y'
+
+        plan = client.sync(local_dir, remote_dir, delete=delete, dry_run=True)
+        print(f"\nDry run: {plan.summary()}")
+        if not plan.uploads and not plan.deletes:
+            print("Already in sync.")
+            return True
+        if input("Apply these changes? (y/n): ").strip().lower() != 'y':
+            print("Nothing changed.")
+            return False
+
+        started = time.monotonic()
+        plan = client.sync(local_dir, remote_dir, delete=delete)
+        for name, error in plan.failed.items():
+            print(f"Failed: {name}: {error}")
+        print(f"Synced {len(plan.uploads) - sum(name in plan.failed for _, name, _ in plan.uploads)} uploads and "
+              f"{len(plan.deletes) - sum(name in plan.failed for name in plan.deletes)} deletes "
+              f"in {time.monotonic() - started:.1f}s.")
+        return not plan.failed
+
+    except dfos_client.ClientError as e:
+        print(f"Server response: {e}")
+        return False
+    except protocol.TransferAborted as e:
+        print(f"Server response: {e}")
+        return False
+    except ConnectionError:
+        raise
+    except Exception as e:
+        print(f"Error while syncing: {e}")
+        return False
+
+#Lists the versions the server kept of a file, and restores or downloads one of them.
+def manage_versions(client):
+    try:
+        filename = input("Filename: ").strip()
+        versions = client.versions(filename)
+        if not versions:
+            print(f"No earlier versions of {filename}.")
             return True
+        print(f"\nEarlier versions of {filename} (newest first):")
+        for i, (version, size, _) in enumerate(versions, 1):
+            replaced = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version / 1e9))
+            print(f"{i}. replaced {replaced}, {size} bytes")
+        action = input("'r N' to restore version N, 'd N' to download it, Enter to go back: ").strip().split()
+        if not action:
+            return True
+        if len(action) != 2 or action[0] not in ('r', 'd') or not action[1].isdigit() \
+                or not 1 <= int(action[1]) <= len(versions):
+            print("Invalid choice.")
+            return False
+        version = versions[int(action[1]) - 1][0]
+        if action[0] == 'r':
+            if client.restore(filename, version):
+                print(f"Restored {filename}; the version it replaced was kept.")
+            else:
+                print(f"{filename} already has those contents.")
         else:
-            print(f"Server response: {server_response}")
+            dest = input("Save as: ").strip() or f"{filename.split('/')[-1]}.{action[1]}"
+            size = client.download(filename, dest, version=version)
+            print(f"Downloaded {size} bytes to {dest}.")
+        return True
+
+    except dfos_client.ClientError as e:
+        print(f"Server response: {e}")
+        return False
+    except protocol.TransferAborted as e:
+        print(f"Server response: {e}")
+        return False
+    except ConnectionError:
+        raise
+    except Exception as e:
+        print(f"Error while handling versions: {e}")
+        return False
+
+#Creates, lists, restores or deletes point-in-time snapshots of all the user's files.
+def manage_snapshots(client):
+    try:
+        action = input("Snapshot action (create/list/restore/delete): ").strip().lower()
+        if action == 'create':
+            name = client.snapshot(input("Snapshot name (blank for a timestamp): ").strip() or None)
+            print(f"Created snapshot {name}.")
+        elif action == 'list':
+            snapshots = client.snapshots()
+            if not snapshots:
+                print("No snapshots.")
+            for name, created, files, size in snapshots:
+                print(f"{name}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))}, "
+                      f"{files} files, {size} bytes")
+        elif action == 'restore':
+            name = input("Snapshot name: ").strip()
+            filename = input("File to restore (blank for every file in the snapshot): ").strip() or None
+            restored = client.restore_snapshot(name, filename)
+            print(f"Restored {restored} files from {name}.")
+        elif action == 'delete':
+            name = input("Snapshot name: ").strip()
+            print(f"Deleted snapshot {name}." if client.delete_snapshot(name) else f"No snapshot named {name}.")
+        else:
+            print("Invalid action.")
             return False
-        
+        return True
+
+    except dfos_client.ClientError as e:
+        print(f"Server response: {e}")
+        return False
+    except protocol.TransferAborted as e:
+        print(f"Server response: {e}")
+        return False
+    except ConnectionError:
+        raise
     except Exception as e:
-        print(f"Error during file deletion: {e}")
+        print(f"Error while handling snapshots: {e}")
         return False
 
-#Checks if the user enters a valid command (upload, download, delete, or exit) and retries if the input is invalid.
+#Checks if the user enters a valid command (upload, download, list, delete, sync, versions, snapshot or exit) and retries if the input is invalid.
 def get_valid_command():
     """Get and validate user command."""
     while True:
-        command = input("Enter command (upload/download/delete/exit): ").strip().lower()
-        if command in ['upload', 'download', 'delete', 'exit']:
+        command = input("Enter command (upload/download/list/delete/sync/versions/snapshot/exit): ").strip().lower()
+        if command in ['upload', 'download', 'list', 'delete', 'sync', 'versions', 'snapshot', 'exit']:
             return command
         elif command:
-            print(f"Invalid command: '{command}'. Please enter 'upload', 'download', 'delete' or 'exit'.")
+            print(f"Invalid command: '{command}'. Please enter 'upload', 'download', 'list', 'delete', 'sync', "
+                  f"'versions', 'snapshot' or 'exit'.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DFOS client")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--streams', type=int, default=1,
+                        help="parallel connections for transfers larger than one stripe")
+    parser.add_argument('--stripe-mb', type=int, default=8, help="stripe size in MiB")
+    parser.add_argument('--compress', choices=['auto', 'none'] + sorted(compress.CODECS), default='auto',
+                        help="compress transfers when the data compresses (auto: zstd or zlib)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="send only the chunks a deduplicating server does not already have")
+    parser.add_argument('--delta', action='store_true',
+                        help="re-upload changed files by sending only the blocks that differ")
+    parser.add_argument('--tls', action='store_true', help="connect over TLS")
+    parser.add_argument('--tls-ca', help="trust the certificates in this PEM file (implies --tls)")
+    parser.add_argument('--tls-insecure', action='store_true',
+                        help="skip checking the server's certificate (implies --tls; testing only)")
+    options = parser.parse_args()
+    options.stripe_size = options.stripe_mb * 1024 * 1024
+    if options.tls or options.tls_ca or options.tls_insecure:
+        # One for all logins, so retries resume the first TLS session
+        options.tls = tls.ClientTLS(tls.client_context(options.tls_ca, not options.tls_insecure))
+    else:
+        options.tls = None
+    return options
+
+# Asks for credentials until the server accepts them (three tries) and returns a connected client, or None.
+def login(options):
+    for attempt in range(1, 4):
+        username = input("Username: ")
+        password = input("Password: ")
+        client = dfos_client.Client(options.host, options.port, username, password, options.compress,
+                                    options.streams, options.stripe_size, options.dedup, options.delta,
+                                    notify=print, tls=options.tls)
+        try:
+            client.connect()
+        except dfos_client.ServerBusy as e:
+            print(e)
+            return None
+        except dfos_client.AuthenticationError as e:
+            print(e, '\n')
+            if str(e) != "Authentication failed.":
+                return None
+            if attempt != 3:
+                print("\nTry Again")
+            continue
+        print("Authentication successful.", '\n')
+        return client
+    return None
 
 #The entry point of the client program, manages server connection, user authentication (with retries), and continuously handles user commands until exit.
 def main():
+    options = parse_args()
     signal.signal(signal.SIGINT, handle_sigint)
     signal.signal(signal.SIGTSTP, handle_sigint)
-    count=1
-    response="Authentication failed."
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client = None
     try:
-        client_socket.connect(('127.0.0.1', 5000))
-        while(count<=3 and response=="Authentication failed."):            
-            
-            print(client_socket.recv(1024).decode(), end='')
-            client_socket.sendall(input().encode())
-            
-            print(client_socket.recv(1024).decode(), end='')
-            client_socket.sendall(input().encode())
-            
-            response = client_socket.recv(1024).decode()
-            print(response,'\n')
-            if response=="Authentication failed.":
-                #count = client_socket.recv(1).decode()
-                count+=1
-                if count!=4:
-                    print("\nTry Again")
-            
-        
-        if response == "Authentication successful.":
-            while True:
-                try:
-                    server_prompt = client_socket.recv(1024).decode()
-                    if not server_prompt:
-                        print("\nLost connection to server.")
-                        break
-                    
-                    command = get_valid_command()
-                    client_socket.sendall(command.encode())
-                    
-                    if command == 'upload':
-                        upload_success = upload_file(client_socket)
-                    elif command == 'download':
-                        download_success = download_file(client_socket)
-                    elif command == 'delete':
-                        delete_success = delete_file(client_socket)
-                    elif command == 'exit':
-                        print("Exiting...")
-                        break
-                    
-                except (BrokenPipeError, ConnectionResetError):
-                    print("\nLost connection to server.")
-                    break
-                except KeyboardInterrupt:
-                    print("\nClient shutting down...")
-                    try:
-                        client_socket.sendall(b'exit')
-                    except:
-                        pass
-                    break
-                except Exception as e:
-                    print(f"\nUnexpected error: {e}")
+        client = login(options)
+        if client is None:
+            return
+        while True:
+            try:
+                command = get_valid_command()
+                
+                if command == 'upload':
+                    upload_success = upload_file(client)
+                elif command == 'download':
+                    download_success = download_file(client)
+                elif command == 'list':
+                    list_success = list_files(client)
+                elif command == 'delete':
+                    delete_success = delete_file(client)
+                elif command == 'sync':
+                    sync_success = sync_directory(client)
+                elif command == 'versions':
+                    versions_success = manage_versions(client)
+                elif command == 'snapshot':
+                    snapshot_success = manage_snapshots(client)
+                elif command == 'exit':
+                    print("Exiting...")
                     break
-    
+                
+            except ConnectionError:
+                print("\nLost connection to server.")
+                break
+            except KeyboardInterrupt:
+                print("\nClient shutting down...")
+                break
+            except Exception as e:
+                print(f"\nUnexpected error: {e}")
+                break
+
     except ConnectionRefusedError:
         print("Could not connect to server. Is it running?")
     except Exception as e:
         print(f"Error: {e}")
-    #if count>3:
-     #   client_socket.close()
     finally:
-        try:
-            client_socket.close()
-        except:
-            pass
+        if client is not None:
+            client.close()
 
 if __name__ == "__main__":
     main()
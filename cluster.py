@@ -0,0 +1,450 @@
+import os
+import json
+import time
+import bisect
+import signal
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+import async_server
+import dfos_client
+import handoff
+import logpipe
+import protocol
+import server
+from credentials import issue_ticket
+
+# Cluster mode (`python3 server.py --cluster-nodes nodes.txt`).
+#
+# The process becomes a coordinator in front of several storage nodes, each
+# an ordinary server.py started with the same --cluster-secret and its own
+# --storage-root. A client connects to the coordinator, which does the
+# handshake and checks the password against id_passwd.txt, then logs in to the
+# node holding that user's files with a ticket (see credentials.py) and from
+# then on copies bytes both ways. The node's command prompt is the first thing
+# the client sees after "Authentication successful.", so clients cannot tell
+# a proxied session from a direct one.
+#
+# Users are the unit of placement: listings, quotas, stripes and deduplication
+# all need a user's files on one node. A user's node is picked on a consistent
+# hash ring (VIRTUAL_NODES points per node and unit of weight) and recorded in
+# the --cluster-state file. The nodes file is re-read when it changes; users
+# whose recorded node is no longer their owner on the ring are moved one at a
+# time by copying their files through the coordinator once they have no open
+# sessions. Logins for a user wait while that user is being moved. The
+# user's history moves too: the nodes' history command lists every version
+# (deleted files' included) and snapshot, and keep adds one to the target,
+# linking it from a copy with the same contents when the target has one so
+# that snapshots of unchanged files cost no transfer. Only once the target's
+# files and history match the source's is the placement switched and the
+# source cleared with purge, which deletes everything of the user without
+# keeping versions. history, keep and purge only accept a coordinator ticket.
+#
+# With --tls-cert the coordinator terminates TLS for clients; its connections
+# to the nodes stay plaintext, so nodes belong on a private network and are
+# started without --tls-cert.
+#
+# SIGTERM stops the coordinator accepting and waits up to --drain-timeout for
+# the open sessions to end before closing the rest. It only relays bytes and
+# cannot see a session reach its command prompt, so unlike a node it cannot
+# end idle sessions early: a client that stays connected is closed at the
+# deadline. Transfers in flight finish if they can within it. SIGHUP (hot
+# restart) is not supported.
+
+VIRTUAL_NODES = 64
+# Seconds between checks of the nodes file and of users left to move
+REBALANCE_INTERVAL = 2.0
+# Seconds before retrying a user whose move failed
+REBALANCE_RETRY = 60.0
+PROXY_BUFFER = 1024 * 1024
+NODE_CONNECT_TIMEOUT = 5.0
+
+UNAVAILABLE = "Storage node unavailable, try again later."
+LEGACY_REFUSED = "This server is a cluster coordinator; please use a framed-protocol client."
+
+
+def parse_node(text):
+    """'host:port' -> (host, port)."""
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def load_nodes(filename):
+    """{'host:port': weight} from lines like "10.0.0.5:5000 weight=2"; '#' starts a comment."""
+    nodes = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            parse_node(fields[0])
+            weight = 1
+            for option in fields[1:]:
+                key, _, value = option.partition('=')
+                if key == 'weight':
+                    weight = max(int(value), 1)
+            nodes[fields[0]] = weight
+    return nodes
+
+
+def _point(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring: adding a node only moves the keys it takes over."""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = dict(nodes)
+        points = sorted((_point(f"{node}#{i}"), node) for node, weight in self.nodes.items()
+                        for i in range(virtual_nodes * weight))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._points:
+            raise LookupError("No storage nodes configured.")
+        return self._owners[bisect.bisect(self._points, _point(key)) % len(self._points)]
+
+
+class Placement:
+    """Which node holds each user's files, saved to a JSON file on every change."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.nodes = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as file:
+                self.nodes = json.load(file)
+
+    def get(self, user):
+        return self.nodes.get(user)
+
+    def set(self, user, node):
+        self.nodes[user] = node
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as file:
+            json.dump(self.nodes, file, indent=1, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.filename)
+
+    def items(self):
+        return list(self.nodes.items())
+
+
+async def _pipe(reader, writer):
+    """Copy reader to writer until EOF; returns the bytes copied."""
+    total = 0
+    try:
+        while data := await reader.read(PROXY_BUFFER):
+            writer.write(data)
+            await writer.drain()
+            total += len(data)
+    except ConnectionError:
+        pass
+    return total
+
+
+def history_entries(history):
+    """The keep requests (see storage.parse_keep_header()) that rebuild a node's history listing."""
+    for name, version, size, digest in history['versions']:
+        yield {'name': name, 'version': version, 'size': size, 'sha256': digest}
+    for snapshot, created, rows in history['snapshots']:
+        if not rows:
+            yield {'snapshot': snapshot, 'created': created, 'name': None}
+        for name, size, mtime, digest in rows:
+            yield {'snapshot': snapshot, 'created': created, 'name': name, 'size': size, 'mtime': mtime,
+                   'sha256': digest}
+
+
+def kept_source(entry):
+    """Client.download() arguments that fetch a history entry's bytes."""
+    if 'version' in entry:
+        return {'version': entry['version']}
+    return {'snapshot': entry['snapshot']}
+
+
+class Coordinator:
+    def __init__(self, nodes_file, placement, secret, executor):
+        self.nodes_file = nodes_file
+        self.placement = placement
+        self.secret = secret
+        # Runs the blocking copies of a rebalance
+        self.executor = executor
+        self.ring = HashRing({})
+        self._signature = None
+        # user -> proxied sessions open; only touched on the event loop
+        self.sessions = defaultdict(int)
+        # Writers of all client connections, for draining
+        self.clients = set()
+        # user -> Event set once the user's move has finished
+        self.moving = {}
+        self.retry_at = {}
+
+    def reload_nodes(self):
+        """Rebuild the ring if the nodes file changed; True if it did."""
+        st = os.stat(self.nodes_file)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self._signature:
+            return False
+        self.ring = HashRing(load_nodes(self.nodes_file))
+        self._signature = signature
+        self.retry_at.clear()
+        logpipe.event("Storage nodes: %(nodes)s", op='rebalance', nodes=sorted(self.ring.nodes))
+        return True
+
+    def node_for(self, user):
+        node = self.placement.get(user)
+        if node is None:
+            node = self.ring.owner(user)
+            self.placement.set(user, node)
+        return node
+
+    def ticket(self, user):
+        return issue_ticket(self.secret, user)
+
+    # Sessions
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        server.performance_tracker.increment_connections()
+        logpipe.event("New connection from %(client)s (%(active)s active)", op='connect', client=client_address,
+                      active=server.performance_tracker.active_connections)
+        user = None
+        self.clients.add(writer)
+        try:
+            sock = writer.get_extra_info('socket')
+            if sock is not None and server.KEEPALIVE_IDLE:
+                protocol.enable_keepalive(sock, server.KEEPALIVE_IDLE)
+            conn = await protocol.async_server_handshake(reader, writer, async_server.io_executor)
+            server.log_handshake(conn, client_address)
+            conn.set_timeout(server.OP_TIMEOUT)
+            if not conn.framed:
+                await conn.send_msg(LEGACY_REFUSED)
+                return
+            user = await async_server.authenticate(conn, client_address)
+            if not user:
+                return
+            while user in self.moving:
+                await self.moving[user].wait()
+            self.sessions[user] += 1
+            try:
+                await self.proxy(conn, user, client_address)
+            finally:
+                self.sessions[user] -= 1
+        except protocol.SessionTimeout:
+            server.log_reaped(user, client_address, 'login')
+        except Exception as e:
+            logpipe.event("Error with client %(client)s: %(error)s", logging.ERROR, user=user, op='session',
+                          client=client_address, error=str(e), outcome='error')
+        finally:
+            self.clients.discard(writer)
+            server.performance_tracker.decrement_connections()
+            logpipe.event("Connection from %(client)s closed.", user=user, op='disconnect', client=client_address)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def proxy(self, conn, user, client_address):
+        try:
+            node = self.node_for(user)
+            node_reader, node_writer = await self.open_node(node, user, conn)
+        except (LookupError, OSError, asyncio.TimeoutError, protocol.ProtocolError) as e:
+            logpipe.event("No storage node for %(user)s: %(error)s", logging.ERROR, user=user, op='proxy',
+                          client=client_address, error=str(e), outcome='unavailable')
+            await conn.send_msg(UNAVAILABLE)
+            return
+
+        started = time.monotonic()
+        upstream = asyncio.ensure_future(_pipe(conn.reader, node_writer))
+        downstream = asyncio.ensure_future(_pipe(node_reader, conn.writer))
+        try:
+            # Whichever side hangs up ends the session for both
+            await asyncio.wait((upstream, downstream), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            node_writer.close()
+            conn.writer.close()
+            sent, received = await asyncio.gather(upstream, downstream)
+        duration = time.monotonic() - started
+        server.performance_tracker.log_operation('proxy', duration, sent + received)
+        logpipe.event("Proxied session of %(user)s on %(node)s ended", user=user, op='proxy', node=node,
+                      client=client_address, bytes_in=sent, bytes_out=received, duration=duration, outcome='ok')
+
+    async def open_node(self, node, user, conn):
+        """Connect to node and log in as user; returns the node's (reader, writer) at its command prompt."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*parse_node(node), limit=PROXY_BUFFER),
+                                                NODE_CONNECT_TIMEOUT)
+        try:
+            # Offer exactly what the client got, so frames pass through unchanged
+            node_conn = await protocol.async_client_handshake(
+                reader, writer, conn.chunk_size, conn.codecs,
+                features=[protocol.FEATURE_DIGEST] if conn.digests else [])
+            reply = await node_conn.recv_msg()
+            while reply.startswith(dfos_client.BUSY):
+                if reply == admission.BUSY_REJECTED:
+                    raise ConnectionError(reply)
+                reply = await node_conn.recv_msg()
+            await node_conn.send_msg(user)
+            await node_conn.recv_msg()
+            await node_conn.send_msg(self.ticket(user))
+            reply = await node_conn.recv_msg()
+            if reply != "Authentication successful.":
+                raise ConnectionError(f"Node refused the login: {reply}")
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    # Rebalancing
+
+    async def rebalance_forever(self):
+        while True:
+            try:
+                self.reload_nodes()
+                await self.rebalance()
+            except Exception as e:
+                logpipe.event("Rebalance failed: %(error)s", logging.ERROR, op='rebalance', error=str(e),
+                              outcome='error')
+            await asyncio.sleep(REBALANCE_INTERVAL)
+
+    async def rebalance(self):
+        loop = asyncio.get_running_loop()
+        for user, node in self.placement.items():
+            target = self.ring.owner(user)
+            if node == target or self.sessions[user] or self.retry_at.get(user, 0) > time.monotonic():
+                continue
+            # No await between the session check and this, so no login slips in
+            done = self.moving[user] = asyncio.Event()
+            started = time.monotonic()
+            try:
+                files, size = await loop.run_in_executor(self.executor, self.copy_user, user, node, target)
+                self.placement.set(user, target)
+                self.retry_at.pop(user, None)
+                duration = time.monotonic() - started
+                server.performance_tracker.log_operation('rebalance', duration, size)
+                logpipe.event("Moved %(files)s files of %(user)s from %(source)s to %(target)s", user=user,
+                              op='rebalance', source=node, target=target, files=files, bytes=size,
+                              duration=duration, outcome='ok')
+            except Exception as e:
+                self.retry_at[user] = time.monotonic() + REBALANCE_RETRY
+                logpipe.event("Could not move %(user)s from %(source)s to %(target)s: %(error)s", logging.ERROR,
+                              user=user, op='rebalance', source=node, target=target, error=str(e),
+                              outcome='error')
+                continue
+            finally:
+                del self.moving[user]
+                done.set()
+            try:
+                await loop.run_in_executor(self.executor, self.purge_user, user, node)
+            except Exception as e:
+                logpipe.event("Could not remove moved files of %(user)s from %(source)s: %(error)s",
+                              logging.WARNING, user=user, op='rebalance', source=node, error=str(e),
+                              outcome='error')
+
+    def _client(self, node, user):
+        host, port = parse_node(node)
+        return dfos_client.Client(host, port, user, self.ticket(user), timeout=server.OP_TIMEOUT)
+
+    def copy_user(self, user, source, target):
+        """Make user's files, versions and snapshots on target the same as on source; returns (files, bytes) copied.
+
+        Raises RuntimeError unless target ends up with all of them, so that
+        the source is neither switched away from nor purged.
+        """
+        files = size = 0
+        with self._client(source, user) as src, self._client(target, user) as dst, \
+                tempfile.TemporaryDirectory(prefix='dfos-move-') as spool:
+            wanted = {row[0]: row for row in src.iter_files()}
+            # Anything left over from an earlier stay on target, or an earlier attempt
+            dst.purge(self.ticket(user))
+            path = os.path.join(spool, 'file')
+            for name, row in wanted.items():
+                src.download(name, path)
+                dst.upload(path, name)
+                os.remove(path)
+                files += 1
+                size += row[1]
+            history = src.history(self.ticket(user))
+            for entry in history_entries(history):
+                # Sent only when target has no copy with these contents to link
+                if not dst.keep(self.ticket(user), entry):
+                    src.download(entry['name'], path, **kept_source(entry))
+                    dst.keep(self.ticket(user), entry, path)
+                    os.remove(path)
+                    size += entry['size']
+            copied = {row[0]: row for row in dst.iter_files()}
+            for name, row in wanted.items():
+                if name not in copied or copied[name][1] != row[1] or row[3] not in (None, copied[name][3]):
+                    raise RuntimeError(f"{name} did not arrive intact on {target}")
+            if dst.history(self.ticket(user)) != history:
+                raise RuntimeError(f"Versions and snapshots did not arrive intact on {target}")
+        return files, size
+
+    def purge_user(self, user, node):
+        """Remove user's files, versions and snapshots from node once they are all on their new one."""
+        with self._client(node, user) as client:
+            client.purge(self.ticket(user))
+
+    async def serve(self, server_socket, signals):
+        listener = await asyncio.start_server(self.handle_client, sock=server_socket, limit=PROXY_BUFFER,
+                                              **async_server.tls_options())
+        rebalancer = asyncio.ensure_future(self.rebalance_forever())
+        loop = asyncio.get_running_loop()
+        signalled = asyncio.Event()
+        loop.add_reader(signals.fileno(), signalled.set)
+        try:
+            await signalled.wait()
+            signals.take()
+        finally:
+            loop.remove_reader(signals.fileno())
+            rebalancer.cancel()
+            listener.close()
+        logpipe.event("Stopping: no new connections, draining %(sessions)s sessions", op='shutdown',
+                      sessions=len(self.clients))
+        await self.drain()
+
+    async def drain(self):
+        """Wait up to --drain-timeout for the client connections to close, then close the rest."""
+        deadline = time.monotonic() + server.DRAIN_TIMEOUT
+        while self.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.clients:
+            logpipe.event("Drain deadline passed; closing %(sessions)s sessions", logging.WARNING, op='shutdown',
+                          sessions=len(self.clients), outcome='timeout')
+            for writer in list(self.clients):
+                writer.transport.abort()
+            # Give the closed sessions a moment to unwind and log
+            for _ in range(10):
+                if not self.clients:
+                    break
+                await asyncio.sleep(0.1)
+
+
+def main(args):
+    if not args.cluster_secret:
+        raise SystemExit("Cluster mode needs --cluster-secret (or DFOS_CLUSTER_SECRET), shared with the nodes.")
+    server.configure_sessions(args)
+    logging.info("Coordinator started. Initializing performance tracking.")
+    signal.signal(signal.SIGINT, server.signal_handler)
+    signals = handoff.ShutdownSignals(signals=(signal.SIGTERM,))
+
+    async_server.io_executor = ThreadPoolExecutor(max_workers=args.io_workers, thread_name_prefix='dfos-io')
+    coordinator = Coordinator(args.cluster_nodes, Placement(args.cluster_state), args.cluster_secret,
+                              ThreadPoolExecutor(max_workers=1, thread_name_prefix='dfos-rebalance'))
+    coordinator.reload_nodes()
+    server_socket = server.create_listener(args.host, args.port, args.backlog)
+    server.start_monitoring(args)
+    print(f"Coordinator is listening on port {args.port} for {len(coordinator.ring.nodes)} storage nodes...")
+    try:
+        asyncio.run(coordinator.serve(server_socket, signals))
+    finally:
+        async_server.io_executor.shutdown(wait=False)
+    server.finish_shutdown()
@@ -0,0 +1,264 @@
+import io
+import os
+import zlib
+import struct
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    from compression import zstd as _zstd      # Python 3.14+
+    _zstandard = None
+except ImportError:
+    _zstd = None
+    try:
+        import zstandard as _zstandard
+    except ImportError:
+        _zstandard = None
+
+# Compression for framed transfers and, optionally, for files at rest.
+#
+# On the wire, the codecs both ends support are agreed in the hello. A sender
+# then decides per transfer: it compresses the first block as a sample and
+# only announces a codec (a CODEC frame before the DATA frames) when that
+# saves at least COMPRESSIBLE_RATIO, so already-compressed media goes out
+# raw. At rest, files are stored in a block container (see
+# write_compressed()) so ranges and previews can be read without inflating
+# the whole file.
+
+ZLIB_LEVEL = 3
+LZMA_PRESET = 1
+ZSTD_LEVEL = 3
+COMPRESSIBLE_RATIO = 0.9
+SAMPLE_SIZE = 64 * 1024
+# Upper bound on the output of one decompress call, against decompression bombs
+MAX_INFLATE = 1024 * 1024
+
+
+def _zstd_compressor():
+    if _zstd:
+        return _zstd.ZstdCompressor(level=ZSTD_LEVEL)
+    return _zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def _zstd_decompressor():
+    if _zstd:
+        return _zstd.ZstdDecompressor()
+    return _zstandard.ZstdDecompressor().decompressobj()
+
+
+def _zstd_block(data):
+    if _zstd:
+        return _zstd.compress(data, level=ZSTD_LEVEL)
+    return _zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _zstd_unblock(data):
+    if _zstd:
+        return _zstd.decompress(data)
+    return _zstandard.ZstdDecompressor().decompress(data)
+
+
+# name -> (stream compressor factory, stream decompressor factory, block compress, block decompress)
+CODECS = {
+    'zlib': (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj,
+             lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompress),
+}
+if lzma:
+    CODECS['lzma'] = (lambda: lzma.LZMACompressor(preset=LZMA_PRESET), lzma.LZMADecompressor,
+                      lambda data: lzma.compress(data, preset=LZMA_PRESET), lzma.decompress)
+if _zstd or _zstandard:
+    CODECS['zstd'] = (_zstd_compressor, _zstd_decompressor, _zstd_block, _zstd_unblock)
+
+# What a client offers when asked for 'auto': fast codecs only, best first.
+# lzma compresses harder but at a few MB/s, so it has to be asked for by name.
+AUTO_CODECS = [name for name in ('zstd', 'zlib') if name in CODECS]
+
+
+def offer(choice):
+    """Codec list a client puts in its hello for --compress choice."""
+    if choice == 'none':
+        return []
+    if choice == 'auto':
+        return list(AUTO_CODECS)
+    if choice not in CODECS:
+        raise ValueError(f"Compression codec '{choice}' is not available here.")
+    return [choice]
+
+
+def negotiate(offered):
+    """The offered codecs this side supports, in the client's order of preference."""
+    return [name for name in offered if name in CODECS]
+
+
+def compressor(name):
+    return CODECS[name][0]()
+
+
+def worth_compressing(name, sample):
+    if not sample:
+        return False
+    return len(CODECS[name][2](sample)) <= len(sample) * COMPRESSIBLE_RATIO
+
+
+class StreamDecoder:
+    """Incremental decompressor whose output comes back in bounded pieces."""
+
+    def __init__(self, name):
+        if name not in CODECS:
+            raise ValueError(f"Unknown compression codec '{name}'")
+        self.name = name
+        self.decompressor = CODECS[name][1]()
+
+    def decode(self, data):
+        """Yield the decompressed pieces (each at most MAX_INFLATE bytes) for data."""
+        decompressor = self.decompressor
+        if hasattr(decompressor, 'unconsumed_tail'):               # zlib
+            while data:
+                out = decompressor.decompress(data, MAX_INFLATE)
+                data = decompressor.unconsumed_tail
+                if out:
+                    yield out
+        elif hasattr(decompressor, 'needs_input'):                 # lzma, compression.zstd
+            out = decompressor.decompress(data, MAX_INFLATE)
+            while True:
+                if out:
+                    yield out
+                if decompressor.needs_input or decompressor.eof:
+                    break
+                out = decompressor.decompress(b'', MAX_INFLATE)
+        else:                                                       # zstandard
+            out = decompressor.decompress(bytes(data))
+            if out:
+                yield out
+
+    def finish(self):
+        if hasattr(self.decompressor, 'flush'):
+            out = self.decompressor.flush()
+            if out:
+                yield out
+
+
+# At-rest container:
+#
+#   MAGIC, codec name (8 bytes, NUL padded), block size, raw size
+#   blocks, each compressed on its own (or kept raw when that is smaller)
+#   index: (offset, stored length, raw flag) per block
+#   index offset, MAGIC
+#
+# Independent blocks let CompressedReader serve any range by inflating only
+# the blocks it covers.
+
+MAGIC = b"\x89DFOSZ\r\n"
+AT_REST_BLOCK_SIZE = 256 * 1024
+_HEADER = struct.Struct('!8s8sIQ')
+_INDEX_ENTRY = struct.Struct('!QI?')
+_TRAILER = struct.Struct('!Q8s')
+
+
+def write_compressed(source, target, name, block_size=AT_REST_BLOCK_SIZE):
+    """Store source at target in the block container if that saves space.
+
+    Returns False, leaving target alone, when the first block does not
+    compress well enough.
+    """
+    compress_block = CODECS[name][2]
+    raw_size = os.path.getsize(source)
+    with open(source, 'rb') as src:
+        if not worth_compressing(name, src.read(SAMPLE_SIZE)):
+            return False
+        src.seek(0)
+        with open(target, 'wb') as dst:
+            dst.write(_HEADER.pack(MAGIC, name.encode(), block_size, raw_size))
+            index = []
+            while block := src.read(block_size):
+                packed = compress_block(block)
+                raw = len(packed) >= len(block)
+                stored = block if raw else packed
+                index.append((dst.tell(), len(stored), raw))
+                dst.write(stored)
+            index_offset = dst.tell()
+            dst.write(b''.join(_INDEX_ENTRY.pack(*entry) for entry in index))
+            dst.write(_TRAILER.pack(index_offset, MAGIC))
+    return True
+
+
+def open_at_rest(path):
+    """Open a stored file: a CompressedReader for container files, the plain file otherwise."""
+    file = open(path, 'rb')
+    try:
+        if file.read(len(MAGIC)) == MAGIC:
+            return CompressedReader(file)
+    except (ValueError, OSError, struct.error):
+        pass
+    except Exception:
+        file.close()
+        raise
+    file.seek(0)
+    return file
+
+
+class CompressedReader(io.RawIOBase):
+    """Seekable read-only view of a container file, inflated a block at a time."""
+
+    def __init__(self, file):
+        self.file = file
+        file.seek(0)
+        magic, name, self.block_size, self.size = _HEADER.unpack(file.read(_HEADER.size))
+        name = name.rstrip(b'\0').decode()
+        file.seek(-_TRAILER.size, io.SEEK_END)
+        index_offset, tail = _TRAILER.unpack(file.read(_TRAILER.size))
+        if magic != MAGIC or tail != MAGIC or name not in CODECS or not self.block_size:
+            raise ValueError("Not a compressed container")
+        self.decompress_block = CODECS[name][3]
+        file.seek(index_offset)
+        count = -(-self.size // self.block_size) if self.size else 0
+        self.index = list(_INDEX_ENTRY.iter_unpack(file.read(count * _INDEX_ENTRY.size)))
+        if len(self.index) != count:
+            raise ValueError("Truncated compressed container")
+        self.position = 0
+        self._cached = (None, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def _block(self, number):
+        if self._cached[0] != number:
+            offset, length, raw = self.index[number]
+            self.file.seek(offset)
+            data = self.file.read(length)
+            self._cached = (number, data if raw else self.decompress_block(data))
+        return self._cached[1]
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.size:
+            number = self.position // self.block_size
+            block = self._block(number)
+            start = self.position - number * self.block_size
+            count = min(len(block) - start, len(view) - written)
+            view[written:written + count] = block[start:start + count]
+            written += count
+            self.position += count
+        return written
+
+    def close(self):
+        self.file.close()
+        super().close()
@@ -0,0 +1,184 @@
+import os
+import re
+import time
+import hmac
+import hashlib
+import threading
+from collections import defaultdict, deque
+
+# In-memory credential store and login throttling for server.py.
+#
+# id_passwd.txt is parsed once and kept as salted PBKDF2 digests. The file is
+# re-read only when its inode, mtime or size changes, checked at most once per
+# poll interval. Lines may hold a plain password ("user:secret") or an already
+# hashed entry produced by hash_password() ("user:pbkdf2_sha256$..."), followed
+# by optional per-user settings separated by spaces, e.g.
+# "user:secret rate=10M weight=2" (see bandwidth.py).
+#
+# In cluster mode (see cluster.py) the coordinator checks passwords and logs
+# in to the storage nodes with short-lived tickets instead: an expiry time and
+# an HMAC of the username, keyed with the secret the cluster shares.
+
+HASH_SCHEME = 'pbkdf2_sha256'
+HASH_ITERATIONS = 20000
+SALT_SIZE = 16
+OPTION = re.compile(r'^([a-z_]+)=(\S*)$')
+TICKET_PREFIX = 'dfos-ticket:'
+TICKET_TTL = 600
+
+
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    salt = salt or os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def _ticket_digest(secret, username, expires):
+    return hmac.new(secret.encode(), f"{username}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def issue_ticket(secret, username, ttl=TICKET_TTL):
+    """A password that logs username in to any node sharing secret for the next ttl seconds."""
+    expires = int(time.time() + ttl)
+    return f"{TICKET_PREFIX}{expires}:{_ticket_digest(secret, username, expires)}"
+
+
+def verify_ticket(secret, username, ticket):
+    try:
+        expires, digest = ticket.removeprefix(TICKET_PREFIX).split(':')
+        expires = int(expires)
+    except ValueError:
+        return False
+    return expires >= time.time() and hmac.compare_digest(digest, _ticket_digest(secret, username, expires))
+
+
+def _split_options(rest):
+    """'secret rate=10M weight=2' -> ('secret', {'rate': '10M', 'weight': '2'})."""
+    tokens = rest.split(' ')
+    options = {}
+    while len(tokens) > 1 and OPTION.match(tokens[-1]):
+        key, value = OPTION.match(tokens.pop()).groups()
+        options[key] = value
+    return ' '.join(tokens).rstrip(), options
+
+
+def _parse_entry(secret):
+    if secret.startswith(HASH_SCHEME + '$'):
+        _, iterations, salt, digest = secret.split('$')
+        return bytes.fromhex(salt), int(iterations), bytes.fromhex(digest)
+    salt = os.urandom(SALT_SIZE)
+    return salt, HASH_ITERATIONS, hashlib.pbkdf2_hmac('sha256', secret.encode(), salt, HASH_ITERATIONS)
+
+
+class CredentialStore:
+    def __init__(self, filename='id_passwd.txt', poll_interval=1.0):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self._entries = {}
+        self._options = {}
+        self._signature = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        # Verified against for unknown users so they take as long as known ones
+        self._dummy = _parse_entry('')
+
+    def _file_signature(self):
+        st = os.stat(self.filename)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            try:
+                signature = self._file_signature()
+                if signature != self._signature:
+                    entries = {}
+                    options = {}
+                    with open(self.filename, 'r') as file:
+                        for line in file:
+                            line = line.strip()
+                            if line and ':' in line:
+                                user, rest = line.split(':', 1)
+                                secret, options[user] = _split_options(rest)
+                                entries[user] = _parse_entry(secret)
+                    self._entries = entries
+                    self._options = options
+                    self._signature = signature
+            except OSError:
+                # Briefly missing while an editor replaces it: keep what is loaded
+                pass
+            # Only now, so concurrent callers wait on the lock instead of
+            # verifying against entries that are not loaded yet
+            self._next_check = now + self.poll_interval
+
+    def verify(self, username, password):
+        self._reload_if_changed()
+        salt, iterations, expected = self._entries.get(username, self._dummy)
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return hmac.compare_digest(digest, expected) and username in self._entries
+
+    def options(self, username):
+        """The settings after the user's password, e.g. {'rate': '10M'}; reloaded with the file."""
+        self._reload_if_changed()
+        return self._options.get(username, {})
+
+
+class LoginThrottle:
+    """Counts recent failures per client IP and per username.
+
+    Once a username reaches max_user_failures, or an IP reaches
+    max_ip_failures, within window seconds, further attempts are refused until
+    the oldest failure ages out. Callers get the remaining time back instead
+    of being put to sleep. Keys whose failures have all aged out are swept
+    once per window, so random usernames or addresses cannot grow the table
+    past what one window of failures holds.
+    """
+
+    def __init__(self, max_user_failures=5, max_ip_failures=20, window=60.0):
+        self.max_user_failures = max_user_failures
+        self.max_ip_failures = max_ip_failures
+        self.window = window
+        self._failures = defaultdict(deque)
+        self._next_sweep = time.monotonic() + window
+        self._lock = threading.Lock()
+
+    def _limits(self, ip, username):
+        return ((f"ip:{ip}", self.max_ip_failures), (f"user:{username}", self.max_user_failures))
+
+    def _prune(self, key, now):
+        failures = self._failures.get(key)
+        while failures and now - failures[0] > self.window:
+            failures.popleft()
+        if not failures:
+            self._failures.pop(key, None)
+            return None
+        return failures
+
+    def retry_after(self, ip, username):
+        """Seconds until another attempt is allowed, or 0 if allowed now."""
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            for key, limit in self._limits(ip, username):
+                failures = self._prune(key, now)
+                if failures and len(failures) >= limit:
+                    wait = max(wait, failures[0] + self.window - now)
+        return wait
+
+    def record_failure(self, ip, username):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                for key in list(self._failures):
+                    self._prune(key, now)
+                self._next_sweep = now + self.window
+            for key, _ in self._limits(ip, username):
+                self._failures[key].append(now)
+
+    def record_success(self, ip, username):
+        with self._lock:
+            self._failures.pop(f"user:{username}", None)
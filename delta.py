@@ -0,0 +1,203 @@
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+
+# rsync-style delta encoding used by the delta_upload command.
+#
+# The server splits its copy of a file into fixed-size blocks and sends one
+# signature per block: a weak rolling checksum (Adler-32) and a truncated
+# BLAKE2b strong hash. The client slides a window over its new version; where
+# the weak checksum and then the strong hash match a block it emits a COPY
+# reference, everything else goes out as LITERAL bytes. The server rebuilds
+# the new file from its old copy plus the delta and checks the whole-file
+# SHA-256 the client declared before committing it.
+
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 64 * 1024
+STRONG_SIZE = 16
+MAX_LITERAL = 64 * 1024
+BATCH_SIZE = 64 * 1024
+
+SIGNATURE = struct.Struct(f'!I{STRONG_SIZE}s')
+COPY = struct.Struct('!cQQ')       # b'C', offset in the old file, length
+LITERAL = struct.Struct('!cI')     # b'L', length, followed by the bytes
+_ADLER_MOD = 65521
+
+
+def choose_block_size(size):
+    """Roughly sqrt(size), as rsync does, rounded to a power of two and clamped."""
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def file_signatures(fileobj, block_size):
+    """Signature table for a file, as bytes ready to send."""
+    out = bytearray()
+    while block := fileobj.read(block_size):
+        out += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(out)
+
+
+def parse_signatures(data):
+    """Map weak checksum -> [(block index, strong hash)]."""
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+
+def compute_delta(path, block_size, table):
+    """Yield encoded delta batches (about BATCH_SIZE bytes each) for the file at path."""
+    batch = bytearray()
+    copy_offset = copy_length = 0
+
+    def flush_copy():
+        nonlocal copy_length
+        if copy_length:
+            batch.extend(COPY.pack(b'C', copy_offset, copy_length))
+            copy_length = 0
+
+    def add_literal(data):
+        flush_copy()
+        for start in range(0, len(data), MAX_LITERAL):
+            piece = data[start:start + MAX_LITERAL]
+            batch.extend(LITERAL.pack(b'L', len(piece)))
+            batch.extend(piece)
+
+    def add_copy(offset, length):
+        nonlocal copy_offset, copy_length
+        if copy_length and copy_offset + copy_length == offset:
+            copy_length += length
+        else:
+            flush_copy()
+            copy_offset, copy_length = offset, length
+
+    size = os.path.getsize(path)
+    if not size:
+        return
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = literal_start = 0
+        weak = zlib.adler32(data[0:block_size]) if size >= block_size else None
+        while position + block_size <= size:
+            candidates = table.get(weak)
+            if candidates:
+                strong = strong_hash(data[position:position + block_size])
+                match = next((index for index, digest in candidates if digest == strong), None)
+                if match is not None:
+                    if literal_start < position:
+                        add_literal(data[literal_start:position])
+                    add_copy(match * block_size, block_size)
+                    position += block_size
+                    literal_start = position
+                    if position + block_size <= size:
+                        weak = zlib.adler32(data[position:position + block_size])
+                    if len(batch) >= BATCH_SIZE:
+                        yield bytes(batch)
+                        batch.clear()
+                    continue
+            if position + block_size < size:
+                # Roll the Adler-32 window one byte forward
+                out_byte = data[position]
+                a = ((weak & 0xffff) - out_byte + data[position + block_size]) % _ADLER_MOD
+                weak = ((((weak >> 16) - block_size * out_byte + a - 1) % _ADLER_MOD) << 16) | a
+            position += 1
+            if position - literal_start >= MAX_LITERAL:
+                add_literal(data[literal_start:position])
+                literal_start = position
+                if len(batch) >= BATCH_SIZE:
+                    yield bytes(batch)
+                    batch.clear()
+        if literal_start < size:
+            add_literal(data[literal_start:size])
+    flush_copy()
+    if batch:
+        yield bytes(batch)
+
+
+class DeltaReader:
+    """Wrap compute_delta() batches in a read() interface for send_stream()."""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            batch = next(self.batches, None)
+            if batch is None:
+                break
+            self.buffer += batch
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class DeltaApplier:
+    """File-like sink that decodes a delta stream and writes the rebuilt file.
+
+    COPY ranges are read from the seekable base file, LITERAL bytes are written as they are,
+    and the output is hashed on the way so it can be checked without a
+    second read.
+    """
+
+    def __init__(self, base, output):
+        self.base = base
+        self.output = output
+        self.pending = bytearray()
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def _emit(self, data):
+        self.output.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def write(self, data):
+        self.pending += data
+        view = memoryview(self.pending)
+        consumed = 0
+        while len(view) - consumed >= LITERAL.size:
+            op = bytes(view[consumed:consumed + 1])
+            if op == b'C':
+                if len(view) - consumed < COPY.size:
+                    break
+                _, offset, length = COPY.unpack_from(view, consumed)
+                consumed += COPY.size
+                self.base.seek(offset)
+                while length:
+                    block = self.base.read(min(length, MAX_BLOCK_SIZE))
+                    if not block:
+                        raise OSError("Delta references data beyond the end of the base file.")
+                    self._emit(block)
+                    length -= len(block)
+            elif op == b'L':
+                _, length = LITERAL.unpack_from(view, consumed)
+                if len(view) - consumed < LITERAL.size + length:
+                    break
+                start = consumed + LITERAL.size
+                self._emit(view[start:start + length])
+                consumed = start + length
+            else:
+                raise OSError(f"Unknown delta operation {op!r}")
+        view.release()
+        del self.pending[:consumed]
+        return len(data)
+
+    def verify(self, total, sha256_hex):
+        return not self.pending and self.size == total and self.digest.hexdigest() == sha256_hex
@@ -0,0 +1,928 @@
+import io
+import os
+import json
+import hashlib
+import queue
+import select
+import socket
+import ssl
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+import delta
+import dirsync
+import chunkstore
+import compress
+from tls import peer_open
+
+# Programmatic client for the DFOS server; client.py is a terminal front end
+# over it and async_dfos_client.py is the asyncio version.
+#
+#   with Client('127.0.0.1', 5000, 'user1', 'password123') as dfos:
+#       dfos.upload('report.pdf')
+#       dfos.download('report.pdf', 'copy.pdf')
+#       heads = dfos.preview_many(['a.txt', 'b.txt', 'c.txt'])
+#       print(dfos.sync('project', 'backup/project').summary())
+#       dfos.restore('report.pdf', dfos.versions('report.pdf')[1][0])
+#
+# A Client keeps a pool of authenticated connections (Sessions) and borrows
+# one per call, so it can be shared between threads. Striped transfers and
+# upload_many()/download_many() borrow several at once. Batch calls whose
+# requests need no reply half-way (previews, deletes) are pipelined: up to
+# PIPELINE_DEPTH requests are written ahead of their replies, so a batch
+# costs about one round trip rather than one per file.
+
+PIPELINE_DEPTH = 32
+DEFAULT_POOL_SIZE = 4
+PROMPT = "Enter command"
+UPLOAD_DONE = "File upload completed successfully."
+PREVIEW_SIZE = 1024
+# Sent before the login prompt while the server has no free session slot
+BUSY = "Server busy"
+
+
+class ClientError(Exception):
+    """The server turned a request down; the message is its reply. The session stays usable."""
+
+
+class AuthenticationError(ClientError):
+    pass
+
+
+class RemoteFileNotFound(ClientError):
+    pass
+
+
+class Unsupported(ClientError):
+    """The server cannot take this kind of upload for this file; send it in full instead."""
+
+
+class ServerBusy(ClientError):
+    """The server's session queue is full; try again later."""
+
+
+def wait_for_login_prompt(reply, recv_msg, notify=None):
+    """Skip "Server busy, position N" notices until the login prompt; ServerBusy if turned away."""
+    while reply.startswith(BUSY):
+        if 'position' not in reply:
+            raise ServerBusy(reply)
+        if notify:
+            notify(reply)
+        reply = recv_msg()
+    return reply
+
+
+class Session:
+    """One authenticated connection. Every method starts and ends at the server's command prompt."""
+
+    def __init__(self, conn, notify=None):
+        self.conn = conn
+        self.notify = notify or (lambda message: None)
+
+    @classmethod
+    def connect(cls, host, port, username, password, codecs=(), timeout=None, notify=None, tls=None):
+        """Log in; tls, a tls.ClientTLS, runs the connection over TLS."""
+        sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            if tls is not None:
+                sock = tls.wrap(sock, host, port)
+            conn = protocol.client_handshake(sock, codecs=codecs)
+            wait_for_login_prompt(conn.recv_msg(), conn.recv_msg, notify)
+            if tls is not None:
+                tls.remember(sock, host, port)
+            conn.send_msg(username)
+            conn.recv_msg()
+            conn.send_msg(password)
+            response = conn.recv_msg()
+            if response != "Authentication successful.":
+                raise AuthenticationError(response)
+            conn.recv_msg()  # command prompt
+        except BaseException:
+            sock.close()
+            raise
+        return cls(conn, notify)
+
+    def alive(self):
+        """False if the server closed the connection since it was last used, e.g. for a restart."""
+        sock = self.conn.sock
+        try:
+            if not select.select([sock], [], [], 0)[0]:
+                return True
+            if isinstance(sock, ssl.SSLSocket):
+                return peer_open(sock)
+            return sock.recv(1, socket.MSG_PEEK) != b''
+        except OSError:
+            return False
+
+    def close(self):
+        try:
+            self.conn.send_msg('exit')
+        except OSError:
+            pass
+        self.conn.close()
+
+    def _prompt(self):
+        reply = self.conn.recv_msg()
+        if not reply.startswith(PROMPT):
+            raise protocol.ProtocolError(f"Expected the command prompt, got {reply!r}")
+
+    def _refused(self, reply, error=ClientError):
+        """The server declined with reply and went back to its prompt."""
+        self._prompt()
+        return error(reply)
+
+    def _finish_upload(self):
+        reply = self.conn.recv_msg()
+        self._prompt()
+        if reply != UPLOAD_DONE:
+            raise ClientError(reply)
+
+    def _send_or_abort(self, send):
+        """Run send(); a local read error is reported to the server instead of desynchronising the session."""
+        try:
+            return send()
+        except ConnectionError:
+            raise
+        except OSError:
+            self.conn.send_error("UPLOAD_ERROR")
+            self._prompt()
+            raise
+
+    # Uploads
+
+    def resumable_upload(self, path, name, progress=None):
+        """Upload path as name, continuing an interrupted earlier attempt; returns the file bytes sent."""
+        stat = os.stat(path)
+        self.conn.send_msg('resume_upload')
+        self.conn.recv_msg()
+        self.conn.send_msg(f"{stat.st_size} {stat.st_mtime_ns} {name}")
+        reply = self.conn.recv_msg()
+        if not reply.startswith("OFFSET "):
+            raise self._refused(reply)
+        offset = int(reply.split()[1])
+        if offset:
+            self.notify(f"Resuming upload at byte {offset} of {stat.st_size}...")
+        else:
+            self.notify(f"Starting upload of {stat.st_size} bytes...")
+
+        def send():
+            with open(path, 'rb') as file:
+                hasher = None
+                if self.conn.digests:
+                    # The server checks the whole file, so hash the part it already has on the way
+                    hasher = hash_prefix(file, offset)
+                file.seek(offset)
+                return self.conn.send_stream(
+                    file, progress=progress and (lambda sent: progress(offset + sent, stat.st_size)),
+                    hasher=hasher)
+
+        sent = self._send_or_abort(send)
+        self._finish_upload()
+        return sent
+
+    def delta_upload(self, path, name):
+        """Send only the blocks that differ from the server's copy; raises Unsupported without one."""
+        file_size = os.path.getsize(path)
+        self.conn.send_msg('delta_upload')
+        self.conn.recv_msg()
+        self.conn.send_msg(f"{file_size} {delta.file_sha256(path)} {name}")
+        reply = self.conn.recv_msg()
+        if reply == "NO_BASE":
+            raise self._refused("No copy on the server to diff against.", Unsupported)
+        if not reply.startswith("SIGNATURES "):
+            raise self._refused(reply)
+
+        block_size = int(reply.split()[1])
+        signatures = io.BytesIO()
+        self.conn.recv_stream(signatures)
+        table = delta.parse_signatures(signatures.getvalue())
+        self.notify(f"Computing delta against {len(signatures.getvalue()) // delta.SIGNATURE.size} server blocks of {block_size} bytes...")
+        sent = self._send_or_abort(
+            lambda: self.conn.send_stream(delta.DeltaReader(delta.compute_delta(path, block_size, table))))
+        self.notify(f"Sent {sent} delta bytes for a {file_size} byte file.")
+
+        reply = self.conn.recv_msg()
+        if reply == "DELTA_MISMATCH":
+            raise self._refused("Server could not rebuild the file from the delta.", Unsupported)
+        self._prompt()
+        if reply != UPLOAD_DONE:
+            raise ClientError(reply)
+        return sent
+
+    def dedup_upload(self, path, name):
+        """Send the chunk list, then only the chunks the server lacks; raises Unsupported if it does not deduplicate."""
+        file_size = os.path.getsize(path)
+        chunks = chunkstore.file_chunks(path)
+        self.conn.send_msg('dedup_upload')
+        self.conn.recv_msg()
+        self.conn.send_msg(f"{file_size} {len(chunks)} {name}")
+        reply = self.conn.recv_msg()
+        if reply == "DEDUP_DISABLED":
+            raise self._refused("Server does not deduplicate.", Unsupported)
+        if reply != "SEND_MANIFEST":
+            raise self._refused(reply)
+
+        self.conn.send_stream(io.BytesIO(chunkstore.encode_manifest(chunks)))
+        reply = self.conn.recv_msg()
+        if not reply.startswith("MISSING "):
+            raise self._refused(reply)
+        indices = io.BytesIO()
+        self.conn.recv_stream(indices)
+        missing = [chunks[index] for index, in chunkstore.INDEX.iter_unpack(indices.getvalue())]
+        self.notify(f"Server already has {len(chunks) - len(missing)} of {len(chunks)} chunks; sending {len(missing)}.")
+
+        def send():
+            with open(path, 'rb') as file:
+                return self.conn.send_stream(chunkstore.ChunkReader(file, missing))
+
+        sent = self._send_or_abort(send)
+        self._finish_upload()
+        return sent
+
+    def keep(self, entry, path=None):
+        """Cluster use: give the server a version or snapshot entry; path holds its bytes if it needs them.
+
+        Returns False when the server needs the bytes and path is None, else
+        True.
+        """
+        self.conn.send_msg('keep')
+        self.conn.recv_msg()
+        self.conn.send_msg(json.dumps(dict(entry, data=path is not None)))
+        reply = self.conn.recv_msg()
+        if reply == "MISSING":
+            self._prompt()
+            return False
+        if reply == "SEND":
+            def send():
+                with open(path, 'rb') as file:
+                    return self.conn.send_stream(file)
+
+            self._send_or_abort(send)
+            reply = self.conn.recv_msg()
+        self._prompt()
+        if reply != "KEPT":
+            raise ClientError(reply)
+        return True
+
+    def stripe_begin(self, header):
+        self.conn.send_msg('stripe_begin')
+        self.conn.recv_msg()
+        self.conn.send_msg(header)
+        reply = self.conn.recv_msg()
+        if reply != "READY":
+            raise self._refused(reply)
+        self._prompt()
+
+    def stripe_put(self, path, offset, length, token, name):
+        self.conn.send_msg('stripe_put')
+        self.conn.recv_msg()
+        self.conn.send_msg(f"{offset} {token} {name}")
+        reply = self.conn.recv_msg()
+        if reply != "READY":
+            raise self._refused(reply)
+        with open(path, 'rb') as file:
+            self.conn.send_file(file, offset, length)
+        reply = self.conn.recv_msg()
+        if not reply.startswith("STRIPE_DONE"):
+            raise self._refused(reply)
+        self._prompt()
+
+    def stripe_commit(self, header):
+        self.conn.send_msg('stripe_commit')
+        self.conn.recv_msg()
+        self.conn.send_msg(header)
+        self._finish_upload()
+
+    # Requests that can be pipelined. Each is (messages to send, read_reply),
+    # where read_reply() reads the reply up to, not including, the next prompt.
+
+    def pipeline(self, requests):
+        """Send requests back to back and collect their results in order.
+
+        A ClientError from one request is returned in its place, the others
+        are unaffected. Any other error leaves the session unusable.
+        """
+        requests = iter(requests)
+        in_flight = deque()
+        results = []
+
+        def send_next():
+            request = next(requests, None)
+            if request is None:
+                return False
+            messages, read_reply = request
+            for message in messages:
+                self.conn.send_msg(message)
+            in_flight.append(read_reply)
+            return True
+
+        while len(in_flight) < PIPELINE_DEPTH and send_next():
+            pass
+        while in_flight:
+            read_reply = in_flight.popleft()
+            try:
+                results.append(read_reply())
+            except ClientError as e:
+                results.append(e)
+            self._prompt()
+            send_next()
+        return results
+
+    def _one(self, request):
+        result, = self.pipeline([request])
+        if isinstance(result, ClientError):
+            raise result
+        return result
+
+    def _file_reply(self, reply, name):
+        if reply == "FILE_NOT_FOUND":
+            return RemoteFileNotFound(f"File not found on server: {name}")
+        if reply == "INVALID_RANGE":
+            return ClientError("Offset is beyond the end of the file.")
+        return protocol.ProtocolError(f"Unexpected server response: {reply}")
+
+    def range_request(self, name, offset, length, sink, source=None):
+        """Request for bytes [offset, offset + length) of name (length -1: to the end) into sink.
+
+        Its result is (bytes received, file size). source reads an earlier
+        version or a snapshot's copy instead (see kept_source()).
+        """
+        def read_reply():
+            reply = self.conn.recv_msg()
+            if not reply.startswith("RANGE_MODE "):
+                raise self._file_reply(reply, name)
+            total = int(reply.split()[3])
+            if isinstance(sink, _ProgressWriter):
+                sink.total = total
+            return self.conn.recv_stream(sink), total
+        return ['download', _from(source, f"RANGE {offset} {length} {name}")], read_reply
+
+    def preview_request(self, name, source=None):
+        def read_reply():
+            reply = self.conn.recv_msg()
+            if reply != "PREVIEW_MODE":
+                raise self._file_reply(reply, name)
+            data = io.BytesIO()
+            self.conn.recv_stream(data)
+            return data.getvalue()
+        return ['download', _from(source, f"PREVIEW {name}")], read_reply
+
+    def delete_request(self, name):
+        def read_reply():
+            self.conn.recv_msg()  # filename prompt
+            reply = self.conn.recv_msg()
+            if reply == "FILE_NOT_FOUND":
+                return False
+            if reply != "FILE_DELETED":
+                raise ClientError(reply)
+            return True
+        return ['delete', name], read_reply
+
+    def list_request(self, query):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply != "LISTING":
+                raise ClientError(reply)
+            listing = io.BytesIO()
+            self.conn.recv_stream(listing)
+            return json.loads(listing.getvalue())
+        return ['list', json.dumps(query)], read_reply
+
+    def manifest_request(self, prefix):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply != "MANIFEST":
+                raise ClientError(reply)
+            manifest = io.BytesIO()
+            self.conn.recv_stream(manifest)
+            return json.loads(manifest.getvalue())['files']
+        return ['manifest', json.dumps({'prefix': prefix} if prefix else {})], read_reply
+
+    def versions_request(self, name):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply != "VERSIONS":
+                raise self._file_reply(reply, name)
+            listing = io.BytesIO()
+            self.conn.recv_stream(listing)
+            return json.loads(listing.getvalue())['versions']
+        return ['versions', name], read_reply
+
+    def restore_request(self, request):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply == "FILE_NOT_FOUND":
+                raise RemoteFileNotFound(f"Nothing to restore: {request}")
+            if not reply.startswith("RESTORED "):
+                raise ClientError(reply)
+            return int(reply.split()[1])
+        return ['restore', json.dumps(request)], read_reply
+
+    def purge_request(self, ticket):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if not reply.startswith("PURGED "):
+                raise ClientError(reply)
+            return tuple(int(count) for count in reply.split()[1:])
+        return ['purge', ticket], read_reply
+
+    def history_request(self, ticket):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply != "HISTORY":
+                raise ClientError(reply)
+            listing = io.BytesIO()
+            self.conn.recv_stream(listing)
+            return json.loads(listing.getvalue())
+        return ['history', ticket], read_reply
+
+    def snapshot_request(self, op, snapshot=None):
+        def read_reply():
+            self.conn.recv_msg()
+            reply = self.conn.recv_msg()
+            if reply == "SNAPSHOT_NOT_FOUND":
+                raise RemoteFileNotFound(f"Snapshot not found on server: {snapshot}")
+            if reply != "SNAPSHOT":
+                raise ClientError(reply)
+            data = io.BytesIO()
+            self.conn.recv_stream(data)
+            return json.loads(data.getvalue())
+        request = {'op': op}
+        if snapshot is not None:
+            request['snapshot'] = snapshot
+        return ['snapshot', json.dumps(request)], read_reply
+
+    def read_range(self, name, offset, length, sink, source=None):
+        return self._one(self.range_request(name, offset, length, sink, source))
+
+    def preview(self, name, source=None):
+        return self._one(self.preview_request(name, source))
+
+    def delete(self, name):
+        return self._one(self.delete_request(name))
+
+    def list(self, query):
+        return self._one(self.list_request(query))
+
+    def manifest(self, prefix):
+        return self._one(self.manifest_request(prefix))
+
+    def download(self, name, dest, progress=None, source=None):
+        """Download name into dest through dest + '.part', resuming from what an earlier attempt left.
+
+        If the server sends the file's digest, what was received (including
+        any earlier partial) is checked against it before the rename.
+        """
+        part_name = dest + ".part"
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        hasher = None
+        if self.conn.digests:
+            with open(part_name, 'rb') if offset else contextlib.nullcontext() as file:
+                hasher = hash_prefix(file, offset)
+        with open(part_name, 'ab') as file:
+            try:
+                sink = file if progress is None else _ProgressWriter(file, offset, progress)
+                if hasher is not None:
+                    sink = protocol.HashingWriter(sink, hasher)
+                _, total = self.read_range(name, offset, -1, sink, source)
+            except ClientError as e:
+                if not isinstance(e, RemoteFileNotFound) and offset:
+                    os.remove(part_name)
+                    raise ClientError("Partial download is larger than the file on the server; discarded it, please retry.")
+                raise
+        if offset:
+            self.notify(f"Resumed download of {name} at byte {offset} of {total}")
+        if os.path.getsize(part_name) != total:
+            raise ClientError("Download incomplete; run it again to resume.")
+        if hasher is not None and self.conn.end_digest and self.conn.end_digest != hasher.hexdigest():
+            os.remove(part_name)
+            raise ClientError("Download failed: checksum mismatch; discarded it, please retry.")
+        os.replace(part_name, dest)
+        return total
+
+
+def kept_source(version=None, snapshot=None):
+    """The download request prefix for an earlier version or a snapshot's copy of a file, or None."""
+    if version is not None:
+        return f"VERSION {int(version)}"
+    if snapshot is not None:
+        return f"SNAPSHOT {snapshot}"
+    return None
+
+
+def _from(source, request):
+    return f"{source} {request}" if source else request
+
+
+def hash_prefix(file, count):
+    """A sha256 fed the first count bytes of file (left positioned at count)."""
+    hasher = hashlib.sha256()
+    remaining = count
+    while remaining and (chunk := file.read(min(remaining, 1024 * 1024))):
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher
+
+
+class _ProgressWriter:
+    def __init__(self, file, offset, progress, total=None):
+        self.file = file
+        self.done = offset
+        self.progress = progress
+        self.total = total
+
+    def write(self, data):
+        written = self.file.write(data)
+        self.done += len(data)
+        self.progress(self.done, self.total)
+        return written
+
+
+def plan_stripes(total, stripe_size):
+    return [(offset, min(stripe_size, total - offset)) for offset in range(0, total, stripe_size)]
+
+
+class Client:
+    """Pool of authenticated sessions to one server, with the file operations on top.
+
+    streams > 1 stripes files larger than stripe_size across that many
+    connections. dedup and delta pick the upload method, falling back to a
+    full upload where the server cannot use them. notify, if given, is called
+    with human-readable progress notes. tls, a tls.ClientTLS, connects over
+    TLS; the pool's later connections resume the first one's TLS session.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5000, username=None, password=None, compression='auto',
+                 streams=1, stripe_size=8 * 1024 * 1024, dedup=False, delta=False, pool_size=None,
+                 timeout=None, notify=None, tls=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.codecs = compress.offer(compression)
+        self.streams = streams
+        self.stripe_size = stripe_size
+        self.dedup = dedup
+        self.delta = delta
+        self.pool_size = max(pool_size or DEFAULT_POOL_SIZE, streams)
+        self.timeout = timeout
+        self.notify = notify or (lambda message: None)
+        self.tls = tls
+        self._idle = []
+        self._open = 0
+        self._available = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def connect(self):
+        """Open the first session now, so bad credentials surface here."""
+        with self.session():
+            pass
+        return self
+
+    def close(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for session in idle:
+            session.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        """Borrow a session from the pool. It is dropped, not returned, if anything but a ClientError escapes."""
+        session = self._acquire()
+        try:
+            yield session
+        except ClientError:
+            self._release(session)
+            raise
+        except BaseException:
+            self._discard(session)
+            raise
+        self._release(session)
+
+    def _acquire(self):
+        while True:
+            with self._available:
+                while not self._idle and self._open >= self.pool_size:
+                    self._available.wait()
+                if not self._idle:
+                    self._open += 1
+                    break
+                session = self._idle.pop()
+            # Pooled sessions may have been closed by a server shutting down
+            if session.alive():
+                return session
+            self._discard(session)
+        try:
+            return Session.connect(self.host, self.port, self.username, self.password, self.codecs,
+                                   self.timeout, self.notify, self.tls)
+        except BaseException:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+
+    def _release(self, session):
+        with self._available:
+            self._idle.append(session)
+            self._available.notify()
+
+    def _discard(self, session):
+        try:
+            session.conn.close()
+        finally:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+
+    # Single operations
+
+    def upload(self, path, name=None, progress=None):
+        """Upload path (as name, default its basename); returns the payload bytes sent.
+
+        That is the file bytes after any resume point, or with dedup or delta
+        only the missing chunks or the delta, counted before transfer
+        compression: with a codec negotiated, fewer bytes cross the wire.
+        """
+        name = name or os.path.basename(path)
+        for enabled, method in ((self.dedup, 'dedup_upload'), (self.delta, 'delta_upload')):
+            if enabled:
+                try:
+                    with self.session() as session:
+                        return getattr(session, method)(path, name)
+                except Unsupported as e:
+                    self.notify(f"{e} Sending the whole file.")
+        if self.streams > 1 and os.path.getsize(path) > self.stripe_size:
+            return self._striped_upload(path, name, progress)
+        with self.session() as session:
+            return session.resumable_upload(path, name, progress)
+
+    def download(self, name, dest=None, progress=None, version=None, snapshot=None):
+        """Download name to dest (default: its basename in the current directory); returns the file size.
+
+        version (an id from versions()) or snapshot downloads that copy of
+        the file instead of the current one.
+        """
+        dest = dest or name.split('/')[-1]
+        source = kept_source(version, snapshot)
+        if self.streams > 1 and not os.path.exists(dest + ".part"):
+            with self.session() as session:
+                _, total = session.read_range(name, 0, 0, io.BytesIO(), source)
+            if total > self.stripe_size:
+                return self._striped_download(name, total, dest, progress, source)
+        with self.session() as session:
+            return session.download(name, dest, progress, source)
+
+    def preview(self, name, version=None, snapshot=None):
+        """The first bytes of name (or of one of its versions or snapshot copies)."""
+        with self.session() as session:
+            return session.preview(name, kept_source(version, snapshot))
+
+    def read_range(self, name, offset, length):
+        """Bytes [offset, offset + length) of name, and the file's size."""
+        data = io.BytesIO()
+        with self.session() as session:
+            _, total = session.read_range(name, offset, length, data)
+        return data.getvalue(), total
+
+    def delete(self, name):
+        """True if name was deleted, False if the server had no such file."""
+        with self.session() as session:
+            return session.delete(name)
+
+    def list(self, prefix=None, glob=None, min_size=None, max_size=None, since=None, limit=None, after=None):
+        """One page of files: {'files': [[name, size, mtime, sha256], ...], 'next': cursor or None}."""
+        query = {key: value for key, value in (('prefix', prefix), ('glob', glob), ('min_size', min_size),
+                                               ('max_size', max_size), ('since', since), ('limit', limit),
+                                               ('after', after)) if value is not None}
+        with self.session() as session:
+            return session.list(query)
+
+    def iter_files(self, **filters):
+        """Every [name, size, mtime, sha256] row matching filters, fetching pages as needed."""
+        after = None
+        while True:
+            page = self.list(after=after, **filters)
+            yield from page['files']
+            after = page['next']
+            if not after:
+                return
+
+    def manifest(self, prefix=None):
+        """Every [name, size, mtime, sha256] row under prefix, in one request."""
+        with self.session() as session:
+            return session.manifest(prefix)
+
+    # Versions and snapshots
+
+    def versions(self, name):
+        """[version, size, sha256] of the earlier versions the server keeps of name, newest first.
+
+        A version id is the time (in ns since the epoch) the version was
+        overwritten or deleted.
+        """
+        with self.session() as session:
+            return session._one(session.versions_request(name))
+
+    def restore(self, name, version):
+        """Make a version of name the current one again (the current one becomes a version).
+
+        Returns 0 if name already had those contents, else 1.
+        """
+        with self.session() as session:
+            return session._one(session.restore_request({'name': name, 'version': version}))
+
+    def purge(self, ticket):
+        """Cluster use: delete all of the user's files, versions and snapshots, keeping nothing.
+
+        ticket is a login ticket from the cluster coordinator (see credentials.issue_ticket()).
+        Returns the (files, versions, snapshots) removed.
+        """
+        with self.session() as session:
+            return session._one(session.purge_request(ticket))
+
+    def history(self, ticket):
+        """Cluster use: every version and snapshot kept for the user, deleted files' versions included.
+
+        Returns {"versions": [[name, version, size, sha256]], "snapshots":
+        [[snapshot, created, [[name, size, mtime, sha256]]]]}; ticket as for
+        purge().
+        """
+        with self.session() as session:
+            return session._one(session.history_request(ticket))
+
+    def keep(self, ticket, entry, path=None):
+        """Cluster use: add a version or snapshot entry (see history()) to the user's history.
+
+        The server links it from a copy with the same contents when it has
+        one; otherwise it needs the bytes from path, and without one this
+        returns False.
+        """
+        with self.session() as session:
+            return session.keep(dict(entry, ticket=ticket), path)
+
+    def snapshot(self, snapshot=None):
+        """Snapshot all of the user's files; returns the snapshot's name (default: a timestamp)."""
+        with self.session() as session:
+            return session._one(session.snapshot_request('create', snapshot))['snapshot']
+
+    def snapshots(self):
+        """[snapshot, created, files, bytes] of the user's snapshots, newest first."""
+        with self.session() as session:
+            return session._one(session.snapshot_request('list'))['snapshots']
+
+    def snapshot_files(self, snapshot):
+        """[name, size, mtime, sha256] of the files in a snapshot."""
+        with self.session() as session:
+            return session._one(session.snapshot_request('files', snapshot))['files']
+
+    def restore_snapshot(self, snapshot, name=None):
+        """Bring back name, or every file in the snapshot, as it was then; returns the files that changed.
+
+        Files created since the snapshot are left alone.
+        """
+        request = {'snapshot': snapshot}
+        if name is not None:
+            request['name'] = name
+        with self.session() as session:
+            return session._one(session.restore_request(request))
+
+    def delete_snapshot(self, snapshot):
+        """True if the snapshot was deleted, False if there was none by that name."""
+        with self.session() as session:
+            return session._one(session.snapshot_request('delete', snapshot))['deleted']
+
+    def sync(self, local_dir, remote_dir=None, delete=False, dry_run=False):
+        """Upload local_dir's new and changed files to remote_dir (default: the top of the user's storage).
+
+        With delete, remote files under remote_dir that are missing locally
+        are deleted too, making it a copy of local_dir; with the default
+        remote_dir that is every other file the user has. With dry_run
+        nothing is changed, on the server or locally. Returns the SyncPlan;
+        files that fail are left in plan.failed.
+        """
+        prefix = dirsync.remote_prefix(remote_dir)
+        cache = dirsync.HashCache(os.path.join(local_dir, dirsync.HASH_CACHE))
+        local = dirsync.local_manifest(local_dir, cache)
+        remote = {name: (size, mtime, digest) for name, size, mtime, digest in self.manifest(prefix)}
+        plan = dirsync.plan(local_dir, prefix, local, remote, delete)
+        if dry_run:
+            return plan
+        cache.save()
+        # Deletes go first: they free quota, and a file replaced by a directory of the same name needs them to
+        for name, result in zip(plan.deletes, self.delete_many(plan.deletes)):
+            if isinstance(result, ClientError):
+                plan.failed[name] = str(result)
+        uploads = [(path, name) for path, name, _ in plan.uploads]
+        for (_, name), result in zip(uploads, self._parallel(lambda item: self.upload(*item), uploads)):
+            if isinstance(result, ClientError):
+                plan.failed[name] = str(result)
+        return plan
+
+    # Batches. Results come back in input order; a ClientError for one file
+    # is returned in its place.
+
+    def preview_many(self, names):
+        with self.session() as session:
+            return session.pipeline([session.preview_request(name) for name in names])
+
+    def delete_many(self, names):
+        with self.session() as session:
+            return session.pipeline([session.delete_request(name) for name in names])
+
+    def upload_many(self, paths):
+        """Upload paths in parallel over the pool."""
+        return self._parallel(self.upload, paths)
+
+    def download_many(self, names, dest_dir='.'):
+        return self._parallel(lambda name: self.download(name, os.path.join(dest_dir, name.split('/')[-1])), names)
+
+    def _parallel(self, call, items):
+        def run(item):
+            try:
+                return call(item)
+            except ClientError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(run, items))
+
+    # Striped transfers
+
+    def _run_stripes(self, stripes, transfer, progress):
+        """Run transfer(session, offset, length) for every stripe over self.streams pooled sessions."""
+        pending = queue.Queue()
+        for stripe in stripes:
+            pending.put(stripe)
+        total = sum(length for _, length in stripes)
+        done = 0
+        done_lock = threading.Lock()
+
+        def worker():
+            nonlocal done
+            with self.session() as session:
+                while True:
+                    try:
+                        offset, length = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    transfer(session, offset, length)
+                    with done_lock:
+                        done += length
+                        if progress:
+                            progress(done, total)
+
+        streams = min(self.streams, len(stripes))
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            for future in [executor.submit(worker) for _ in range(streams)]:
+                future.result()
+
+    def _striped_upload(self, path, name, progress):
+        stat = os.stat(path)
+        header = f"{stat.st_size} {stat.st_mtime_ns} {name}"
+        with self.session() as session:
+            session.stripe_begin(header)
+        stripes = plan_stripes(stat.st_size, self.stripe_size)
+        self.notify(f"Starting striped upload of {stat.st_size} bytes in {len(stripes)} stripes over {min(self.streams, len(stripes))} connections...")
+        self._run_stripes(stripes, lambda session, offset, length:
+                          session.stripe_put(path, offset, length, stat.st_mtime_ns, name), progress)
+        with self.session() as session:
+            session.stripe_commit(header)
+        return stat.st_size
+
+    def _striped_download(self, name, total, dest, progress, source=None):
+        part_name = dest + ".part"
+        fd = os.open(part_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, total)
+            stripes = plan_stripes(total, self.stripe_size)
+            self.notify(f"Downloading {name} in {len(stripes)} stripes over {min(self.streams, len(stripes))} connections...")
+
+            def fetch_stripe(session, offset, length):
+                received, _ = session.read_range(name, offset, length,
+                                                 protocol.PositionalWriter(fd, offset, offset + length), source)
+                if received != length:
+                    raise ClientError(f"Short stripe at {offset}: {received}/{length} bytes")
+
+            self._run_stripes(stripes, fetch_stripe, progress)
+        except BaseException:
+            os.close(fd)
+            os.remove(part_name)
+            raise
+        os.close(fd)
+        os.replace(part_name, dest)
+        return total
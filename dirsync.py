@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+
+# Directory sync for dfos_client.Client.sync(): make the server's copy of a
+# local tree match it.
+#
+# The local side is described by a manifest of (path, size, mtime, sha256)
+# for every file under the directory. Hashes are kept in a cache file at the
+# top of the tree (HASH_CACHE), keyed on path, size and mtime, so only files
+# that changed since the last sync are read again. The server sends its
+# manifest for the same prefix in one reply (the `manifest` command, hashes
+# from its metadata index), and diffing the two gives the plan: files to
+# upload (new, or with a different hash) and, when asked for, remote files to
+# delete (gone locally). A remote file without a hash counts as changed: the
+# same size says nothing about the contents. Subdirectories map to
+# "dir/name" paths on the server.
+
+HASH_CACHE = ".dfos-hashes.json"
+HASH_BLOCK = 1024 * 1024
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_BLOCK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """sha256 of local files, reused while a file's size and mtime are unchanged."""
+
+    def __init__(self, path):
+        self.path = path
+        self.hashed = 0
+        try:
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+        self._seen = {}
+
+    def digest(self, relative, path, stat):
+        entry = self.entries.get(relative)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            digest = entry[2]
+        else:
+            digest = _sha256(path)
+            self.hashed += 1
+        self._seen[relative] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        """Write back the entries looked up this run (dropping files that are gone)."""
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, 'w') as file:
+                json.dump(self._seen, file)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
+
+
+def local_manifest(root, cache=None):
+    """{relative/path: (size, mtime, sha256)} for every regular file under root."""
+    files = {}
+    for directory, subdirs, names in os.walk(root):
+        subdirs.sort()
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            if relative in (HASH_CACHE, HASH_CACHE + ".tmp"):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            digest = cache.digest(relative, path, stat) if cache else _sha256(path)
+            files[relative] = (stat.st_size, stat.st_mtime, digest)
+    return files
+
+
+def remote_prefix(prefix):
+    """A server directory as a name prefix: '' or 'some/dir/'."""
+    prefix = (prefix or '').strip('/')
+    return prefix + '/' if prefix else ''
+
+
+class SyncPlan:
+    def __init__(self, root, prefix, uploads, new, deletes, unchanged):
+        self.root = root
+        self.prefix = prefix
+        # (local path, remote name, size) to send
+        self.uploads = uploads
+        # Remote names among the uploads that do not exist on the server yet
+        self.new = new
+        # Remote names to remove
+        self.deletes = deletes
+        self.unchanged = unchanged
+        # Filled in by Client.sync() once the plan has run: remote name -> error message
+        self.failed = {}
+
+    @property
+    def upload_bytes(self):
+        return sum(size for _, _, size in self.uploads)
+
+    def summary(self):
+        """Counts, then one line per file: + new, ~ changed, - deleted."""
+        lines = [f"{len(self.uploads)} to upload ({len(self.new)} new, {len(self.uploads) - len(self.new)} "
+                 f"changed, {self.upload_bytes} bytes), {len(self.deletes)} to delete, "
+                 f"{self.unchanged} unchanged."]
+        lines.extend(f"  {'+' if name in self.new else '~'} {name}" for _, name, _ in self.uploads)
+        lines.extend(f"  - {name}" for name in self.deletes)
+        return '\n'.join(lines)
+
+
+def plan(root, prefix, local, remote, delete=False):
+    """SyncPlan turning remote ({name: (size, mtime, sha256)}) into a copy of local (local_manifest())."""
+    uploads = []
+    new = set()
+    unchanged = 0
+    for relative, (size, _, digest) in local.items():
+        name = prefix + relative
+        theirs = remote.get(name)
+        if theirs is None:
+            new.add(name)
+        elif theirs[2] == digest:
+            unchanged += 1
+            continue
+        uploads.append((os.path.join(root, *relative.split('/')), name, size))
+    deletes = sorted(name for name in remote if name[len(prefix):] not in local) if delete else []
+    return SyncPlan(root, prefix, uploads, new, deletes, unchanged)
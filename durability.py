@@ -0,0 +1,90 @@
+import os
+import threading
+
+# How hard a commit pushes an upload to disk before the client is told it
+# succeeded (--fsync):
+#
+#   none   leave it to the page cache. Fastest; a power cut can lose uploads
+#          that were already acknowledged.
+#   file   each commit fsyncs its file before the rename and the directory
+#          after it.
+#   group  the same syncs, but commits arriving while a sync is running queue
+#          up and the next one to go fsyncs the whole queue at once, so
+#          concurrent uploads share their syncs (and a directory several of
+#          them landed in is synced once). There is no timer: a lone upload
+#          syncs straight away, batches only form under load.
+
+MODES = ('none', 'file', 'group')
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Batch:
+    def __init__(self):
+        self.paths = set()
+        self.done = False
+        self.error = None
+
+
+class Durability:
+    def __init__(self, mode='none'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown fsync mode {mode!r}")
+        self.mode = mode
+        # Syncs issued and batches they went out in, for the logs
+        self.fsyncs = 0
+        self.batches = 0
+        self._cond = threading.Condition()
+        self._filling = _Batch()
+        self._syncing = False
+
+    def sync(self, paths):
+        """fsync every path (files or directories); returns once they are all on disk."""
+        if self.mode == 'none':
+            return
+        if self.mode == 'file':
+            for path in dict.fromkeys(paths):
+                _fsync(path)
+            with self._cond:
+                self.fsyncs += len(set(paths))
+                self.batches += 1
+            return
+        with self._cond:
+            batch = self._filling
+            batch.paths.update(paths)
+            while not batch.done:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # Nobody is syncing, so batch is the one still filling: lead it
+                self._syncing = True
+                self._filling = _Batch()
+                self._cond.release()
+                try:
+                    for path in batch.paths:
+                        _fsync(path)
+                except Exception as e:
+                    batch.error = e
+                finally:
+                    self._cond.acquire()
+                    self.fsyncs += len(batch.paths)
+                    self.batches += 1
+                    batch.done = True
+                    self._syncing = False
+                    self._cond.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+    def sync_file(self, path):
+        """sync() for a file about to be renamed into place."""
+        self.sync([path])
+
+    def sync_parent(self, *paths):
+        """sync() the directories holding paths, once renames into them must survive a crash."""
+        self.sync([os.path.dirname(os.path.abspath(path)) for path in paths])
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import socket
+import signal
+import threading
+import subprocess
+
+# Graceful stop and hot restart for server.py.
+#
+#   SIGTERM  stop accepting, let the sessions finish (up to --drain-timeout)
+#            and exit.
+#   SIGHUP   the same, but first start a new copy of the server that inherits
+#            the listening socket, so no connection is refused while the old
+#            process drains. The new process says when it is accepting, and
+#            later receives the old one's PerformanceTracker totals.
+#
+# Both processes hold the same listening socket, so connections already
+# waiting in its backlog are picked up by the new process. Draining ends
+# sessions at their next command prompt; sessions sitting idle at the prompt
+# are closed straight away. A transfer in progress runs to completion unless
+# the deadline passes first.
+
+LISTEN_FD_ENV = 'DFOS_LISTEN_FD'
+HANDOFF_FD_ENV = 'DFOS_HANDOFF_FD'
+READY = b'READY\n'
+# Seconds a new process may take to start accepting before the restart is abandoned
+SPAWN_TIMEOUT = 30.0
+DRAIN_TIMEOUT = 60.0
+
+STOP = 'stop'
+RESTART = 'restart'
+
+
+class ShutdownSignals:
+    """SIGTERM and SIGHUP as a socket that becomes readable, so an accept loop can select on them.
+
+    Processes that cannot restart themselves (pre-fork workers, the cluster
+    coordinator) pass signals=(signal.SIGTERM,).
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGHUP)):
+        self.reader, self._writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self._writer.setblocking(False)
+        self.requested = None
+        for signum in signals:
+            signal.signal(signum, self._handle)
+
+    def _handle(self, signum, frame):
+        if self.requested != STOP:
+            self.requested = RESTART if signum == signal.SIGHUP else STOP
+        try:
+            self._writer.send(b'!')
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def take(self):
+        """The pending request (STOP or RESTART), or None."""
+        try:
+            while self.reader.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        requested, self.requested = self.requested, None
+        return requested
+
+
+class SessionRegistry:
+    """Open sessions, and which of them are waiting at the command prompt, for draining."""
+
+    def __init__(self):
+        self.draining = False
+        self._sessions = set()
+        self._idle = set()
+        self._lock = threading.Lock()
+
+    def add(self, conn):
+        with self._lock:
+            self._sessions.add(conn)
+
+    def remove(self, conn):
+        with self._lock:
+            self._sessions.discard(conn)
+            self._idle.discard(conn)
+
+    def wait_for_command(self, conn):
+        """Mark conn idle at the prompt; False if the server is draining and the session should end."""
+        with self._lock:
+            if self.draining:
+                return False
+            self._idle.add(conn)
+            return True
+
+    def got_command(self, conn):
+        with self._lock:
+            self._idle.discard(conn)
+
+    def drain(self):
+        """Stop new commands and close the sessions idle at the prompt."""
+        with self._lock:
+            self.draining = True
+            idle = list(self._idle)
+        for conn in idle:
+            conn.expire()
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions)
+        for conn in sessions:
+            conn.expire()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class Successor:
+    """The process that took over the listening socket, seen from the one it replaces."""
+
+    def __init__(self, process, channel):
+        self.process = process
+        self.channel = channel
+
+    def send_totals(self, snapshot):
+        try:
+            self.channel.sendall(json.dumps(snapshot).encode())
+        finally:
+            self.channel.close()
+
+
+def start_successor(listener, timeout=SPAWN_TIMEOUT):
+    """Start a new copy of this server on listener; returns it once it accepts, None if it did not start."""
+    channel, child_end = socket.socketpair()
+    env = dict(os.environ)
+    env[LISTEN_FD_ENV] = str(listener.fileno())
+    env[HANDOFF_FD_ENV] = str(child_end.fileno())
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                   pass_fds=(listener.fileno(), child_end.fileno()))
+    finally:
+        child_end.close()
+    channel.settimeout(timeout)
+    try:
+        reply = channel.makefile('rb').readline()
+    except (socket.timeout, OSError):
+        reply = b''
+    if reply != READY:
+        channel.close()
+        if process.poll() is None:
+            process.terminate()
+        return None
+    channel.settimeout(None)
+    return Successor(process, channel)
+
+
+def inherited_listener():
+    """The listening socket passed down by the process this one replaces, or None."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    return socket.socket(fileno=int(fd)) if fd else None
+
+
+def take_over(on_totals):
+    """In a successor: report that it is accepting, then pass the predecessor's totals to on_totals.
+
+    The totals arrive once the old process has drained, so they are received
+    on a background thread.
+    """
+    fd = os.environ.pop(HANDOFF_FD_ENV, None)
+    if fd is None:
+        return
+    channel = socket.socket(fileno=int(fd))
+    channel.sendall(READY)
+
+    def receive():
+        with channel, channel.makefile('rb') as stream:
+            data = stream.read()
+        if data:
+            on_totals(json.loads(data))
+
+    threading.Thread(target=receive, name='dfos-handoff', daemon=True).start()
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import itertools
+import multiprocessing
+import logging.handlers
+
+# Logging pipeline for the server. Handler threads only put records on a
+# queue; a listener thread formats them and does the file and terminal I/O,
+# so a slow disk or terminal never stalls a transfer. The log file holds one
+# JSON object per line:
+#
+#   {"ts": "2024-05-01T12:00:00.123Z", "level": "INFO", "pid": 4242,
+#    "msg": "File upload completed: a.txt, User: user1, Size: 2100 bytes",
+#    "user": "user1", "op": "upload", "file": "a.txt", "bytes": 2100,
+#    "duration": 0.004, "outcome": "ok"}
+#
+# Call sites pass structured fields with event(); message templates refer to
+# them as %(name)s and are only filled in on the listener thread. Records with
+# an 'op' field can be sampled per op (--log-sample preview=100 keeps one in
+# 100 successful previews); warnings and errors are always kept.
+
+ECHO_FORMAT = '%(asctime)s - %(levelname)s: %(message)s'
+
+_listener = None
+_owner_pid = None
+
+
+def event(message, level=logging.INFO, **fields):
+    """Log message with fields attached; message may use %(field)s placeholders."""
+    logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        if fields:
+            logger.log(level, message, fields)
+        else:
+            logger.log(level, message)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'pid': record.process,
+            'msg': record.getMessage(),
+        }
+        if isinstance(record.args, dict):
+            entry.update(record.args)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in N records of each sampled op at INFO and below, and marks the survivors."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counters = {op: itertools.count() for op in rates}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not isinstance(record.args, dict):
+            return True
+        op = record.args.get('op')
+        if op not in self.rates:
+            return True
+        if next(self.counters[op]) % self.rates[op]:
+            return False
+        record.args['sampled'] = self.rates[op]
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Leave msg and args alone so the listener does the formatting; only
+        # tracebacks, which cannot cross a process boundary, are rendered here.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(text):
+    """'preview=100,range=10' -> {'preview': 100, 'range': 10}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in (text or '').split(','))):
+        op, _, every = item.partition('=')
+        try:
+            rates[op] = max(int(every), 1)
+        except ValueError:
+            raise ValueError(f"Invalid sample rate {item!r}; expected op=N")
+    return rates
+
+
+def _file_handler(args):
+    if args.log_rotate:
+        handler = logging.handlers.TimedRotatingFileHandler(args.log_file, when=args.log_rotate,
+                                                            backupCount=args.log_backups)
+    else:
+        handler = logging.handlers.RotatingFileHandler(args.log_file, maxBytes=args.log_max_mb * 1024 * 1024,
+                                                       backupCount=args.log_backups)
+    handler.setFormatter(JsonLinesFormatter())
+    return handler
+
+
+def start(args):
+    """Route the root logger through the queue and start the listener writing the file (and terminal).
+
+    With --processes the queue is a multiprocessing one: forked workers inherit
+    the queue handler and their records reach the parent's listener.
+    """
+    global _listener, _owner_pid
+    log_queue = multiprocessing.Queue() if args.processes > 1 else queue.SimpleQueue()
+    handlers = [_file_handler(args)]
+    if args.log_echo:
+        echo = logging.StreamHandler()
+        echo.setFormatter(logging.Formatter(ECHO_FORMAT))
+        handlers.append(echo)
+
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(args.log_sample))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    _owner_pid = os.getpid()
+    atexit.register(stop)
+
+
+def stop():
+    """Drain the queue and stop the listener. A no-op in forked workers, which only produce records."""
+    global _listener
+    if _listener is None or os.getpid() != _owner_pid:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
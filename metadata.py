@@ -0,0 +1,319 @@
+import os
+import sqlite3
+import threading
+
+# Per-user file metadata index behind the `list` command.
+#
+# One row per committed file (name, size, mtime, SHA-256), kept in
+# server_storage/.dfos/index.db and updated by storage.py whenever an upload
+# commits or a file is deleted, so listing never has to walk or stat the
+# user's directory. Rows are clustered on (user, name) and pages are fetched
+# with a keyset cursor (the last name returned), so a page costs the same for
+# the first file as for the 100,000th.
+#
+# Users whose files predate the index are scanned once, the first time they
+# list; those rows have no hash until the file is uploaded again.
+#
+# The usage table holds each indexed user's total bytes and file count for
+# quota.py. It is adjusted in the same transaction as every row change, by
+# the difference the change makes, so it is never recomputed on the hot path
+# and survives restarts. reconcile() corrects it against the disk.
+#
+# The versions, snapshots and snapshot_files tables describe the earlier
+# versions and point-in-time snapshots storage.py keeps (see versions.py).
+# Version ids are the time.time_ns() at which the version was superseded.
+#
+# Each thread keeps one open connection (opened again in a forked child), so
+# lookups on the request path, such as digest_of() for a download or usage()
+# for a quota check, cost a query rather than a connect.
+
+MAX_PAGE = 1000
+DEFAULT_PAGE = 100
+# Largest SQLite integer, for "no limit" in a comparison
+UNLIMITED = 2 ** 63 - 1
+
+
+class MetadataIndex:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS files (user TEXT, name TEXT, size INTEGER, mtime REAL, "
+                       "sha256 TEXT, PRIMARY KEY (user, name)) WITHOUT ROWID")
+            db.execute("CREATE TABLE IF NOT EXISTS indexed_users (user TEXT PRIMARY KEY)")
+            db.execute("CREATE TABLE IF NOT EXISTS versions (user TEXT, name TEXT, version INTEGER, size INTEGER, "
+                       "sha256 TEXT, kind TEXT, PRIMARY KEY (user, name, version)) WITHOUT ROWID")
+            db.execute("CREATE TABLE IF NOT EXISTS snapshots (user TEXT, snapshot TEXT, created REAL, "
+                       "PRIMARY KEY (user, snapshot)) WITHOUT ROWID")
+            db.execute("CREATE TABLE IF NOT EXISTS snapshot_files (user TEXT, snapshot TEXT, name TEXT, "
+                       "size INTEGER, mtime REAL, sha256 TEXT, kind TEXT, "
+                       "PRIMARY KEY (user, snapshot, name)) WITHOUT ROWID")
+            with db:
+                if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'usage'").fetchone():
+                    # Index from before usage tracking: total up what it already holds, once
+                    db.execute("CREATE TABLE usage (user TEXT PRIMARY KEY, bytes INTEGER, files INTEGER)")
+                    db.execute("INSERT INTO usage SELECT user, SUM(size), COUNT(*) FROM files GROUP BY user")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _db(self):
+        """This thread's connection."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = self._connect()
+            local.pid = os.getpid()
+        return local.db
+
+    def _write(self, statement, *params):
+        db = self._db()
+        with db:
+            db.execute(statement, params)
+
+    @staticmethod
+    def _adjust_usage(db, user, size_change, file_change):
+        db.execute("INSERT INTO usage VALUES (?, ?, ?) ON CONFLICT (user) DO UPDATE SET "
+                   "bytes = bytes + excluded.bytes, files = files + excluded.files",
+                   (user, size_change, file_change))
+
+    def record(self, user, name, size, mtime, sha256):
+        db = self._db()
+        with db:
+            old = db.execute("SELECT size FROM files WHERE user = ? AND name = ?", (user, name)).fetchone()
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (user, name, size, mtime, sha256))
+            self._adjust_usage(db, user, size - (old[0] if old else 0), 0 if old else 1)
+
+    def remove(self, user, name):
+        db = self._db()
+        with db:
+            old = db.execute("SELECT size FROM files WHERE user = ? AND name = ?", (user, name)).fetchone()
+            if old:
+                db.execute("DELETE FROM files WHERE user = ? AND name = ?", (user, name))
+                self._adjust_usage(db, user, -old[0], -1)
+
+    def size_of(self, user, name):
+        """Recorded size of a file, or None if it is not indexed."""
+        db = self._db()
+        row = db.execute("SELECT size FROM files WHERE user = ? AND name = ?", (user, name)).fetchone()
+        return row[0] if row else None
+
+    def digest_of(self, user, name):
+        """(size, sha256) recorded for a file, or None if it is not indexed; sha256 may be None."""
+        db = self._db()
+        row = db.execute("SELECT size, sha256 FROM files WHERE user = ? AND name = ?", (user, name)).fetchone()
+        return tuple(row) if row else None
+
+    def set_digest(self, user, name, size, sha256):
+        """Fill in a missing hash, unless the file has been replaced (changed size) meanwhile."""
+        self._write("UPDATE files SET sha256 = ? WHERE user = ? AND name = ? AND size = ? AND sha256 IS NULL",
+                    sha256, user, name, size)
+
+    def usage(self, user):
+        """(bytes, files) the user's indexed files add up to."""
+        db = self._db()
+        row = db.execute("SELECT bytes, files FROM usage WHERE user = ?", (user,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def indexed_users(self):
+        db = self._db()
+        return [row[0] for row in db.execute("SELECT user FROM indexed_users")]
+
+    def is_indexed(self, user):
+        db = self._db()
+        return db.execute("SELECT 1 FROM indexed_users WHERE user = ?", (user,)).fetchone() is not None
+
+    def add_scanned(self, user, rows):
+        """Index files found on disk, (name, size, mtime, sha256) each, and mark user as indexed.
+
+        Rows already recorded by a commit are kept, since they carry a hash.
+        """
+        db = self._db()
+        with db:
+            db.executemany("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)",
+                           ((user, *row) for row in rows))
+            db.execute("INSERT OR IGNORE INTO indexed_users VALUES (?)", (user,))
+            self._total_usage(db, user)
+
+    @staticmethod
+    def _total_usage(db, user):
+        db.execute("INSERT OR REPLACE INTO usage SELECT ?, COALESCE(SUM(size), 0), COUNT(*) FROM files "
+                   "WHERE user = ?", (user, user))
+
+    def reconcile(self, user, rows, before):
+        """Bring user's rows in line with rows found on disk and recount their usage.
+
+        Only rows and files last changed before `before` (when the disk scan
+        started) are touched, so uploads committing during the scan are left
+        alone. Returns the usage before and after as two (bytes, files) pairs.
+        """
+        on_disk = {name: (size, mtime) for name, size, mtime, _ in rows}
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            old_usage = db.execute("SELECT bytes, files FROM usage WHERE user = ?", (user,)).fetchone()
+            indexed = {name: (size, mtime) for name, size, mtime in
+                       db.execute("SELECT name, size, mtime FROM files WHERE user = ?", (user,))}
+            for name, (size, mtime) in indexed.items():
+                if name not in on_disk and mtime < before:
+                    db.execute("DELETE FROM files WHERE user = ? AND name = ?", (user, name))
+            for name, (size, mtime) in on_disk.items():
+                if mtime >= before:
+                    continue
+                if name not in indexed:
+                    db.execute("INSERT INTO files VALUES (?, ?, ?, ?, NULL)", (user, name, size, mtime))
+                elif indexed[name][0] != size and indexed[name][1] < before:
+                    db.execute("UPDATE files SET size = ?, mtime = ?, sha256 = NULL WHERE user = ? AND name = ?",
+                               (size, mtime, user, name))
+            db.execute("INSERT OR IGNORE INTO indexed_users VALUES (?)", (user,))
+            self._total_usage(db, user)
+            new_usage = db.execute("SELECT bytes, files FROM usage WHERE user = ?", (user,)).fetchone()
+        return tuple(old_usage) if old_usage else (0, 0), tuple(new_usage)
+
+    def files(self, user, prefix=None):
+        """Every [name, size, mtime, sha256] row of user's (under prefix), in name order."""
+        clauses = ["user = ?"]
+        params = [user]
+        if prefix:
+            clauses.append("name >= ? AND name < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        db = self._db()
+        return [list(row) for row in db.execute(f"SELECT name, size, mtime, sha256 FROM files WHERE "
+                                                f"{' AND '.join(clauses)} ORDER BY name", params)]
+
+    def _rows(self, statement, *params):
+        db = self._db()
+        return [list(row) for row in db.execute(statement, params)]
+
+    # Versions and snapshots
+
+    def add_version(self, user, name, version, size, sha256, kind):
+        self._write("INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?)", user, name, version, size, sha256, kind)
+
+    def versions(self, user, name):
+        """[version, size, sha256, kind] of each kept version of a file, newest first."""
+        return self._rows("SELECT version, size, sha256, kind FROM versions WHERE user = ? AND name = ? "
+                          "ORDER BY version DESC", user, name)
+
+    def version(self, user, name, version):
+        """[size, sha256, kind] of one version, or None."""
+        rows = self._rows("SELECT size, sha256, kind FROM versions WHERE user = ? AND name = ? AND version = ?",
+                          user, name, version)
+        return rows[0] if rows else None
+
+    def user_versions(self, user):
+        """[name, version, size, sha256, kind] of every version kept for user's files, deleted files included."""
+        return self._rows("SELECT name, version, size, sha256, kind FROM versions WHERE user = ? "
+                          "ORDER BY name, version", user)
+
+    def copies_of(self, user, name, sha256):
+        """[('version', id) or ('snapshot', name)] of the plain kept copies of a file with these contents."""
+        return self._rows("SELECT 'version', version FROM versions "
+                          "WHERE user = ? AND name = ? AND sha256 = ? AND kind = 'file' "
+                          "UNION ALL SELECT 'snapshot', snapshot FROM snapshot_files "
+                          "WHERE user = ? AND name = ? AND sha256 = ? AND kind = 'file'",
+                          user, name, sha256, user, name, sha256)
+
+    def remove_version(self, user, name, version):
+        self._write("DELETE FROM versions WHERE user = ? AND name = ? AND version = ?", user, name, version)
+
+    def expired_versions(self, keep_last=None, before=None, user=None, name=None):
+        """[user, name, version, kind] of versions beyond the newest keep_last of their file or older than before.
+
+        user and name narrow the search to one file.
+        """
+        clauses, params = ["1"], []
+        if user is not None:
+            clauses.append("user = ? AND name = ?")
+            params += [user, name]
+        return self._rows(f"SELECT user, name, version, kind FROM (SELECT *, ROW_NUMBER() OVER "
+                          f"(PARTITION BY user, name ORDER BY version DESC) AS position FROM versions "
+                          f"WHERE {' AND '.join(clauses)}) WHERE position > ? OR version < ?",
+                          *params, keep_last or UNLIMITED, before or 0)
+
+    def add_snapshot(self, user, snapshot, created, rows):
+        """Record a snapshot and its files, (name, size, mtime, sha256, kind) each."""
+        db = self._db()
+        with db:
+            db.execute("INSERT INTO snapshots VALUES (?, ?, ?)", (user, snapshot, created))
+            db.executemany("INSERT INTO snapshot_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           ((user, snapshot, *row) for row in rows))
+
+    def add_snapshot_file(self, user, snapshot, created, row):
+        """Record one file of a snapshot being copied in, and the snapshot itself if it is new."""
+        db = self._db()
+        with db:
+            db.execute("INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?)", (user, snapshot, created))
+            if row is not None:
+                db.execute("INSERT INTO snapshot_files VALUES (?, ?, ?, ?, ?, ?, ?)", (user, snapshot, *row))
+
+    def snapshots(self, user):
+        """[snapshot, created, files, bytes] of each of user's snapshots, newest first."""
+        return self._rows("SELECT s.snapshot, s.created, COUNT(f.name), COALESCE(SUM(f.size), 0) "
+                          "FROM snapshots s LEFT JOIN snapshot_files f ON f.user = s.user AND f.snapshot = s.snapshot "
+                          "WHERE s.user = ? GROUP BY s.snapshot ORDER BY s.created DESC", user)
+
+    def snapshot_files(self, user, snapshot, name=None):
+        """[name, size, mtime, sha256, kind] of the files in a snapshot (just name's, if given)."""
+        if name is not None:
+            return self._rows("SELECT name, size, mtime, sha256, kind FROM snapshot_files "
+                              "WHERE user = ? AND snapshot = ? AND name = ?", user, snapshot, name)
+        return self._rows("SELECT name, size, mtime, sha256, kind FROM snapshot_files "
+                          "WHERE user = ? AND snapshot = ? ORDER BY name", user, snapshot)
+
+    def has_snapshot(self, user, snapshot):
+        return bool(self._rows("SELECT 1 FROM snapshots WHERE user = ? AND snapshot = ?", user, snapshot))
+
+    def remove_snapshot(self, user, snapshot):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM snapshot_files WHERE user = ? AND snapshot = ?", (user, snapshot))
+            db.execute("DELETE FROM snapshots WHERE user = ? AND snapshot = ?", (user, snapshot))
+
+    def expired_snapshots(self, keep_last=None, before=None):
+        """[user, snapshot] of snapshots beyond the newest keep_last of their user or created before before."""
+        return self._rows("SELECT user, snapshot FROM (SELECT *, ROW_NUMBER() OVER "
+                          "(PARTITION BY user ORDER BY created DESC) AS position FROM snapshots) "
+                          "WHERE position > ? OR created < ?",
+                          keep_last or UNLIMITED, before or 0)
+
+    def page(self, user, limit=DEFAULT_PAGE, after=None, prefix=None, pattern=None,
+             min_size=None, max_size=None, since=None):
+        """One page of user's files in name order; returns (rows, cursor for the next page or None).
+
+        prefix and after are answered from the primary key. pattern (a glob),
+        the size bounds and since are checked row by row while walking it, so
+        a selective filter reads every row of the user's (prefix) range it
+        skips on the way to a full page; over a large range that is a scan.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE))
+        clauses = ["user = ?"]
+        params = [user]
+        if after is not None:
+            clauses.append("name > ?")
+            params.append(after)
+        if prefix:
+            clauses.append("name >= ? AND name < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        if pattern:
+            clauses.append("name GLOB ?")
+            params.append(pattern)
+        if min_size is not None:
+            clauses.append("size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            clauses.append("size <= ?")
+            params.append(max_size)
+        if since is not None:
+            clauses.append("mtime >= ?")
+            params.append(since)
+        db = self._db()
+        rows = db.execute(f"SELECT name, size, mtime, sha256 FROM files WHERE {' AND '.join(clauses)} "
+                          f"ORDER BY name LIMIT ?", (*params, limit + 1)).fetchall()
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1][0]
+        return rows, None
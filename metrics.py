@@ -0,0 +1,222 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+# Live server metrics: histograms kept by PerformanceTracker, a background
+# sampler of the process's CPU, memory and descriptors, and an HTTP endpoint
+# that serves all of it in the Prometheus text format
+# (`python3 server.py --metrics-port 9100`, then GET /metrics).
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Bytes per second, 64 KiB/s to 4 GiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(9))
+# Seconds between a connection (or a blocking I/O call) being queued and a pool worker picking it up
+QUEUE_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+SAMPLE_INTERVAL = 5.0
+# Samples kept for the shutdown report (an hour at the default interval)
+SAMPLE_HISTORY = 720
+
+
+class Histogram:
+    """Cumulative-bucket histogram. Not locked: the owning tracker serialises access."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None when empty)."""
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+    def merge(self, snapshot):
+        for index, count in enumerate(snapshot['counts']):
+            self.counts[index] += count
+        self.sum += snapshot['sum']
+
+
+class ResourceSampler:
+    """Daemon thread recording this process's CPU %, RSS and open descriptors every interval seconds."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history=SAMPLE_HISTORY):
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.process.cpu_percent()   # the first call only sets the baseline
+        self.thread = threading.Thread(target=self._run, name='dfos-sampler', daemon=True)
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except psutil.Error as e:
+                logging.warning(f"Resource sampling failed: {e}")
+
+    def sample(self):
+        with self.process.oneshot():
+            cpu = self.process.cpu_percent()
+            rss = self.process.memory_info().rss
+            fds = self.process.num_fds() if hasattr(self.process, 'num_fds') else self.process.num_handles()
+            threads = self.process.num_threads()
+        with self.lock:
+            self.samples.append((time.time(), cpu, rss, fds, threads))
+
+    def summary(self):
+        """Latest and peak values, or {} before the first sample."""
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return {}
+        _, cpu, rss, fds, threads = samples[-1]
+        return {
+            'cpu_percent': cpu,
+            'rss_bytes': rss,
+            'open_fds': fds,
+            'threads': threads,
+            'peak_cpu_percent': max(sample[1] for sample in samples),
+            'peak_rss_bytes': max(sample[2] for sample in samples),
+            'peak_open_fds': max(sample[3] for sample in samples),
+        }
+
+
+# Prometheus text exposition
+
+_COUNTERS = [
+    ('dfos_connections_total', 'total_connections', "Client connections accepted."),
+    ('dfos_file_transfers_total', 'file_transfers', "Completed file uploads."),
+    ('dfos_cache_hits_total', 'cache_hits', "Content cache hits."),
+    ('dfos_cache_misses_total', 'cache_misses', "Content cache misses."),
+    ('dfos_cache_evictions_total', 'cache_evictions', "Content cache evictions."),
+    ('dfos_sessions_queued_total', 'sessions_queued', "Clients told to wait for a free session slot."),
+    ('dfos_sessions_rejected_total', 'sessions_rejected', "Clients turned away because the wait queue was full."),
+    ('dfos_sessions_reaped_total', 'sessions_reaped', "Sessions closed for idling or making no progress."),
+]
+_GAUGES = [
+    ('dfos_connections_active', 'active_connections', "Client connections currently open."),
+    ('dfos_sessions_waiting', 'sessions_waiting', "Clients currently waiting for a session slot."),
+]
+_RESOURCE_GAUGES = [
+    ('dfos_process_cpu_percent', 'cpu_percent', "CPU use of the server process at the last sample."),
+    ('dfos_process_resident_memory_bytes', 'rss_bytes', "Resident memory at the last sample."),
+    ('dfos_process_open_fds', 'open_fds', "Open file descriptors at the last sample."),
+    ('dfos_process_threads', 'threads', "Threads at the last sample."),
+    ('dfos_process_peak_resident_memory_bytes', 'peak_rss_bytes', "Highest sampled resident memory."),
+]
+_HISTOGRAMS = [
+    ('dfos_operation_duration_seconds', 'latency', 'operation', "Time to serve a request, by operation."),
+    ('dfos_transfer_bytes_per_second', 'throughput', 'operation', "File bytes moved per second, by operation."),
+    ('dfos_queue_wait_seconds', 'queue_wait', 'pool', "Time spent waiting for a pool worker."),
+]
+# One series per transfer in progress, labelled with its id, user and op
+_TRANSFER_GAUGES = [
+    ('dfos_transfer_rate_current_bytes_per_second', 'rate', "Measured rate of each transfer in progress."),
+    ('dfos_transfer_rate_allocated_bytes_per_second', 'allocated',
+     "Rate the bandwidth scheduler allows each transfer (absent when unlimited)."),
+    ('dfos_transfer_progress_bytes', 'bytes', "Bytes moved so far by each transfer in progress."),
+]
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(snapshot):
+    """A PerformanceTracker snapshot as Prometheus text format."""
+    lines = []
+    for name, key, help_text in _COUNTERS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {snapshot[key]}"]
+    for name, key, help_text in _GAUGES:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {snapshot[key]}"]
+    resources = snapshot.get('resources', {})
+    for name, key, help_text in _RESOURCE_GAUGES:
+        if key in resources:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_number(resources[key])}"]
+    for name, key, label, help_text in _HISTOGRAMS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for value, histogram in sorted(snapshot[key].items()):
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{_number(bound)}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {_number(histogram["sum"])}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {cumulative}')
+    transfers = snapshot.get('transfers', [])
+    for name, key, help_text in _TRANSFER_GAUGES:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for transfer in transfers:
+            if transfer[key] is not None:
+                labels = f'transfer="{transfer["id"]}",user="{_label(transfer["user"])}",op="{transfer["op"]}"'
+                lines.append(f'{name}{{{labels}}} {_number(transfer[key])}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    tracker = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(self.tracker.snapshot()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(tracker, host, port):
+    """Serve GET /metrics for tracker from a daemon thread; returns the HTTP server."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'tracker': tracker})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='dfos-metrics', daemon=True).start()
+    logging.info(f"Metrics endpoint on http://{host}:{port}/metrics (pid {os.getpid()})")
+    return httpd
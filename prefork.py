@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import queue
+import socket
+import signal
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+import handoff
+import server
+
+# Pre-fork mode for server.py (`python3 server.py --processes N`).
+#
+# N worker processes each run the selected engine on their own listening
+# socket bound to the same port with SO_REUSEPORT, so the kernel spreads new
+# connections across cores. Where SO_REUSEPORT is missing the parent binds one
+# socket before forking and the workers accept from it. Each worker keeps its
+# own PerformanceTracker and sends a snapshot to the parent when it is told to
+# stop; the parent merges them into the usual shutdown report.
+#
+# SIGTERM to the parent is passed on to the workers, which drain like a single
+# server (see handoff.py): no new connections, sessions end at their next
+# command prompt, and whatever is left after --drain-timeout is closed. The
+# parent waits that long for their reports before killing them. Ctrl+C stops
+# the workers at once (STOP_NOW). Hot restart (SIGHUP) is not supported.
+
+SHUTDOWN_TIMEOUT = 5.0
+# Sent by the parent on Ctrl+C: report and exit without draining
+STOP_NOW = signal.SIGUSR1
+REUSE_PORT_AVAILABLE = hasattr(socket, 'SO_REUSEPORT')
+
+
+def worker_main(worker_id, args, shared_socket, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent coordinates Ctrl+C
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    reported = False
+
+    def report(snapshot):
+        nonlocal reported
+        if reported:
+            return
+        reported = True
+        results.put((worker_id, os.getpid(), snapshot))
+        results.close()
+        results.join_thread()
+
+    def report_and_exit(signum, frame):
+        report(server.performance_tracker.snapshot())
+        sys.exit(0)
+
+    signal.signal(STOP_NOW, report_and_exit)
+    # SIGTERM drains; the engine hands the totals to report() when it is done
+    signals = handoff.ShutdownSignals(signals=(signal.SIGTERM,))
+    server.report_totals = report
+
+    if shared_socket is None:
+        server_socket = server.create_listener(args.host, args.port, args.backlog, reuse_port=True)
+    else:
+        server_socket = shared_socket
+    logging.info(f"Worker {worker_id} (pid {os.getpid()}) serving port {args.port} with the {args.engine} engine.")
+    server.start_monitoring(args, worker_id)
+    server.run_engine(server_socket, args, signals)
+
+
+def start_worker(worker_id, args, shared_socket, results):
+    process = multiprocessing.Process(target=worker_main, name=f"dfos-worker-{worker_id}",
+                                      args=(worker_id, args, shared_socket, results))
+    process.start()
+    return process
+
+
+def run(args):
+    logging.info(f"Server started in pre-fork mode with {args.processes} worker processes.")
+    shared_socket = None
+    if not REUSE_PORT_AVAILABLE:
+        shared_socket = server.create_listener(args.host, args.port, args.backlog)
+
+    results = multiprocessing.Queue()
+    workers = {i: start_worker(i, args, shared_socket, results) for i in range(args.processes)}
+    print(f"Server is listening on port {args.port} ({args.processes} x {args.engine} engine)...")
+
+    stopping = None
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = signum
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGHUP, lambda signum, frame: logging.warning(
+        "Hot restart (SIGHUP) is not supported with --processes; ignoring it."))
+
+    while stopping is None:
+        sentinels = {process.sentinel: worker_id for worker_id, process in workers.items()}
+        for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=1.0):
+            worker_id = sentinels[sentinel]
+            if stopping is not None:
+                break
+            logging.error(f"Worker {worker_id} exited with code {workers[worker_id].exitcode}; restarting it.")
+            workers[worker_id] = start_worker(worker_id, args, shared_socket, results)
+
+    drain = stopping == signal.SIGTERM
+    if drain:
+        logging.info(f"Draining {len(workers)} workers for up to {server.DRAIN_TIMEOUT} seconds.")
+    for process in workers.values():
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM if drain else STOP_NOW)
+
+    aggregate = server.PerformanceTracker()
+    reported = 0
+    deadline = time.monotonic() + (server.DRAIN_TIMEOUT if drain else 0) + SHUTDOWN_TIMEOUT
+    while reported < len(workers) and time.monotonic() < deadline:
+        try:
+            worker_id, pid, snapshot = results.get(timeout=max(deadline - time.monotonic(), 0.01))
+        except queue.Empty:
+            break
+        counters = {key: value for key, value in snapshot.items() if not isinstance(value, (dict, list))}
+        logging.info(f"Worker {worker_id} (pid {pid}): {counters}")
+        aggregate.merge(snapshot)
+        reported += 1
+
+    for process in workers.values():
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            process.kill()
+
+    if reported < len(workers):
+        logging.warning(f"Only {reported} of {len(workers)} workers reported their statistics.")
+    server.log_shutdown_report(aggregate)
+    print("\nServer is shutting down gracefully...")
@@ -0,0 +1,1054 @@
+import asyncio
+import errno
+import functools
+import os
+import ssl
+import socket
+import struct
+import time
+
+import compress
+import tls
+
+# Wire protocol shared by server.py and client.py.
+#
+# A framed client opens the connection by sending MAGIC followed by a HELLO
+# frame carrying "<version> <chunk_size> [codec,codec,...|-] [feature,...]".
+# The server answers with its own HELLO frame holding the negotiated values
+# and from then on every message is a frame: a fixed header (protocol
+# version, frame type, payload length) followed by exactly `length` payload
+# bytes. File bodies are streamed as DATA frames terminated by an END frame,
+# without any per-chunk acknowledgement. A CODEC frame before the first DATA
+# frame means the body is compressed with that codec (see compress.py).
+#
+# With the "sha256" feature negotiated, the END frame of a stream that runs
+# to the end of a file carries the hex SHA-256 of the whole file (not just of
+# the part this stream sent, so a resumed transfer is checked end to end).
+# Senders hash as they read and receivers as they write, so checking costs no
+# extra pass over the data. Receivers read an END payload whether or not they
+# asked for one; an empty END means "no digest".
+#
+# Clients that do not send the hello within HELLO_TIMEOUT are served with the
+# original sentinel based byte protocol through LegacyConnection. Legacy
+# clients cannot speak TLS, so on a TLS connection (see tls.py) the hello is
+# simply awaited.
+#
+# set_timeout() bounds how long any single send or receive may wait. A stream
+# cut off mid-frame cannot be resynchronised, so when the limit is hit the
+# connection is shut down and SessionTimeout (a ConnectionError) is raised.
+
+PROTOCOL_VERSION = 1
+MAGIC = b"DFOS"
+HEADER = struct.Struct('!BBQ')  # version, frame type, payload length
+
+FRAME_HELLO = 0
+FRAME_MSG = 1
+FRAME_DATA = 2
+FRAME_END = 3
+FRAME_ERROR = 4
+FRAME_CODEC = 5
+
+# Optional protocol features, offered in the hello and used if both sides list them
+FEATURE_DIGEST = 'sha256'
+FEATURES = (FEATURE_DIGEST,)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_MESSAGE_SIZE = 64 * 1024
+HELLO_TIMEOUT = 0.3
+# TCP keepalive probing once a connection has been idle (see enable_keepalive)
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 5
+
+# Downloads go out as a single DATA frame whose body is pushed by the kernel
+# with sendfile(); without it the body is copied through a large buffer.
+SENDFILE_AVAILABLE = hasattr(os, 'sendfile')
+FALLBACK_BUFFER_SIZE = 1024 * 1024
+_MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+LEGACY_CHUNK_SIZE = 1024
+LEGACY_SETTLE_DELAY = 0.1
+LEGACY_CHUNK_DELAY = 0.01
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed or unexpected frame."""
+
+
+class TransferAborted(Exception):
+    """Raised when the peer reports an error instead of the expected reply."""
+
+
+class SessionTimeout(ConnectionError):
+    """Raised when the peer made no progress within the connection's timeout."""
+
+
+def _expires(method):
+    """Turn a socket timeout in method into SessionTimeout, shutting the connection down."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except TimeoutError:
+            self.expire()
+            raise SessionTimeout("Timed out waiting for the peer.") from None
+    return wrapper
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed by peer.")
+        received += count
+    return bytes(buffer)
+
+
+def negotiate_chunk_size(requested, limit=MAX_CHUNK_SIZE):
+    return max(MIN_CHUNK_SIZE, min(int(requested), limit))
+
+
+def _parse_hello(payload):
+    """(version, chunk_size, codecs, features) from a hello; older peers send neither list."""
+    try:
+        fields = payload.decode().split()
+        codecs = fields[2].split(',') if len(fields) > 2 and fields[2] != '-' else []
+        features = fields[3].split(',') if len(fields) > 3 else []
+        return int(fields[0]), int(fields[1]), codecs, features
+    except (ValueError, IndexError):
+        raise ProtocolError(f"Malformed hello: {payload!r}")
+
+
+def _hello(version, chunk_size, codecs, features=()):
+    fields = [str(version), str(chunk_size)]
+    if codecs or features:
+        fields.append(','.join(codecs) or '-')
+    if features:
+        fields.append(','.join(features))
+    return ' '.join(fields).encode()
+
+
+def _hashed(read, hasher):
+    """read, also feeding everything it returns to hasher (if there is one)."""
+    if hasher is None:
+        return read
+
+    def read_hashed(size):
+        data = read(size)
+        hasher.update(data)
+        return data
+    return read_hashed
+
+
+class HashingWriter:
+    """File-like sink that feeds what it writes to a hashlib object on the way through."""
+
+    def __init__(self, sink, hasher):
+        self.sink = sink
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.sink.write(data)
+
+
+def _end_digest(payload):
+    return payload.decode(errors='replace').strip() or None
+
+
+def _read_at(file, offset, size):
+    try:
+        return os.pread(file.fileno(), size, offset)
+    except (OSError, ValueError):
+        file.seek(offset)
+        return file.read(size)
+
+
+def _write_decoded(decoder, data, fileobj):
+    written = 0
+    for piece in decoder.decode(data):
+        fileobj.write(piece)
+        written += len(piece)
+    return written
+
+
+def _write_final(decoder, fileobj):
+    written = 0
+    for piece in decoder.finish():
+        fileobj.write(piece)
+        written += len(piece)
+    return written
+
+
+class PositionalWriter:
+    """File-like sink that writes at an offset of an open fd with os.pwrite().
+
+    Used for striped transfers, where several connections fill different
+    ranges of the same preallocated file concurrently.
+    """
+
+    def __init__(self, fd, offset, limit):
+        self.fd = fd
+        self.position = offset
+        self.limit = limit
+
+    def write(self, data):
+        if self.position + len(data) > self.limit:
+            raise OSError(errno.EFBIG, "Write extends past the declared file size.")
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.position)
+            self.position += written
+            view = view[written:]
+        return len(data)
+
+
+class FramedConnection:
+    framed = True
+
+    def __init__(self, sock, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.version = PROTOCOL_VERSION
+        self.codecs = []
+        # Whether END frames carry digests (FEATURE_DIGEST negotiated)
+        self.digests = False
+        # Digest from the END frame of the last stream received, or None
+        self.end_digest = None
+        # Set by the server while a transfer is scheduled (bandwidth.Transfer)
+        self.pacer = None
+        self.expired = False
+        # The SSLSocket when the connection runs over TLS
+        self.ssl_object = sock if isinstance(sock, ssl.SSLSocket) else None
+
+    def set_timeout(self, seconds):
+        """Limit how long a single send or receive may wait; None waits forever."""
+        self.sock.settimeout(seconds)
+
+    def expire(self):
+        self.expired = True
+        _shutdown(self.sock)
+
+    def _pace(self, count):
+        if self.pacer is not None:
+            delay = self.pacer.consume(count)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _pick_codec(self, sample):
+        """The negotiated codec if sample compresses well enough, else None."""
+        if self.codecs and compress.worth_compressing(self.codecs[0], sample):
+            return self.codecs[0]
+        return None
+
+    def _end(self, digest=None):
+        return digest.encode() if digest and self.digests else b""
+
+    @_expires
+    def send_frame(self, frame_type, payload=b""):
+        self.sock.sendall(HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload)
+
+    @_expires
+    def recv_header(self):
+        version, frame_type, length = HEADER.unpack(recv_exact(self.sock, HEADER.size))
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        return frame_type, length
+
+    @_expires
+    def recv_frame(self):
+        frame_type, length = self.recv_header()
+        if frame_type != FRAME_DATA and length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Control frame too large ({length} bytes)")
+        return frame_type, recv_exact(self.sock, length) if length else b""
+
+    def send_msg(self, text):
+        self.send_frame(FRAME_MSG, text.encode())
+
+    def recv_msg(self):
+        frame_type, payload = self.recv_frame()
+        if frame_type == FRAME_ERROR:
+            raise TransferAborted(payload.decode(errors='replace'))
+        if frame_type != FRAME_MSG:
+            raise ProtocolError(f"Expected a message frame, got type {frame_type}")
+        return payload.decode().strip()
+
+    def send_error(self, text):
+        self.send_frame(FRAME_ERROR, text.encode())
+
+    def send_stream(self, fileobj, progress=None, hasher=None):
+        """Stream fileobj as DATA frames followed by END; returns the byte count.
+
+        hasher (a hashlib object, possibly already fed the bytes before this
+        stream) is updated with everything read, and its digest goes in END.
+        """
+        read = _hashed(fileobj.read, hasher)
+        chunk = read(self.chunk_size)
+        codec = self._pick_codec(chunk)
+        if codec:
+            total = self._send_compressed(codec, chunk, lambda: read(self.chunk_size), progress)
+        else:
+            total = 0
+            while chunk:
+                self.send_frame(FRAME_DATA, chunk)
+                total += len(chunk)
+                self._pace(len(chunk))
+                if progress:
+                    progress(total)
+                chunk = read(self.chunk_size)
+        self.send_frame(FRAME_END, self._end(hasher and hasher.hexdigest()))
+        return total
+
+    def _send_compressed(self, codec, chunk, read_next, progress=None):
+        self.send_frame(FRAME_CODEC, codec.encode())
+        compressor = compress.compressor(codec)
+        pending = bytearray()
+        total = 0
+        while chunk:
+            pending += compressor.compress(chunk)
+            total += len(chunk)
+            if len(pending) >= self.chunk_size:
+                self.send_frame(FRAME_DATA, pending)
+                self._pace(len(pending))
+                pending.clear()
+            if progress:
+                progress(total)
+            chunk = read_next()
+        pending += compressor.flush()
+        if pending:
+            self.send_frame(FRAME_DATA, pending)
+        return total
+
+    @_expires
+    def send_file(self, file, offset=0, count=None, zero_copy=True, digest=None):
+        """Send count bytes of file from offset as one DATA frame followed by END.
+
+        When a codec is negotiated and the start of the range compresses, the
+        range is streamed compressed instead. digest, the stored hex SHA-256
+        of the whole file, goes in END.
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if self.codecs and count:
+            sample = _read_at(file, offset, min(count, self.chunk_size))
+            codec = self._pick_codec(sample)
+            if codec:
+                file.seek(offset + len(sample))
+                remaining = count - len(sample)
+
+                def read_next():
+                    nonlocal remaining
+                    data = file.read(min(self.chunk_size, remaining))
+                    remaining -= len(data)
+                    return data
+
+                sent = self._send_compressed(codec, sample, read_next)
+                if sent != count:
+                    raise ConnectionError(f"File shrank during transfer ({sent}/{count} bytes sent)")
+                self.send_frame(FRAME_END, self._end(digest))
+                return count
+        header = HEADER.pack(PROTOCOL_VERSION, FRAME_DATA, count)
+        zero_copy = zero_copy and SENDFILE_AVAILABLE
+        if self.ssl_object is not None and not (zero_copy and tls.kernel_send(self.sock)):
+            # Every byte goes through OpenSSL: large writes, header included, fill whole records
+            sent = self._send_buffered(file, offset, count, header)
+        else:
+            self.sock.sendall(header, 0 if self.ssl_object is not None else _MSG_MORE)
+            sent = count and (self._sendfile(file, offset, count) if zero_copy
+                              else self._send_buffered(file, offset, count))
+        if sent != count:
+            raise ConnectionError(f"File shrank during transfer ({sent}/{count} bytes sent)")
+        self.send_frame(FRAME_END, self._end(digest))
+        return count
+
+    def _sendfile(self, file, offset, count):
+        # The plain socket method: SSLSocket.sendfile() copies through user space even when
+        # the kernel does the encryption (tls.kernel_send())
+        sendfile = socket.socket.sendfile
+        if self.pacer is None:
+            return sendfile(self.sock, file, offset, count)
+        # Paced: hand the kernel one chunk at a time
+        sent = 0
+        while sent < count:
+            step = sendfile(self.sock, file, offset + sent, min(count - sent, self.chunk_size))
+            if not step:
+                break
+            sent += step
+            self._pace(step)
+        return sent
+
+    def _send_buffered(self, file, offset, count, head=b""):
+        """Copy count bytes of file from offset to the socket through a large buffer, head first."""
+        size = min(count, FALLBACK_BUFFER_SIZE if self.pacer is None else self.chunk_size)
+        buffer = bytearray(len(head) + size)
+        view = memoryview(buffer)
+        view[:len(head)] = head
+        start = len(head)
+        file.seek(offset)
+        sent = 0
+        while sent < count:
+            read = file.readinto(view[start:start + min(count - sent, size)])
+            if not read:
+                break
+            self.sock.sendall(view[:start + read])
+            sent += read
+            self._pace(read)
+            start = 0
+        if start:
+            self.sock.sendall(view[:start])
+        return sent
+
+    def send_preview(self, data, digest=None):
+        if len(data):
+            self.send_frame(FRAME_DATA, data)
+        self.send_frame(FRAME_END, self._end(digest))
+
+    @_expires
+    def recv_stream(self, fileobj, progress=None):
+        """Write incoming DATA frames to fileobj until END; returns the byte count.
+
+        A failing write does not desynchronise the connection: the rest of the
+        stream is drained and the write error is raised afterwards. A digest
+        in the END frame is left in end_digest.
+        """
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        total = 0
+        write_error = None
+        decoder = None
+        self.end_digest = None
+        while True:
+            frame_type, length = self.recv_header()
+            if frame_type == FRAME_END:
+                if length > MAX_MESSAGE_SIZE:
+                    raise ProtocolError(f"END frame too large ({length} bytes)")
+                if length:
+                    self.end_digest = _end_digest(recv_exact(self.sock, length))
+                break
+            if frame_type == FRAME_ERROR:
+                raise TransferAborted(recv_exact(self.sock, length).decode(errors='replace'))
+            if frame_type == FRAME_CODEC:
+                decoder = self._decoder(recv_exact(self.sock, length))
+                continue
+            if frame_type != FRAME_DATA:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in data stream")
+            while length:
+                count = self.sock.recv_into(view, min(length, len(buffer)))
+                if not count:
+                    raise ConnectionError("Connection closed by peer.")
+                self._pace(count)
+                if write_error is None:
+                    try:
+                        if decoder:
+                            total += _write_decoded(decoder, view[:count], fileobj)
+                        else:
+                            fileobj.write(view[:count])
+                            total += count
+                    except OSError as e:
+                        write_error = e
+                length -= count
+            if progress:
+                progress(total)
+        if decoder and write_error is None:
+            try:
+                total += _write_final(decoder, fileobj)
+            except OSError as e:
+                write_error = e
+        if write_error is not None:
+            raise write_error
+        return total
+
+    def _decoder(self, payload):
+        name = payload.decode(errors='replace')
+        if name not in self.codecs:
+            raise ProtocolError(f"Codec {name!r} was not negotiated")
+        return compress.StreamDecoder(name)
+
+    def close(self):
+        self.sock.close()
+
+
+class LegacyConnection:
+    """Original byte protocol: raw messages, per-chunk acks and sentinels."""
+
+    framed = False
+    ssl_object = None
+    chunk_size = LEGACY_CHUNK_SIZE
+    # No digests in this protocol
+    digests = False
+    end_digest = None
+
+    expired = False
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._sent_last = False
+
+    def set_timeout(self, seconds):
+        self.sock.settimeout(seconds)
+
+    def expire(self):
+        self.expired = True
+        _shutdown(self.sock)
+
+    def _settle(self):
+        # Old clients read each reply with a single recv(1024), so two
+        # consecutive sends must not coalesce into one segment.
+        if self._sent_last:
+            time.sleep(LEGACY_SETTLE_DELAY)
+        self._sent_last = True
+
+    @_expires
+    def send_msg(self, text):
+        self._settle()
+        self.sock.sendall(text.encode())
+
+    @_expires
+    def recv_msg(self):
+        self._sent_last = False
+        data = self.sock.recv(1024)
+        if not data:
+            raise ConnectionError("Connection closed by peer.")
+        return data.decode().strip()
+
+    @_expires
+    def send_error(self, text):
+        self._settle()
+        self.sock.sendall(text.encode())
+
+    @_expires
+    def send_stream(self, fileobj, progress=None, count=None):
+        self._settle()
+        total = 0
+        while count is None or total < count:
+            size = LEGACY_CHUNK_SIZE if count is None else min(LEGACY_CHUNK_SIZE, count - total)
+            chunk = fileobj.read(size)
+            if not chunk:
+                break
+            self.sock.sendall(chunk)
+            total += len(chunk)
+            time.sleep(LEGACY_CHUNK_DELAY)
+        time.sleep(LEGACY_SETTLE_DELAY)
+        self.sock.sendall(b"END_OF_FILE")
+        return total
+
+    def send_file(self, file, offset=0, count=None, zero_copy=True, digest=None):
+        # Old clients need the paced 1 KiB stream; there is no zero-copy path.
+        file.seek(offset)
+        return self.send_stream(file, count=count)
+
+    @_expires
+    def send_preview(self, data, digest=None):
+        self._settle()
+        self.sock.sendall(data)
+        time.sleep(LEGACY_SETTLE_DELAY)
+        self.sock.sendall(b"END_OF_PREVIEW")
+
+    @_expires
+    def recv_stream(self, fileobj, progress=None):
+        self._sent_last = False
+        total = 0
+        while True:
+            chunk = self.sock.recv(LEGACY_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("Connection closed by peer.")
+            if chunk == b'END_OF_FILE':
+                return total
+            if chunk == b'UPLOAD_ERROR':
+                raise TransferAborted("UPLOAD_ERROR")
+            fileobj.write(chunk)
+            total += len(chunk)
+            self.sock.sendall(b"Chunk received.")
+
+    def close(self):
+        self.sock.close()
+
+
+def _enable_nodelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def enable_keepalive(sock, idle, interval=KEEPALIVE_INTERVAL, probes=KEEPALIVE_PROBES):
+    """Have the kernel probe a silent peer after idle seconds and drop it after probes unanswered ones."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # The tuning options are Linux names; elsewhere the system defaults apply
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', probes)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(int(value), 1))
+    except OSError:
+        pass
+
+
+def server_handshake(sock, max_chunk_size=MAX_CHUNK_SIZE, timeout=HELLO_TIMEOUT):
+    """Return a FramedConnection if the client opens with a hello, else a LegacyConnection.
+
+    A socket wrapped by tls.wrap_server() has its TLS handshake run here.
+    """
+    if isinstance(sock, ssl.SSLSocket):
+        sock.settimeout(tls.HANDSHAKE_TIMEOUT)
+        try:
+            sock.do_handshake()
+            head = recv_exact(sock, len(MAGIC))
+        except socket.timeout:
+            raise ConnectionError("Timed out waiting for the TLS handshake and hello.") from None
+        finally:
+            sock.settimeout(None)
+        if head != MAGIC:
+            raise ProtocolError(f"Unexpected data before authentication: {head!r}")
+    else:
+        sock.settimeout(timeout)
+        try:
+            head = sock.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+        except socket.timeout:
+            head = b""
+        finally:
+            sock.settimeout(None)
+
+        if head != MAGIC:
+            return LegacyConnection(sock)
+        recv_exact(sock, len(MAGIC))
+
+    conn = FramedConnection(sock)
+    frame_type, payload = conn.recv_frame()
+    if frame_type != FRAME_HELLO:
+        raise ProtocolError(f"Expected hello, got frame type {frame_type}")
+    version, requested, offered, features = _parse_hello(payload)
+    conn.version = min(version, PROTOCOL_VERSION)
+    conn.chunk_size = negotiate_chunk_size(requested, max_chunk_size)
+    conn.codecs = compress.negotiate(offered)
+    conn.digests = FEATURE_DIGEST in features
+    _enable_nodelay(sock)
+    conn.send_frame(FRAME_HELLO, _hello(conn.version, conn.chunk_size, conn.codecs, _accepted(features)))
+    return conn
+
+
+def _accepted(features):
+    return [name for name in features if name in FEATURES]
+
+
+def client_handshake(sock, chunk_size=DEFAULT_CHUNK_SIZE, codecs=(), features=FEATURES):
+    """Open a framed session; returns the connection with the negotiated chunk size, codecs and features."""
+    _enable_nodelay(sock)
+    hello = _hello(PROTOCOL_VERSION, chunk_size, codecs, features)
+    sock.sendall(MAGIC + HEADER.pack(PROTOCOL_VERSION, FRAME_HELLO, len(hello)) + hello)
+    conn = FramedConnection(sock, chunk_size)
+    frame_type, payload = conn.recv_frame()
+    if frame_type != FRAME_HELLO:
+        raise ProtocolError(f"Expected hello, got frame type {frame_type}")
+    conn.version, conn.chunk_size, accepted, agreed = _parse_hello(payload)
+    conn.codecs = [name for name in accepted if name in codecs]
+    conn.digests = FEATURE_DIGEST in agreed and FEATURE_DIGEST in features
+    return conn
+
+
+# asyncio counterparts used by async_server.py and async_dfos_client.py.
+# Blocking file reads and writes are pushed to `executor` so the event loop
+# only ever waits on sockets.
+
+async def _run_io(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def _read_exact(reader, size):
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed by peer.")
+
+
+class AsyncFramedConnection:
+    framed = True
+
+    def __init__(self, reader, writer, chunk_size=DEFAULT_CHUNK_SIZE, executor=None):
+        self.reader = reader
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.version = PROTOCOL_VERSION
+        self.codecs = []
+        self.digests = False
+        self.end_digest = None
+        self.pacer = None
+        self.timeout = None
+        self.expired = False
+        # The SSLObject when the connection runs over TLS
+        self.ssl_object = writer.get_extra_info('ssl_object')
+
+    def set_timeout(self, seconds):
+        """Limit how long a single send or receive may wait; None waits forever."""
+        self.timeout = seconds
+
+    def expire(self):
+        self.expired = True
+        self.writer.transport.abort()
+
+    async def _io(self, awaitable):
+        if self.timeout is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self.expire()
+            raise SessionTimeout("Timed out waiting for the peer.") from None
+
+    async def _pace(self, count):
+        if self.pacer is not None:
+            delay = self.pacer.consume(count)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _pick_codec(self, sample):
+        if self.codecs and await _run_io(self.executor, compress.worth_compressing, self.codecs[0], sample):
+            return self.codecs[0]
+        return None
+
+    def _end(self, digest=None):
+        return digest.encode() if digest and self.digests else b""
+
+    async def send_frame(self, frame_type, payload=b""):
+        self.writer.write(HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload)
+        await self._io(self.writer.drain())
+
+    async def recv_header(self):
+        version, frame_type, length = HEADER.unpack(await self._io(_read_exact(self.reader, HEADER.size)))
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        return frame_type, length
+
+    async def recv_frame(self):
+        frame_type, length = await self.recv_header()
+        if frame_type != FRAME_DATA and length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Control frame too large ({length} bytes)")
+        return frame_type, await self._io(_read_exact(self.reader, length)) if length else b""
+
+    async def send_msg(self, text):
+        await self.send_frame(FRAME_MSG, text.encode())
+
+    async def recv_msg(self):
+        frame_type, payload = await self.recv_frame()
+        if frame_type == FRAME_ERROR:
+            raise TransferAborted(payload.decode(errors='replace'))
+        if frame_type != FRAME_MSG:
+            raise ProtocolError(f"Expected a message frame, got type {frame_type}")
+        return payload.decode().strip()
+
+    async def send_error(self, text):
+        await self.send_frame(FRAME_ERROR, text.encode())
+
+    async def send_stream(self, fileobj, progress=None, hasher=None):
+        read = _hashed(fileobj.read, hasher)
+        chunk = await _run_io(self.executor, read, self.chunk_size)
+        codec = await self._pick_codec(chunk)
+        if codec:
+            total = await self._send_compressed(codec, chunk, read, progress)
+        else:
+            total = 0
+            while chunk:
+                await self.send_frame(FRAME_DATA, chunk)
+                total += len(chunk)
+                await self._pace(len(chunk))
+                if progress:
+                    progress(total)
+                chunk = await _run_io(self.executor, read, self.chunk_size)
+        await self.send_frame(FRAME_END, self._end(hasher and hasher.hexdigest()))
+        return total
+
+    async def _send_compressed(self, codec, chunk, read, progress=None, limit=None):
+        """Compressed stream of chunk plus read(n) results, up to limit bytes in all."""
+        await self.send_frame(FRAME_CODEC, codec.encode())
+        compressor = compress.compressor(codec)
+        pending = bytearray()
+        total = 0
+        while chunk:
+            pending += await _run_io(self.executor, compressor.compress, chunk)
+            total += len(chunk)
+            if len(pending) >= self.chunk_size:
+                await self.send_frame(FRAME_DATA, pending)
+                await self._pace(len(pending))
+                pending.clear()
+            if progress:
+                progress(total)
+            size = self.chunk_size if limit is None else min(self.chunk_size, limit - total)
+            chunk = await _run_io(self.executor, read, size) if size else b""
+        pending += compressor.flush()
+        if pending:
+            await self.send_frame(FRAME_DATA, pending)
+        return total
+
+    async def send_file(self, file, offset=0, count=None, zero_copy=True, digest=None):
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if self.codecs and count:
+            sample = await _run_io(self.executor, _read_at, file, offset, min(count, self.chunk_size))
+            codec = await self._pick_codec(sample)
+            if codec:
+                await _run_io(self.executor, file.seek, offset + len(sample))
+                sent = await self._send_compressed(codec, sample, file.read, limit=count)
+                if sent != count:
+                    raise ConnectionError(f"File shrank during transfer ({sent}/{count} bytes sent)")
+                await self.send_frame(FRAME_END, self._end(digest))
+                return count
+        self.writer.write(HEADER.pack(PROTOCOL_VERSION, FRAME_DATA, count))
+        await self._io(self.writer.drain())
+        # asyncio's TLS transport encrypts in user space: no sendfile() on it
+        zero_copy = zero_copy and self.ssl_object is None
+        if count:
+            loop = asyncio.get_running_loop()
+            if zero_copy and SENDFILE_AVAILABLE and self.pacer is None and self.timeout is None:
+                sent = await loop.sendfile(self.writer.transport, file, offset, count)
+            elif zero_copy and SENDFILE_AVAILABLE:
+                # Sliced, so pacing and the timeout apply per chunk rather than to the whole file
+                step_size = self.chunk_size if self.pacer is not None else FALLBACK_BUFFER_SIZE
+                sent = 0
+                while sent < count:
+                    step = await self._io(loop.sendfile(self.writer.transport, file, offset + sent,
+                                                        min(count - sent, step_size)))
+                    if not step:
+                        break
+                    sent += step
+                    await self._pace(step)
+            else:
+                sent = 0
+                step_size = FALLBACK_BUFFER_SIZE if self.pacer is None else self.chunk_size
+                await _run_io(self.executor, file.seek, offset)
+                while sent < count:
+                    chunk = await _run_io(self.executor, file.read, min(count - sent, step_size))
+                    if not chunk:
+                        break
+                    self.writer.write(chunk)
+                    await self._io(self.writer.drain())
+                    sent += len(chunk)
+                    await self._pace(len(chunk))
+            if sent != count:
+                raise ConnectionError(f"File shrank during transfer ({sent}/{count} bytes sent)")
+        await self.send_frame(FRAME_END, self._end(digest))
+        return count
+
+    async def send_preview(self, data, digest=None):
+        if len(data):
+            await self.send_frame(FRAME_DATA, data)
+        await self.send_frame(FRAME_END, self._end(digest))
+
+    async def recv_stream(self, fileobj, progress=None):
+        total = 0
+        write_error = None
+        decoder = None
+        self.end_digest = None
+        while True:
+            frame_type, length = await self.recv_header()
+            if frame_type == FRAME_END:
+                if length > MAX_MESSAGE_SIZE:
+                    raise ProtocolError(f"END frame too large ({length} bytes)")
+                if length:
+                    self.end_digest = _end_digest(await self._io(_read_exact(self.reader, length)))
+                break
+            if frame_type == FRAME_ERROR:
+                payload = await self._io(_read_exact(self.reader, length))
+                raise TransferAborted(payload.decode(errors='replace'))
+            if frame_type == FRAME_CODEC:
+                name = (await self._io(_read_exact(self.reader, length))).decode(errors='replace')
+                if name not in self.codecs:
+                    raise ProtocolError(f"Codec {name!r} was not negotiated")
+                decoder = compress.StreamDecoder(name)
+                continue
+            if frame_type != FRAME_DATA:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in data stream")
+            while length:
+                data = await self._io(self.reader.read(min(length, self.chunk_size)))
+                if not data:
+                    raise ConnectionError("Connection closed by peer.")
+                await self._pace(len(data))
+                if write_error is None:
+                    try:
+                        if decoder:
+                            total += await _run_io(self.executor, _write_decoded, decoder, data, fileobj)
+                        else:
+                            await _run_io(self.executor, fileobj.write, data)
+                            total += len(data)
+                    except OSError as e:
+                        write_error = e
+                length -= len(data)
+            if progress:
+                progress(total)
+        if decoder and write_error is None:
+            try:
+                total += await _run_io(self.executor, _write_final, decoder, fileobj)
+            except OSError as e:
+                write_error = e
+        if write_error is not None:
+            raise write_error
+        return total
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncLegacyConnection:
+    framed = False
+    ssl_object = None
+    chunk_size = LEGACY_CHUNK_SIZE
+    digests = False
+    end_digest = None
+
+    def __init__(self, reader, writer, executor=None):
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self._sent_last = False
+        self.timeout = None
+        self.expired = False
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def expire(self):
+        self.expired = True
+        self.writer.transport.abort()
+
+    async def _io(self, awaitable):
+        if self.timeout is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self.expire()
+            raise SessionTimeout("Timed out waiting for the peer.") from None
+
+    async def _settle(self):
+        if self._sent_last:
+            await asyncio.sleep(LEGACY_SETTLE_DELAY)
+        self._sent_last = True
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self._io(self.writer.drain())
+
+    async def send_msg(self, text):
+        await self._settle()
+        await self._send(text.encode())
+
+    async def recv_msg(self):
+        self._sent_last = False
+        data = await self._io(self.reader.read(1024))
+        if not data:
+            raise ConnectionError("Connection closed by peer.")
+        return data.decode().strip()
+
+    async def send_error(self, text):
+        await self._settle()
+        await self._send(text.encode())
+
+    async def send_stream(self, fileobj, progress=None, count=None):
+        await self._settle()
+        total = 0
+        while count is None or total < count:
+            size = LEGACY_CHUNK_SIZE if count is None else min(LEGACY_CHUNK_SIZE, count - total)
+            chunk = await _run_io(self.executor, fileobj.read, size)
+            if not chunk:
+                break
+            await self._send(chunk)
+            total += len(chunk)
+            await asyncio.sleep(LEGACY_CHUNK_DELAY)
+        await asyncio.sleep(LEGACY_SETTLE_DELAY)
+        await self._send(b"END_OF_FILE")
+        return total
+
+    async def send_file(self, file, offset=0, count=None, zero_copy=True, digest=None):
+        await _run_io(self.executor, file.seek, offset)
+        return await self.send_stream(file, count=count)
+
+    async def send_preview(self, data, digest=None):
+        await self._settle()
+        await self._send(bytes(data))
+        await asyncio.sleep(LEGACY_SETTLE_DELAY)
+        await self._send(b"END_OF_PREVIEW")
+
+    async def recv_stream(self, fileobj, progress=None):
+        self._sent_last = False
+        total = 0
+        while True:
+            chunk = await self._io(self.reader.read(LEGACY_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed by peer.")
+            if chunk == b'END_OF_FILE':
+                return total
+            if chunk == b'UPLOAD_ERROR':
+                raise TransferAborted("UPLOAD_ERROR")
+            await _run_io(self.executor, fileobj.write, chunk)
+            total += len(chunk)
+            await self._send(b"Chunk received.")
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def async_server_handshake(reader, writer, executor=None, max_chunk_size=MAX_CHUNK_SIZE,
+                                 timeout=HELLO_TIMEOUT):
+    """asyncio version of server_handshake()."""
+    secure = writer.get_extra_info('ssl_object') is not None
+    try:
+        head = await asyncio.wait_for(reader.readexactly(len(MAGIC)), tls.HANDSHAKE_TIMEOUT if secure else timeout)
+    except asyncio.TimeoutError:
+        if secure:
+            raise ConnectionError("Timed out waiting for the hello.") from None
+        return AsyncLegacyConnection(reader, writer, executor)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed by peer.")
+    if head != MAGIC:
+        raise ProtocolError(f"Unexpected data before authentication: {head!r}")
+
+    conn = AsyncFramedConnection(reader, writer, executor=executor)
+    frame_type, payload = await conn.recv_frame()
+    if frame_type != FRAME_HELLO:
+        raise ProtocolError(f"Expected hello, got frame type {frame_type}")
+    version, requested, offered, features = _parse_hello(payload)
+    conn.version = min(version, PROTOCOL_VERSION)
+    conn.chunk_size = negotiate_chunk_size(requested, max_chunk_size)
+    conn.codecs = compress.negotiate(offered)
+    conn.digests = FEATURE_DIGEST in features
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        _enable_nodelay(sock)
+    await conn.send_frame(FRAME_HELLO, _hello(conn.version, conn.chunk_size, conn.codecs, _accepted(features)))
+    return conn
+
+
+async def async_client_handshake(reader, writer, chunk_size=DEFAULT_CHUNK_SIZE, codecs=(), executor=None,
+                                 features=FEATURES):
+    """asyncio version of client_handshake()."""
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        _enable_nodelay(sock)
+    hello = _hello(PROTOCOL_VERSION, chunk_size, codecs, features)
+    writer.write(MAGIC + HEADER.pack(PROTOCOL_VERSION, FRAME_HELLO, len(hello)) + hello)
+    conn = AsyncFramedConnection(reader, writer, chunk_size, executor)
+    frame_type, payload = await conn.recv_frame()
+    if frame_type != FRAME_HELLO:
+        raise ProtocolError(f"Expected hello, got frame type {frame_type}")
+    conn.version, conn.chunk_size, accepted, agreed = _parse_hello(payload)
+    conn.codecs = [name for name in accepted if name in codecs]
+    conn.digests = FEATURE_DIGEST in agreed and FEATURE_DIGEST in features
+    return conn
@@ -0,0 +1,207 @@
+import errno
+import logging
+import threading
+import time
+
+import logpipe
+import storage
+
+# Per-user storage quotas: a byte limit ("quota=" in id_passwd.txt, else
+# --quota-bytes) and a file-count limit ("max_files=", else --quota-files).
+#
+# Usage comes from the counters the metadata index keeps up to date on every
+# commit, overwrite and delete (see metadata.py), so a check is one lookup
+# rather than a directory walk. An upload reserves room before its first byte:
+# its declared size, if the command has one, and otherwise whatever it writes,
+# claimed in GRANT_SIZE steps as the data arrives. Reservations are released
+# when the upload commits (and its size is in the counters) or fails. Sizes
+# are logical: what the user uploaded, before compression or deduplication.
+#
+# A Scrubber thread periodically walks each user's files and corrects the
+# index and counters for anything changed behind the server's back.
+
+# Bytes an undeclared upload claims at a time while it streams
+GRANT_SIZE = 8 * 1024 * 1024
+SCRUB_INTERVAL = 3600
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    """'500M', '10G' (bytes) -> int; '0', 'none' or '' -> None (unlimited)."""
+    text = str(text).strip().upper().removesuffix('B')
+    if text in ('', '0', 'NONE'):
+        return None
+    unit = text[-1] if text[-1] in _UNITS else ''
+    value = int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+    if value <= 0:
+        raise ValueError(f"Invalid size {text!r}")
+    return value
+
+
+class QuotaExceeded(OSError):
+    """An upload would take the user past a quota.
+
+    An OSError, so a stream that hits it mid-way is drained like any other
+    write error and the connection stays usable.
+    """
+
+    def __init__(self, message):
+        super().__init__(errno.EDQUOT, message)
+
+    def __str__(self):
+        return self.strerror
+
+
+class Reservation:
+    """Room held for one upload; also a context manager that releases it."""
+
+    def __init__(self, manager, user, existing=0, new_file=False):
+        self.manager = manager
+        self.user = user
+        # Size of the file being replaced; it stops counting once this one commits
+        self.existing = existing
+        self.new_file = new_file
+        self.size = 0
+        self.written = 0
+
+    def writer(self, sink):
+        """sink, wrapped so that writing past the reserved size claims more room or fails."""
+        return _QuotaWriter(sink, self) if self.manager is not None else sink
+
+    def release(self):
+        if self.manager is not None:
+            self.manager._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class _QuotaWriter:
+    def __init__(self, sink, reservation):
+        self.sink = sink
+        self.reservation = reservation
+
+    def write(self, data):
+        reservation = self.reservation
+        reservation.written += len(data)
+        if reservation.written > reservation.size:
+            reservation.manager._grow(reservation, reservation.written, GRANT_SIZE)
+        return self.sink.write(data)
+
+
+class QuotaManager:
+    def __init__(self, max_bytes=None, max_files=None, user_options=None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # user -> {'quota': '10G', 'max_files': '1000'}, e.g. CredentialStore.options
+        self.user_options = user_options or (lambda user: {})
+        # user -> Reservations of uploads in progress
+        self.reserved = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes=None, max_files=None, user_options=None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        if user_options is not None:
+            self.user_options = user_options
+
+    def limits(self, user):
+        """(max bytes, max files) for user; None means no limit."""
+        options = self.user_options(user)
+        max_bytes, max_files = self.max_bytes, self.max_files
+        try:
+            if 'quota' in options:
+                max_bytes = parse_size(options['quota'])
+            if 'max_files' in options:
+                max_files = int(options['max_files']) or None
+        except ValueError:
+            logging.warning(f"Ignoring invalid quota options for user {user}: {options}")
+        return max_bytes, max_files
+
+    def reserve(self, user, filename, size=0):
+        """Reserve room for an upload of size bytes (0 if not declared) to filename; raises QuotaExceeded."""
+        max_bytes, max_files = self.limits(user)
+        if max_bytes is None and max_files is None:
+            return Reservation(None, user)
+        existing = storage.stored_size(user, filename)
+        reservation = Reservation(self, user, existing or 0, existing is None)
+        with self._lock:
+            others = self.reserved.setdefault(user, [])
+            pending_files = sum(r.new_file for r in others)
+            others.append(reservation)
+        try:
+            if reservation.new_file and max_files is not None:
+                files = storage.usage(user)[1] + pending_files
+                if files >= max_files:
+                    raise QuotaExceeded(f"Quota exceeded: {files} of {max_files} files stored.")
+            self._grow(reservation, size)
+        except BaseException:
+            reservation.release()
+            raise
+        return reservation
+
+    def _grow(self, reservation, size, headroom=0):
+        """Raise reservation to size bytes, plus up to headroom more if the quota has room for it."""
+        max_bytes = self.limits(reservation.user)[0]
+        if max_bytes is None:
+            reservation.size = size + headroom
+            return
+        used = storage.usage(reservation.user)[0]
+        with self._lock:
+            # Pending overwrites only free space once they commit
+            pending = sum(max(r.size - r.existing, 0) for r in self.reserved.get(reservation.user, ())
+                          if r is not reservation)
+        available = max_bytes - used - pending + reservation.existing
+        if size > available:
+            raise QuotaExceeded(f"Quota exceeded: {used} of {max_bytes} bytes used"
+                                f"{f' and {pending} reserved' if pending else ''}; upload needs {size}.")
+        reservation.size = min(size + headroom, available)
+
+    def _release(self, reservation):
+        with self._lock:
+            reservations = self.reserved.get(reservation.user, [])
+            if reservation in reservations:
+                reservations.remove(reservation)
+            if not reservations:
+                self.reserved.pop(reservation.user, None)
+
+
+class Scrubber:
+    """Background thread that reconciles every user's index rows and usage with the disk."""
+
+    def __init__(self, interval=SCRUB_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='dfos-quota-scrub', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.scrub()
+
+    def scrub(self):
+        started = time.monotonic()
+        corrected = 0
+        for user in storage.stored_users():
+            try:
+                before, after = storage.scrub_user(user)
+            except Exception as e:
+                logpipe.event("Quota scrub failed for %(user)s: %(error)s", logging.ERROR, user=user,
+                              op='scrub', error=str(e), outcome='error')
+                continue
+            if before != after:
+                corrected += 1
+                logpipe.event("Corrected usage of %(user)s from %(before)s to %(after)s (bytes, files)",
+                              logging.WARNING, user=user, op='scrub', before=before, after=after,
+                              outcome='corrected')
+        logpipe.event("Quota scrub finished: %(corrected)s users corrected", op='scrub', corrected=corrected,
+                      duration=time.monotonic() - started, outcome='ok')
@@ -4,19 +4,29 @@ import os
 import time
 import signal
 import sys
+import argparse
 import logging
+import mmap
+import io
+import json
 import psutil
+import selectors
 from concurrent.futures import ThreadPoolExecutor
-
-# Configure performance logging
-logging.basicConfig(
-    level=logging.INFO, 
-    format='%(asctime)s - %(levelname)s: %(message)s',
-    handlers=[
-        logging.FileHandler('server_performance.log'),  # Writes to file
-        logging.StreamHandler()  # Displays in terminal
-    ]
-)
+import protocol
+import storage
+import delta
+import chunkstore
+import compress
+import metrics
+import logpipe
+import bandwidth
+import admission
+import quota
+import handoff
+import durability
+import versions
+import tls
+from credentials import CredentialStore, LoginThrottle, TICKET_PREFIX, verify_ticket
 
 # Global performance tracking variables
 class PerformanceTracker:
@@ -24,6 +34,24 @@ class PerformanceTracker:
         self.active_connections = 0
         self.total_connections = 0
         self.file_transfers = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # Sessions that waited for a slot, were turned away, or were closed for inactivity
+        self.sessions_queued = 0
+        self.sessions_rejected = 0
+        self.sessions_reaped = 0
+        # operation -> Histogram; created on first use
+        self.latency = {}
+        self.throughput = {}
+        self.queue_wait = {}
+        self.sampler = None
+        # bandwidth.BandwidthScheduler whose active transfers are reported
+        self.scheduler = None
+        # admission.AdmissionController whose queue length is reported
+        self.admission = None
+        # Resource figures merged in from worker processes
+        self.resources = {}
         self.transfer_lock = threading.Lock()
 
     def increment_connections(self):
@@ -39,269 +67,1390 @@ class PerformanceTracker:
         with self.transfer_lock:
             self.file_transfers += 1
 
+    def log_cache(self, hits=0, misses=0, evictions=0):
+        with self.transfer_lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+            self.cache_evictions += evictions
+
+    def log_session(self, outcome):
+        """Count a session that was 'queued', 'rejected' or 'reaped'."""
+        with self.transfer_lock:
+            key = f'sessions_{outcome}'
+            setattr(self, key, getattr(self, key) + 1)
+
+    def log_operation(self, operation, duration, size=None):
+        """Record how long an operation took and, for transfers, its bytes per second."""
+        with self.transfer_lock:
+            self._histogram(self.latency, operation, metrics.LATENCY_BUCKETS).observe(duration)
+            if size and duration > 0:
+                self._histogram(self.throughput, operation, metrics.THROUGHPUT_BUCKETS).observe(size / duration)
+
+    def log_queue_wait(self, pool, seconds):
+        with self.transfer_lock:
+            self._histogram(self.queue_wait, pool, metrics.QUEUE_WAIT_BUCKETS).observe(seconds)
+
+    @staticmethod
+    def _histogram(family, name, buckets):
+        histogram = family.get(name)
+        if histogram is None:
+            histogram = family[name] = metrics.Histogram(buckets)
+        return histogram
+
+    def start_sampler(self, interval=metrics.SAMPLE_INTERVAL):
+        self.sampler = metrics.ResourceSampler(interval).start()
+
+    def snapshot(self):
+        resources = self.sampler.summary() if self.sampler else {}
+        with self.transfer_lock:
+            return {
+                'active_connections': self.active_connections,
+                'total_connections': self.total_connections,
+                'file_transfers': self.file_transfers,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'cache_evictions': self.cache_evictions,
+                'sessions_queued': self.sessions_queued,
+                'sessions_rejected': self.sessions_rejected,
+                'sessions_reaped': self.sessions_reaped,
+                'sessions_waiting': self.admission.queue_length() if self.admission else 0,
+                'latency': {name: h.snapshot() for name, h in self.latency.items()},
+                'throughput': {name: h.snapshot() for name, h in self.throughput.items()},
+                'queue_wait': {name: h.snapshot() for name, h in self.queue_wait.items()},
+                'resources': resources or dict(self.resources),
+                'transfers': self.scheduler.snapshot() if self.scheduler else [],
+            }
+
+    def merge(self, snapshot):
+        """Add another tracker's snapshot (e.g. from a worker process) into this one."""
+        with self.transfer_lock:
+            self.active_connections += snapshot['active_connections']
+            self.total_connections += snapshot['total_connections']
+            self.file_transfers += snapshot['file_transfers']
+            self.cache_hits += snapshot['cache_hits']
+            self.cache_misses += snapshot['cache_misses']
+            self.cache_evictions += snapshot['cache_evictions']
+            for key in ('sessions_queued', 'sessions_rejected', 'sessions_reaped'):
+                setattr(self, key, getattr(self, key) + snapshot[key])
+            for key in ('latency', 'throughput', 'queue_wait'):
+                family = getattr(self, key)
+                for name, histogram in snapshot[key].items():
+                    self._histogram(family, name, histogram['buckets']).merge(histogram)
+            # Workers are separate processes, so their usage adds up
+            for key, value in snapshot['resources'].items():
+                self.resources[key] = self.resources.get(key, 0) + value
+
 performance_tracker = PerformanceTracker()
 
-def load_credentials(filename='id_passwd.txt'):
-    credentials = {}
-    with open(filename, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if line and ':' in line:
-                user, pwd = line.split(':', 1)
-                credentials[user] = pwd
-    return credentials
-
-def authenticate(client_socket):
+PREVIEW_SIZE = 1024
+# Ranges up to this size (previews included) are sliced from an mmap
+MMAP_RANGE_LIMIT = 64 * 1024
+
+STRIPE_COMMANDS = ('stripe_begin', 'stripe_put', 'stripe_commit')
+
+# Use sendfile() for downloads when the platform supports it
+ZERO_COPY_DOWNLOADS = True
+
+# Seconds a session may sit at the command prompt, and that any single send or
+# receive within a login or command may wait, before the session is closed
+# (None: no limit). Set from the command line in main().
+IDLE_TIMEOUT = 300
+OP_TIMEOUT = 60
+# Seconds of silence before TCP keepalive probes start (0: keepalive off)
+KEEPALIVE_IDLE = 60
+# Threads that greet clients waiting for a worker
+LOBBY_WORKERS = 2
+# Seconds a SIGTERM/SIGHUP waits for sessions to finish before closing them
+DRAIN_TIMEOUT = handoff.DRAIN_TIMEOUT
+
+credential_store = CredentialStore('id_passwd.txt')
+login_throttle = LoginThrottle()
+# Shared with the cluster coordinator, whose login tickets this node then accepts
+CLUSTER_SECRET = None
+# SSLContext from --tls-cert; None serves plaintext
+TLS_CONTEXT = None
+# Limits are set from the command line and id_passwd.txt in main()
+bandwidth_scheduler = bandwidth.BandwidthScheduler()
+performance_tracker.scheduler = bandwidth_scheduler
+admission_controller = admission.AdmissionController()
+performance_tracker.admission = admission_controller
+quota_manager = quota.QuotaManager()
+session_registry = handoff.SessionRegistry()
+# The process started by a hot restart, once it has taken over the listening socket
+successor = None
+# When draining sessions gives up and closes the rest
+drain_deadline = None
+# Set in pre-fork workers: takes the totals after a drain, for the parent's combined report
+report_totals = None
+metrics_server = None
+
+def throttle_message(retry_after):
+    return f"Too many failed attempts. Try again in {int(retry_after) + 1} seconds."
+
+def verify_login(username, password):
+    """Check a password from id_passwd.txt, or a coordinator's ticket on a cluster node."""
+    if CLUSTER_SECRET and password.startswith(TICKET_PREFIX):
+        return verify_ticket(CLUSTER_SECRET, username, password)
+    return credential_store.verify(username, password)
+
+def authenticate(conn, client_address):
+    client_ip = client_address[0]
     count=1
     while (count<=3):    
-        client_socket.sendall(b"Username: ")
-        username = client_socket.recv(1024).decode().strip()
-        client_socket.sendall(b"Password: ")
-        password = client_socket.recv(1024).decode().strip()
-        credentials = load_credentials()
-        if username in credentials and credentials[username] == password:
-            client_socket.sendall(b"Authentication successful.")
-            print("Authentication Successful")
-            logging.info(f"Authentication Successful for user {username}")
-            time.sleep(0.1)
+        conn.send_msg("Username: ")
+        username = conn.recv_msg()
+        conn.send_msg("Password: ")
+        password = conn.recv_msg()
+        retry_after = login_throttle.retry_after(client_ip, username)
+        if retry_after:
+            conn.send_msg(throttle_message(retry_after))
+            logpipe.event("Login throttled for user %(user)s from %(client)s", logging.WARNING,
+                          user=username, op='auth', client=client_ip, outcome='throttled')
+            return None
+        started = time.monotonic()
+        verified = verify_login(username, password)
+        performance_tracker.log_operation('auth', time.monotonic() - started)
+        if verified:
+            login_throttle.record_success(client_ip, username)
+            conn.send_msg("Authentication successful.")
+            logpipe.event("Authentication successful for user %(user)s", user=username, op='auth',
+                          client=client_ip, outcome='ok')
             return username
         else:
-            client_socket.sendall(b"Authentication failed.")
-            time.sleep(0.1)
-            print("Authentication failed")
-            logging.warning(f"Authentication failed for user {username}")
+            login_throttle.record_failure(client_ip, username)
+            conn.send_msg("Authentication failed.")
+            logpipe.event("Authentication failed for user %(user)s", logging.WARNING, user=username,
+                          op='auth', client=client_ip, outcome='failed')
             count+=1
             
-    logging.error(f"Multiple failed authentication attempts for user {username}")
+    logpipe.event("Multiple failed authentication attempts for user %(user)s", logging.ERROR,
+                  user=username, op='auth', client=client_ip, outcome='locked_out')
     return None
 
-def handle_file_upload(client_socket, user):
-    start_time = time.time()
+def refuse_over_quota(conn, user, op, filename, error):
+    logpipe.event("Upload of %(file)s by %(user)s refused: %(error)s", logging.WARNING, user=user, op=op,
+                  file=filename, error=str(error), outcome='over_quota')
+    conn.send_msg(str(error))
+
+def refuse_corrupt_upload(conn, user, op, filename, error):
+    logpipe.event("Upload of %(file)s by %(user)s does not match the client's checksum; discarded",
+                  logging.ERROR, user=user, op=op, file=filename, outcome='checksum_mismatch')
+    conn.send_msg(str(error))
+
+def handle_file_upload(conn, user):
     try:
-        client_socket.sendall(b"Ready to receive the filename.")
-        filename = client_socket.recv(1024).decode().strip()
+        conn.send_msg("Ready to receive the filename.")
+        filename = conn.recv_msg()
         
         if filename == "CANCEL_UPLOAD":
-            print(f"Upload cancelled by user {user}")
-            logging.info(f"Upload cancelled by user {user}")
+            logpipe.event("Upload cancelled by user %(user)s", user=user, op='upload', outcome='cancelled')
             return
             
-        if not filename:
-            client_socket.sendall(b"Invalid filename.")
+        try:
+            storage.resolve(user, filename)
+        except storage.StorageError:
+            conn.send_msg("Invalid filename.")
+            return
+        try:
+            reservation = quota_manager.reserve(user, filename)
+        except quota.QuotaExceeded as e:
+            refuse_over_quota(conn, user, 'upload', filename, e)
             return
 
-        user_dir = os.path.join("server_storage", user)
-        os.makedirs(user_dir, exist_ok=True)
-
-        filepath = os.path.join(user_dir, filename)
-        client_socket.sendall(b"Ready to receive file data.")
-        time.sleep(0.1)
+        started = time.monotonic()
+        with reservation:
+            file, _ = storage.open_upload(user, filename)
+            conn.send_msg("Ready to receive file data.")
 
-        with open(filepath, 'wb') as file:
-            total_bytes = 0
-            while True:
-                chunk = client_socket.recv(1024)
-                if not chunk:
-                    print(f"Client {user} disconnected unexpectedly.")
-                    logging.warning(f"Client {user} disconnected unexpectedly.")
+            with file, bandwidth_scheduler.pace(conn, user, 'upload'):
+                try:
+                    total_bytes = conn.recv_stream(reservation.writer(file))
+                except quota.QuotaExceeded as e:
+                    storage.discard_upload(user, filename)
+                    refuse_over_quota(conn, user, 'upload', filename, e)
                     return
-                if chunk == b'END_OF_FILE':
-                    break
-                if chunk == b'UPLOAD_ERROR':
-                    print(f"Upload error reported by client {user}")
-                    logging.error(f"Upload error reported by client {user}")
+                except protocol.TransferAborted:
+                    logpipe.event("Upload error reported by client %(user)s", logging.ERROR,
+                                  user=user, op='upload', file=filename, outcome='client_error')
+                    storage.discard_upload(user, filename)
                     return
-                file.write(chunk)
-                total_bytes += len(chunk)
-                client_socket.sendall(b"Chunk received.")
+                except ConnectionError:
+                    logpipe.event("Client %(user)s disconnected unexpectedly.", logging.WARNING,
+                                  user=user, op='upload', file=filename, outcome='disconnected')
+                    storage.discard_upload(user, filename)
+                    return
+            try:
+                storage.commit_upload(user, filename, digest=file.hexdigest(), expected_digest=conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                refuse_corrupt_upload(conn, user, 'upload', filename, e)
+                return
 
-        end_time = time.time()
+        duration = time.monotonic() - started
         performance_tracker.log_file_transfer()
-        logging.info(f"File upload completed: {filename}, User: {user}, Size: {total_bytes} bytes, Duration: {end_time - start_time:.2f}s")
-        client_socket.sendall(b"File upload completed successfully.")
-        print(f"File {filename} uploaded successfully for user {user}")
+        performance_tracker.log_operation('upload', duration, total_bytes)
+        logpipe.event("File upload completed: %(file)s, User: %(user)s, Size: %(bytes)s bytes",
+                      user=user, op='upload', file=filename, bytes=total_bytes, duration=duration, outcome='ok')
+        conn.send_msg("File upload completed successfully.")
         
-    except BrokenPipeError:
-        print(f"Broken pipe error with client {user}.")
-        logging.error(f"Broken pipe error with client {user}.")
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='upload',
+                      outcome='disconnected')
     except Exception as e:
-        print(f"Error while handling file upload for user {user}: {e}")
-        logging.error(f"File upload error for user {user}: {e}")
+        logpipe.event("File upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='upload',
+                      error=str(e), outcome='error')
         try:
-            client_socket.sendall(b"Error: Failed to receive file data.")
+            conn.send_error("Error: Failed to receive file data.")
         except:
             pass
 
-def handle_file_download(client_socket, user):
+def handle_resume_upload(conn, user):
+    """Upload that continues from whatever an earlier, interrupted attempt left behind."""
     try:
-        request = client_socket.recv(1024).decode().strip()
+        conn.send_msg("Ready to receive the filename.")
+        header = conn.recv_msg()
+
+        if header == "CANCEL_UPLOAD":
+            logpipe.event("Upload cancelled by user %(user)s", user=user, op='upload', outcome='cancelled')
+            return
+
+        started = time.monotonic()
+        try:
+            total, token, filename = storage.parse_resume_header(header)
+            reservation = quota_manager.reserve(user, filename, total)
+        except quota.QuotaExceeded as e:
+            refuse_over_quota(conn, user, 'upload', filename, e)
+            return
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+
+        with reservation:
+            file, offset = storage.open_upload(user, filename, total, token)
+            if offset:
+                logpipe.event("Resuming upload of %(file)s for user %(user)s at byte %(offset)s of %(total)s",
+                              user=user, op='upload', file=filename, offset=offset, total=total)
+            conn.send_msg(f"OFFSET {offset}")
+
+            with file, bandwidth_scheduler.pace(conn, user, 'upload'):
+                try:
+                    received = conn.recv_stream(reservation.writer(file))
+                except quota.QuotaExceeded as e:
+                    storage.discard_upload(user, filename)
+                    refuse_over_quota(conn, user, 'upload', filename, e)
+                    return
+                except protocol.TransferAborted:
+                    logpipe.event("Upload error reported by client %(user)s", logging.ERROR,
+                                  user=user, op='upload', file=filename, outcome='client_error')
+                    return
+                except ConnectionError:
+                    logpipe.event("Client %(user)s disconnected during upload of %(file)s; partial data kept for resume.",
+                                  logging.WARNING, user=user, op='upload', file=filename, outcome='disconnected')
+                    return
+
+            try:
+                committed = storage.commit_upload(user, filename, total, file.hexdigest(), conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                refuse_corrupt_upload(conn, user, 'upload', filename, e)
+                return
+            if not committed:
+                conn.send_msg(f"Upload incomplete: {storage.partial_size(user, filename)} of {total} bytes received.")
+                return
+
+        duration = time.monotonic() - started
+        performance_tracker.log_file_transfer()
+        performance_tracker.log_operation('upload', duration, received)
+        logpipe.event("File upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes (%(bytes)s sent this session)",
+                      user=user, op='upload', file=filename, bytes=received, total=total, duration=duration,
+                      outcome='ok')
+        conn.send_msg("File upload completed successfully.")
+
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='upload',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to receive file data.")
+        except:
+            pass
+
+def handle_delta_upload(conn, user):
+    """Re-upload of a file the server already has: send block signatures, rebuild from the client's delta."""
+    try:
+        conn.send_msg("Ready to receive the filename.")
+        header = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            total, digest, filename = storage.parse_resume_header(header)
+            has_base = storage.file_exists(user, filename)
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+
+        if not has_base:
+            conn.send_msg("NO_BASE")
+            return
+        try:
+            reservation = quota_manager.reserve(user, filename, total)
+        except quota.QuotaExceeded as e:
+            refuse_over_quota(conn, user, 'delta_upload', filename, e)
+            return
+
+        with reservation:
+            base, base_size = storage.open_file(user, filename)
+            with base, bandwidth_scheduler.pace(conn, user, 'delta_upload'):
+                block_size = delta.choose_block_size(base_size)
+                signatures = delta.file_signatures(base, block_size)
+                conn.send_msg(f"SIGNATURES {block_size}")
+                conn.send_stream(io.BytesIO(signatures))
+
+                file, _ = storage.open_upload(user, filename)
+                with file:
+                    applier = delta.DeltaApplier(base, reservation.writer(file))
+                    try:
+                        received = conn.recv_stream(applier)
+                    except quota.QuotaExceeded as e:
+                        storage.discard_upload(user, filename)
+                        refuse_over_quota(conn, user, 'delta_upload', filename, e)
+                        return
+                    except (protocol.TransferAborted, ConnectionError, OSError):
+                        storage.discard_upload(user, filename)
+                        raise
+
+            if not applier.verify(total, digest):
+                storage.discard_upload(user, filename)
+                logpipe.event("Delta upload of %(file)s for user %(user)s failed verification", logging.WARNING,
+                              user=user, op='delta_upload', file=filename, outcome='mismatch')
+                conn.send_msg("DELTA_MISMATCH")
+                return
+            storage.commit_upload(user, filename, digest=digest)
+
+        duration = time.monotonic() - started
+        performance_tracker.log_file_transfer()
+        performance_tracker.log_operation('delta_upload', duration, total)
+        logpipe.event("Delta upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes (%(bytes)s delta bytes)",
+                      user=user, op='delta_upload', file=filename, bytes=received, total=total, duration=duration,
+                      outcome='ok')
+        conn.send_msg("File upload completed successfully.")
+
+    except protocol.TransferAborted:
+        logpipe.event("Upload error reported by client %(user)s", logging.ERROR, user=user, op='delta_upload',
+                      outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='delta_upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Delta upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='delta_upload',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to receive file data.")
+        except:
+            pass
+
+def handle_dedup_upload(conn, user):
+    """Upload into the chunk store: take the client's chunk list, ask only for the chunks not stored yet."""
+    try:
+        conn.send_msg("Ready to receive the filename.")
+        header = conn.recv_msg()
+        started = time.monotonic()
+        if storage.BACKEND != 'dedup':
+            conn.send_msg("DEDUP_DISABLED")
+            return
+        try:
+            total, count, filename = storage.parse_resume_header(header)
+            reservation = quota_manager.reserve(user, filename, total)
+        except quota.QuotaExceeded as e:
+            refuse_over_quota(conn, user, 'dedup_upload', filename, e)
+            return
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+
+        with reservation:
+            store = storage.chunk_store()
+            conn.send_msg("SEND_MANIFEST")
+            manifest = io.BytesIO()
+            conn.recv_stream(manifest)
+            entries = chunkstore.decode_manifest(manifest.getvalue())
+            if len(entries) != int(count) or sum(length for _, length in entries) != total:
+                conn.send_msg("Invalid manifest.")
+                return
+
+            missing = store.missing(entries)
+            conn.send_msg(f"MISSING {len(missing)}")
+            conn.send_stream(io.BytesIO(b''.join(chunkstore.INDEX.pack(index) for index in missing)))
+            sink = chunkstore.ChunkSink(store, [entries[index] for index in missing])
+            with bandwidth_scheduler.pace(conn, user, 'dedup_upload'):
+                received = conn.recv_stream(sink)
+            if not sink.complete():
+                conn.send_msg("Upload incomplete: chunks missing.")
+                return
+            try:
+                storage.commit_chunks(user, filename, entries)
+            except chunkstore.ChunkStoreError as e:
+                conn.send_msg(str(e))
+                return
+
+        duration = time.monotonic() - started
+        performance_tracker.log_file_transfer()
+        performance_tracker.log_operation('dedup_upload', duration, total)
+        logpipe.event("Dedup upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes, %(chunks_sent)s/%(chunks)s chunks sent (%(bytes)s bytes)",
+                      user=user, op='dedup_upload', file=filename, bytes=received, total=total,
+                      chunks_sent=len(missing), chunks=len(entries), duration=duration, outcome='ok')
+        conn.send_msg("File upload completed successfully.")
+
+    except protocol.TransferAborted:
+        logpipe.event("Upload error reported by client %(user)s", logging.ERROR, user=user, op='dedup_upload',
+                      outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='dedup_upload',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Dedup upload error for user %(user)s: %(error)s", logging.ERROR, user=user, op='dedup_upload',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to receive file data.")
+        except:
+            pass
+
+def handle_stripe_command(conn, user, command):
+    """stripe_begin / stripe_put / stripe_commit: one upload split across several connections."""
+    try:
+        conn.send_msg("Ready to receive the filename.")
+        header = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            if command == 'stripe_begin':
+                total, token, filename = storage.parse_resume_header(header)
+                # Checked again at commit; the stripes arrive on other connections
+                quota_manager.reserve(user, filename, total).release()
+                storage.begin_striped_upload(user, filename, total, token)
+                logpipe.event("Striped upload of %(file)s (%(total)s bytes) started for user %(user)s",
+                              user=user, op='upload_stripe', file=filename, total=total)
+                conn.send_msg("READY")
+
+            elif command == 'stripe_put':
+                offset, token, filename = storage.parse_stripe_header(header)
+                fd, total = storage.open_stripe(user, filename, token)
+                try:
+                    conn.send_msg("READY")
+                    with bandwidth_scheduler.pace(conn, user, 'upload_stripe'):
+                        received = conn.recv_stream(protocol.PositionalWriter(fd, offset, total))
+                finally:
+                    os.close(fd)
+                storage.record_stripe(user, filename, offset, received)
+                duration = time.monotonic() - started
+                performance_tracker.log_operation('upload_stripe', duration, received)
+                logpipe.event("Stripe at %(offset)s of %(file)s received for user %(user)s", user=user,
+                              op='upload_stripe', file=filename, offset=offset, bytes=received,
+                              duration=duration, outcome='ok')
+                conn.send_msg(f"STRIPE_DONE {received}")
+
+            else:
+                _, token, filename = storage.parse_resume_header(header)
+                total = storage.striped_upload_total(user, filename, token)
+                missing = storage.missing_stripe_bytes(user, filename, total)
+                if missing:
+                    conn.send_msg(f"Upload incomplete: {missing} of {total} bytes missing.")
+                    return
+                try:
+                    reservation = quota_manager.reserve(user, filename, total)
+                except quota.QuotaExceeded:
+                    storage.discard_upload(user, filename)
+                    raise
+                with reservation:
+                    storage.commit_upload(user, filename)
+                performance_tracker.log_file_transfer()
+                logpipe.event("Striped upload completed: %(file)s, User: %(user)s, Size: %(total)s bytes",
+                              user=user, op='upload', file=filename, total=total, outcome='ok')
+                conn.send_msg("File upload completed successfully.")
+        except quota.QuotaExceeded as e:
+            refuse_over_quota(conn, user, 'upload_stripe', filename, e)
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+    except protocol.TransferAborted:
+        logpipe.event("Stripe upload error reported by client %(user)s", logging.ERROR,
+                      user=user, op='upload_stripe', outcome='client_error')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op=command,
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("%(op)s error for user %(user)s: %(error)s", logging.ERROR, user=user, op=command,
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to receive file data.")
+        except:
+            pass
+
+def sends_zero_copy(conn):
+    """Whether whole-file downloads on conn can go out with sendfile(), so should skip the content cache."""
+    if not (ZERO_COPY_DOWNLOADS and protocol.SENDFILE_AVAILABLE and conn.framed) or conn.codecs:
+        return False
+    return conn.ssl_object is None or tls.kernel_send(getattr(conn, 'sock', None))
+
+def send_range(conn, file, offset, count, digest=None, preview=False):
+    # Previews must end with send_preview(): legacy clients wait for END_OF_PREVIEW, not END_OF_FILE
+    if count > MMAP_RANGE_LIMIT and not preview:
+        conn.send_file(file, offset, count, zero_copy=ZERO_COPY_DOWNLOADS and storage.has_descriptor(file),
+                       digest=digest)
+    elif not storage.has_descriptor(file):
+        conn.send_preview(storage.read_range(file, offset, count), digest)
+    elif count:
+        # mmap offsets must be aligned to the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(file.fileno(), offset + count - start, offset=start, access=mmap.ACCESS_READ) as mapped:
+            conn.send_preview(mapped[offset - start:offset - start + count], digest)
+    else:
+        conn.send_preview(b"", digest)
+
+def download_digest(conn, user, filename, mode, offset, count, size, source=None):
+    """The stored digest to end a download with: only for transfers that reach the end of the file."""
+    if not conn.digests or mode == 'preview' or offset + count != size:
+        return None
+    return storage.stored_digest(user, filename, size, source)
+
+def handle_file_download(conn, user):
+    mode = 'download'
+    try:
+        request = conn.recv_msg()
+        started = time.monotonic()
         
-        if request.startswith("PREVIEW "):
-            preview_mode = True
-            filename = request[8:]
-        else:
-            preview_mode = False
-            filename = request
+        try:
+            mode, filename, offset, length, source = storage.parse_download_request(request, PREVIEW_SIZE)
+            if mode == 'preview':
+                file, size = storage.open_preview(user, filename, PREVIEW_SIZE, source)
+            else:
+                file, size = storage.open_file(user, filename, source, zero_copy=sends_zero_copy(conn))
+        except (storage.StorageError, FileNotFoundError, IsADirectoryError):
+            conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("File not found: %(file)s for user %(user)s", logging.WARNING,
+                          user=user, op=mode, file=request, outcome='not_found')
+            return
 
-        user_dir = os.path.join("server_storage", user)
-        filepath = os.path.join(user_dir, filename)
+        with file, bandwidth_scheduler.pace(conn, user, mode):
+            if mode == 'download':
+                conn.send_msg("FILE_FOUND")
+                conn.send_file(file, 0, size, zero_copy=ZERO_COPY_DOWNLOADS and storage.has_descriptor(file),
+                               digest=download_digest(conn, user, filename, mode, 0, size, size, source))
+                count = size
+            else:
+                try:
+                    count = storage.clamp_range(offset, length, size)
+                except storage.StorageError as e:
+                    conn.send_msg(str(e))
+                    return
+                if mode == 'preview':
+                    conn.send_msg("PREVIEW_MODE")
+                else:
+                    conn.send_msg(f"RANGE_MODE {offset} {count} {size}")
+                send_range(conn, file, offset, count,
+                           download_digest(conn, user, filename, mode, offset, count, size, source),
+                           preview=mode == 'preview')
+        duration = time.monotonic() - started
+        performance_tracker.log_operation(mode, duration, count)
+        logpipe.event("Successfully completed %(op)s for %(file)s by user %(user)s",
+                      user=user, op=mode, file=filename, bytes=count, duration=duration, outcome='ok')
         
-        if not os.path.exists(filepath):
-            client_socket.sendall(b"FILE_NOT_FOUND")
-            time.sleep(0.1)
-            logging.warning(f"File not found: {filename} for user {user}")
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op=mode,
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File %(op)s error for user %(user)s: %(error)s", logging.ERROR, user=user, op=mode,
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("ERROR")
+        except:
+            pass
+
+def handle_list_files(conn, user):
+    try:
+        conn.send_msg("Ready to receive the listing query.")
+        query = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            page = storage.list_files(user, storage.parse_list_query(query))
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
             return
+        conn.send_msg("LISTING")
+        conn.send_preview(json.dumps(page).encode())
+        duration = time.monotonic() - started
+        performance_tracker.log_operation('list', duration)
+        logpipe.event("Listed %(files)s files for user %(user)s", user=user, op='list',
+                      files=len(page['files']), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='list',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("File listing error for user %(user)s: %(error)s", logging.ERROR, user=user, op='list',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to list files.")
+        except:
+            pass
 
-        logging.info(f"Handling {'preview' if preview_mode else 'download'} request for {filename} by user {user}")
+def handle_manifest(conn, user):
+    """Every file under a prefix with its size, mtime and hash, in one reply, for sync clients."""
+    try:
+        conn.send_msg("Ready to receive the manifest query.")
+        query = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            rows = storage.manifest(user, storage.parse_list_query(query).get('prefix'))
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+        conn.send_msg("MANIFEST")
+        conn.send_stream(io.BytesIO(json.dumps({'files': rows}).encode()))
+        duration = time.monotonic() - started
+        performance_tracker.log_operation('manifest', duration)
+        logpipe.event("Sent manifest of %(files)s files to user %(user)s", user=user, op='manifest',
+                      files=len(rows), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='manifest',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Manifest error for user %(user)s: %(error)s", logging.ERROR, user=user, op='manifest',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to build the manifest.")
+        except:
+            pass
 
-        if preview_mode:
-            client_socket.sendall(b"PREVIEW_MODE")
-            time.sleep(0.1)
-            
-            with open(filepath, 'rb') as file:
-                preview_data = file.read(1024)
-                client_socket.sendall(preview_data)
-            
-            time.sleep(0.1)
-            client_socket.sendall(b"END_OF_PREVIEW")
-            
-        else:
-            client_socket.sendall(b"FILE_FOUND")
-            time.sleep(0.1)
-            
-            with open(filepath, 'rb') as file:
-                while chunk := file.read(1024):
-                    client_socket.sendall(chunk)
-                    time.sleep(0.01)
-                
-            time.sleep(0.1)
-            client_socket.sendall(b"END_OF_FILE")
-            
-        print(f"Successfully handled {'preview' if preview_mode else 'download'} request for {filename} by user {user}")
-        logging.info(f"Successfully completed {'preview' if preview_mode else 'download'} for {filename} by user {user}")
-        
+def restore_files(user, filename, source):
+    """Restore one file, or a whole snapshot, reserving quota for each file; returns how many changed."""
+    restored = 0
+    for name, size in storage.restore_targets(user, filename, source):
+        with quota_manager.reserve(user, name, size):
+            restored += storage.restore(user, name, source)
+    return restored
+
+def snapshot_operation(user, op, snapshot):
+    """Carry out a snapshot request; returns the reply to send as JSON."""
+    if op == 'create':
+        snapshot, files = storage.create_snapshot(user, snapshot)
+        return {'snapshot': snapshot, 'files': files}
+    if op == 'list':
+        return {'snapshots': storage.list_snapshots(user)}
+    if op == 'files':
+        return {'files': [row[:4] for row in storage.snapshot_files(user, snapshot)]}
+    return {'deleted': storage.delete_snapshot(user, snapshot)}
+
+def handle_versions(conn, user):
+    """The kept earlier versions of a file, newest first."""
+    try:
+        conn.send_msg("Ready to receive the filename.")
+        filename = conn.recv_msg()
+        try:
+            rows = storage.list_versions(user, filename)
+        except storage.StorageError:
+            conn.send_msg("FILE_NOT_FOUND")
+            return
+        conn.send_msg("VERSIONS")
+        conn.send_preview(json.dumps({'versions': [row[:3] for row in rows]}).encode())
+        logpipe.event("Listed %(versions)s versions of %(file)s for user %(user)s", user=user, op='versions',
+                      file=filename, versions=len(rows), outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='versions',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Version listing error for user %(user)s: %(error)s", logging.ERROR, user=user,
+                      op='versions', error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to list versions.")
+        except:
+            pass
+
+def handle_restore(conn, user):
+    try:
+        conn.send_msg("Ready to receive the restore request.")
+        request = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            filename, source = storage.parse_restore_request(request)
+            restored = restore_files(user, filename, source)
+        except (storage.StorageError, quota.QuotaExceeded) as e:
+            conn.send_msg(str(e))
+            logpipe.event("Restore for user %(user)s refused: %(error)s", logging.WARNING, user=user, op='restore',
+                          error=str(e), outcome='refused')
+            return
+        except (FileNotFoundError, IsADirectoryError):
+            conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("Nothing to restore for user %(user)s: %(request)s", logging.WARNING, user=user,
+                          op='restore', request=request, outcome='not_found')
+            return
+        duration = time.monotonic() - started
+        performance_tracker.log_operation('restore', duration)
+        conn.send_msg(f"RESTORED {restored}")
+        logpipe.event("Restored %(files)s files from %(source)s for user %(user)s", user=user, op='restore',
+                      files=restored, source=f"{source[0]} {source[1]}", duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='restore',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Restore error for user %(user)s: %(error)s", logging.ERROR, user=user, op='restore',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to restore.")
+        except:
+            pass
+
+def handle_snapshot(conn, user):
+    op = 'snapshot'
+    try:
+        conn.send_msg("Ready to receive the snapshot request.")
+        request = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            op, snapshot = storage.parse_snapshot_request(request)
+            reply = snapshot_operation(user, op, snapshot)
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+        except FileNotFoundError:
+            conn.send_msg("SNAPSHOT_NOT_FOUND")
+            return
+        duration = time.monotonic() - started
+        performance_tracker.log_operation('snapshot', duration)
+        conn.send_msg("SNAPSHOT")
+        conn.send_preview(json.dumps(reply).encode())
+        logpipe.event("Snapshot %(action)s for user %(user)s", user=user, op='snapshot', action=op,
+                      snapshot=reply.get('snapshot', snapshot), duration=duration, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='snapshot',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Snapshot %(action)s error for user %(user)s: %(error)s", logging.ERROR, user=user,
+                      op='snapshot', action=op, error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Snapshot request failed.")
+        except:
+            pass
+
+def authorize_coordinator(user, ticket):
+    """Only the cluster coordinator may purge or move history, with a ticket it just issued for the user."""
+    return (bool(CLUSTER_SECRET) and isinstance(ticket, str) and ticket.startswith(TICKET_PREFIX)
+            and verify_ticket(CLUSTER_SECRET, user, ticket))
+
+def handle_history(conn, user):
+    """Cluster nodes: every version and snapshot kept for a user, for the coordinator to move."""
+    try:
+        conn.send_msg("Ready to receive the ticket.")
+        ticket = conn.recv_msg()
+        if not authorize_coordinator(user, ticket):
+            conn.send_msg("History refused.")
+            logpipe.event("History for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='history', outcome='refused')
+            return
+        history = storage.user_history(user)
+        conn.send_msg("HISTORY")
+        conn.send_preview(json.dumps(history).encode())
+        logpipe.event("Listed %(versions)s versions and %(snapshots)s snapshots of %(user)s", user=user,
+                      op='history', versions=len(history['versions']), snapshots=len(history['snapshots']),
+                      outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='history',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("History error for user %(user)s: %(error)s", logging.ERROR, user=user, op='history',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to list history.")
+        except:
+            pass
+
+def handle_keep(conn, user):
+    """Cluster nodes: take in one version or snapshot entry of a user moving here."""
+    try:
+        conn.send_msg("Ready to receive the header.")
+        header = conn.recv_msg()
+        started = time.monotonic()
+        try:
+            entry = storage.parse_keep_header(header)
+        except storage.StorageError as e:
+            conn.send_msg(str(e))
+            return
+        if not authorize_coordinator(user, entry.get('ticket')):
+            conn.send_msg("Keep refused.")
+            logpipe.event("Keep for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='keep', outcome='refused')
+            return
+        received = 0
+        if not storage.link_kept(user, entry):
+            if not entry.get('data'):
+                conn.send_msg("MISSING")
+                return
+            conn.send_msg("SEND")
+            with storage.open_kept_upload(user, entry) as file:
+                received = conn.recv_stream(file)
+            try:
+                storage.commit_kept(user, entry, file.hexdigest(), conn.end_digest)
+            except storage.ChecksumMismatch as e:
+                refuse_corrupt_upload(conn, user, 'keep', entry['name'], e)
+                return
+        conn.send_msg("KEPT")
+        logpipe.event("Kept %(file)s from %(source)s for user %(user)s", user=user, op='keep', file=entry.get('name'),
+                      source=f"version {entry['version']}" if 'version' in entry else f"snapshot {entry['snapshot']}",
+                      bytes=received, duration=time.monotonic() - started, outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='keep',
+                      outcome='disconnected')
+    except Exception as e:
+        logpipe.event("Keep error for user %(user)s: %(error)s", logging.ERROR, user=user, op='keep',
+                      error=str(e), outcome='error')
+        try:
+            conn.send_error("Error: Failed to keep the entry.")
+        except:
+            pass
+
+def handle_purge(conn, user):
+    """Cluster nodes: drop everything of a user who moved to another node, versions and snapshots included."""
+    try:
+        conn.send_msg("Ready to receive the ticket.")
+        ticket = conn.recv_msg()
+        if not authorize_coordinator(user, ticket):
+            conn.send_msg("Purge refused.")
+            logpipe.event("Purge for user %(user)s refused: no valid cluster ticket", logging.WARNING, user=user,
+                          op='purge', outcome='refused')
+            return
+        started = time.monotonic()
+        files, kept, snapshots = storage.purge_user(user)
+        duration = time.monotonic() - started
+        conn.send_msg(f"PURGED {files} {kept} {snapshots}")
+        logpipe.event("Purged %(files)s files, %(versions)s versions and %(snapshots)s snapshots of %(user)s",
+                      user=user, op='purge', files=files, versions=kept, snapshots=snapshots, duration=duration,
+                      outcome='ok')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='purge',
+                      outcome='disconnected')
     except Exception as e:
-        print(f"Error while handling file {'preview' if preview_mode else 'download'} for user {user}: {e}")
-        logging.error(f"File {'preview' if preview_mode else 'download'} error for user {user}: {e}")
+        logpipe.event("Purge error for user %(user)s: %(error)s", logging.ERROR, user=user, op='purge',
+                      error=str(e), outcome='error')
         try:
-            client_socket.sendall(b"ERROR")
+            conn.send_error("Error: Purge failed.")
         except:
             pass
 
-def handle_file_deletion(client_socket, user):
+def handle_file_deletion(conn, user):
     try:
-        client_socket.sendall(b"Enter the filename to delete: ")
-        filename = client_socket.recv(1024).decode().strip()
-
-        user_dir = os.path.join("server_storage", user)
-        filepath = os.path.join(user_dir, filename)
-
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            client_socket.sendall(b"FILE_DELETED")
-            print(f"File {filename} deleted for user {user}")
-            logging.info(f"File {filename} deleted for user {user}")
-            time.sleep(0.1)
+        conn.send_msg("Enter the filename to delete: ")
+        filename = conn.recv_msg()
+        started = time.monotonic()
+
+        try:
+            deleted = storage.delete_file(user, filename)
+        except storage.StorageError:
+            deleted = False
+        duration = time.monotonic() - started
+        performance_tracker.log_operation('delete', duration)
+
+        if deleted:
+            conn.send_msg("FILE_DELETED")
+            logpipe.event("File %(file)s deleted for user %(user)s", user=user, op='delete', file=filename,
+                          duration=duration, outcome='ok')
         else:
-            client_socket.sendall(b"FILE_NOT_FOUND")
-            logging.warning(f"File not found for deletion: {filename} for user {user}")
-    except BrokenPipeError:
-        print(f"Broken pipe error with client {user}.")
-        logging.error(f"Broken pipe error with client {user}.")
+            conn.send_msg("FILE_NOT_FOUND")
+            logpipe.event("File not found for deletion: %(file)s for user %(user)s", logging.WARNING,
+                          user=user, op='delete', file=filename, outcome='not_found')
+    except ConnectionError:
+        logpipe.event("Broken pipe error with client %(user)s.", logging.ERROR, user=user, op='delete',
+                      outcome='disconnected')
     except Exception as e:
-        print(f"Error while handling file deletion for user {user}: {e}")
-        logging.error(f"File deletion error for user {user}: {e}")
+        logpipe.event("File deletion error for user %(user)s: %(error)s", logging.ERROR, user=user, op='delete',
+                      error=str(e), outcome='error')
         try:
-            client_socket.sendall(b"Error: Failed to delete file.")
+            conn.send_error("Error: Failed to delete file.")
         except:
             pass
 
-def handle_client(client_socket, client_address):
+def tls_handshake(conn):
+    """'full' or 'resumed' for a TLS connection, else None."""
+    if conn.ssl_object is None:
+        return None
+    return 'resumed' if conn.ssl_object.session_reused else 'full'
+
+def log_handshake(conn, client_address):
+    logpipe.event("Client %(client)s using %(protocol)s protocol (chunk size %(chunk_size)s)", op='connect',
+                  client=client_address, protocol='framed' if conn.framed else 'legacy',
+                  chunk_size=conn.chunk_size, tls=tls_handshake(conn))
+
+def log_reaped(user, client_address, reason):
+    performance_tracker.log_session('reaped')
+    logpipe.event("Closed %(reason)s session of %(client)s", logging.WARNING, user=user, op='session',
+                  client=client_address, reason=reason, outcome='reaped')
+
+def log_drained(user, client_address):
+    logpipe.event("Closed session of %(client)s for shutdown", user=user, op='session', client=client_address,
+                  outcome='drained')
+
+def handle_client(client_socket, client_address, queued_at=None, conn=None):
+    """Serve one session. conn is given when a lobby thread already did the handshake."""
+    if queued_at is not None:
+        performance_tracker.log_queue_wait('clients', time.monotonic() - queued_at)
     performance_tracker.increment_connections()
-    print(f"Connection from {client_address} established.")
-    logging.info(f"New connection from {client_address}")
-    logging.info(f"Active Connections: {performance_tracker.active_connections}")
+    logpipe.event("New connection from %(client)s (%(active)s active)", op='connect', client=client_address,
+                  active=performance_tracker.active_connections)
+    user = None
     try:
-        user = authenticate(client_socket)
+        if conn is None:
+            conn = protocol.server_handshake(client_socket)
+            log_handshake(conn, client_address)
+        session_registry.add(conn)
+        conn.set_timeout(OP_TIMEOUT)
+
+        user = authenticate(conn, client_address)
         if not user:
             client_socket.close()
             return
 
-        print(f"User '{user}' authenticated successfully from {client_address}")
-
         while True:
             try:
-                client_socket.sendall(b"Enter command (upload/download/delete/exit): ")
-                command = client_socket.recv(1024).decode().strip()
+                conn.send_msg("Enter command (upload/download/list/delete/exit): ")
+                # Sent even when draining: clients read it to finish the previous command
+                if not session_registry.wait_for_command(conn):
+                    log_drained(user, client_address)
+                    break
+                conn.set_timeout(IDLE_TIMEOUT)
+                try:
+                    command = conn.recv_msg()
+                except protocol.SessionTimeout:
+                    log_reaped(user, client_address, 'idle')
+                    break
+                except ConnectionError:
+                    if not session_registry.draining:
+                        raise
+                    log_drained(user, client_address)
+                    break
+                finally:
+                    session_registry.got_command(conn)
+                conn.set_timeout(OP_TIMEOUT)
 
                 if command == 'upload':
-                    print(f"User {user} requested file upload.")
-                    handle_file_upload(client_socket, user)
+                    handle_file_upload(conn, user)
+                elif command == 'resume_upload' and conn.framed:
+                    handle_resume_upload(conn, user)
+                elif command == 'delta_upload' and conn.framed:
+                    handle_delta_upload(conn, user)
+                elif command == 'dedup_upload' and conn.framed:
+                    handle_dedup_upload(conn, user)
+                elif command in STRIPE_COMMANDS and conn.framed:
+                    handle_stripe_command(conn, user, command)
                 elif command == 'download':
-                    print(f"User {user} requested file download.")
-                    handle_file_download(client_socket, user)
+                    handle_file_download(conn, user)
+                elif command == 'list':
+                    handle_list_files(conn, user)
+                elif command == 'manifest' and conn.framed:
+                    handle_manifest(conn, user)
+                elif command == 'versions' and conn.framed:
+                    handle_versions(conn, user)
+                elif command == 'restore' and conn.framed:
+                    handle_restore(conn, user)
+                elif command == 'snapshot' and conn.framed:
+                    handle_snapshot(conn, user)
+                elif command == 'purge' and conn.framed:
+                    handle_purge(conn, user)
+                elif command == 'history' and conn.framed:
+                    handle_history(conn, user)
+                elif command == 'keep' and conn.framed:
+                    handle_keep(conn, user)
                 elif command == 'delete':
-                    print(f"User {user} requested file deletion.")
-                    handle_file_deletion(client_socket, user)
+                    handle_file_deletion(conn, user)
                 elif command == 'exit':
-                    print(f"User {user} exited.")
-                    logging.info(f"User {user} exited.")
+                    logpipe.event("User %(user)s exited.", user=user, op='exit', client=client_address)
                     break
                 else:
-                    client_socket.sendall(b"Invalid command.")
-            except BrokenPipeError:
-                print(f"Connection lost with client {client_address}")
-                logging.error(f"Connection lost with client {client_address}")
+                    conn.send_msg("Invalid command.")
+                # Handlers treat a timeout like a disconnect and return; the session is over either way
+                if conn.expired:
+                    log_reaped(user, client_address, 'stalled')
+                    break
+            except protocol.SessionTimeout:
+                log_reaped(user, client_address, 'stalled')
+                break
+            except ConnectionError:
+                logpipe.event("Connection lost with client %(client)s", logging.ERROR, user=user, op='session',
+                              client=client_address, outcome='disconnected')
                 break
             except Exception as e:
-                print(f"Error handling command for {client_address}: {e}")
-                logging.error(f"Error handling command for {client_address}: {e}")
+                logpipe.event("Error handling command for %(client)s: %(error)s", logging.ERROR, user=user,
+                              op='session', client=client_address, error=str(e), outcome='error')
                 break
 
+    except protocol.SessionTimeout:
+        log_reaped(user, client_address, 'login')
     except Exception as e:
-        print(f"Error with client {client_address}: {e}")
-        logging.error(f"Error with client {client_address}: {e}")
+        logpipe.event("Error with client %(client)s: %(error)s", logging.ERROR, user=user, op='session',
+                      client=client_address, error=str(e), outcome='error')
     finally:
-        print(f"Connection from {client_address} closed.")
+        if conn is not None:
+            session_registry.remove(conn)
         performance_tracker.decrement_connections()
-        logging.info(f"Connection from {client_address} closed.")
+        logpipe.event("Connection from %(client)s closed.", user=user, op='disconnect', client=client_address)
         try:
             client_socket.close()
         except:
             pass
 
-def signal_handler(signum, frame):
+def log_shutdown_report(tracker):
     logging.info("\nServer shutdown initiated.")
-    logging.info(f"Total Connections: {performance_tracker.total_connections}")
-    logging.info(f"Active Connections: {performance_tracker.active_connections}")
-    logging.info(f"File Transfers: {performance_tracker.file_transfers}")
+    logging.info(f"Total Connections: {tracker.total_connections}")
+    logging.info(f"Active Connections: {tracker.active_connections}")
+    logging.info(f"File Transfers: {tracker.file_transfers}")
+    logging.info(f"Content Cache - Hits: {tracker.cache_hits}, Misses: {tracker.cache_misses}, Evictions: {tracker.cache_evictions}")
+    logging.info(f"Sessions - Queued: {tracker.sessions_queued}, Rejected: {tracker.sessions_rejected}, Reaped: {tracker.sessions_reaped}")
+    # Called from the signal handler, so read without taking transfer_lock
+    for operation, histogram in sorted(list(tracker.latency.items())):
+        logging.info(f"Latency {operation} - Count: {histogram.count}, p50 <= {histogram.quantile(0.5)}s, p95 <= {histogram.quantile(0.95)}s, p99 <= {histogram.quantile(0.99)}s")
+    for pool, histogram in sorted(list(tracker.queue_wait.items())):
+        logging.info(f"Queue wait ({pool}) - Count: {histogram.count}, p95 <= {histogram.quantile(0.95)}s")
+    resources = tracker.sampler.summary() if tracker.sampler else tracker.resources
+    if resources:
+        logging.info(f"Sampled Resources - Peak CPU: {resources['peak_cpu_percent']}%, Peak RSS: {resources['peak_rss_bytes'] / 1e6:.1f} MB, Peak FDs: {resources['peak_open_fds']}")
     
     cpu_usage = psutil.cpu_percent()
     memory_usage = psutil.virtual_memory().percent
     logging.info(f"Final System Resources - CPU: {cpu_usage}%, Memory: {memory_usage}%")
-    
+
+def signal_handler(signum, frame):
+    log_shutdown_report(performance_tracker)
     print("\nServer is shutting down gracefully...")
     sys.exit(0)
 
-def main():
-    logging.info("Server started. Initializing performance tracking.")
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+def parse_args():
+    parser = argparse.ArgumentParser(description="DFOS file server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="threads: one pool worker per client; asyncio: one coroutine per client")
+    parser.add_argument('--workers', type=int, default=10,
+                        help="client worker threads (threads engine)")
+    parser.add_argument('--io-workers', type=int, default=16,
+                        help="blocking file I/O threads (asyncio engine)")
+    parser.add_argument('--backlog', type=int,
+                        help="listen() backlog (default 5 for threads, 1024 for asyncio)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="pre-forked worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--storage', choices=['files', 'dedup'], default='files',
+                        help="files: plain per-user copies; dedup: shared content-addressed chunk store")
+    parser.add_argument('--compress-at-rest', choices=['none'] + sorted(compress.CODECS), default='none',
+                        help="store compressible files compressed (files storage)")
+    parser.add_argument('--fsync', choices=durability.MODES, default='none',
+                        help="sync uploads to disk before acknowledging them: per file, or grouped "
+                             "across concurrent uploads")
+    parser.add_argument('--cache-mb', type=int, default=64,
+                        help="memory for caching hot file contents and previews, per process (0 disables)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on this port (worker N of --processes uses port + N)")
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help="address for the metrics endpoint")
+    parser.add_argument('--sample-interval', type=float, default=metrics.SAMPLE_INTERVAL,
+                        help="seconds between CPU/RSS/fd samples")
+    parser.add_argument('--log-file', default='server_performance.log',
+                        help="JSON-lines log written by a background thread")
+    parser.add_argument('--log-max-mb', type=int, default=100,
+                        help="rotate the log when it reaches this size (0: never)")
+    parser.add_argument('--log-rotate',
+                        help="rotate by time instead of size: S, M, H, D, midnight or W0-W6")
+    parser.add_argument('--log-backups', type=int, default=5, help="rotated log files to keep")
+    parser.add_argument('--log-sample', type=logpipe.parse_sample_rates, default='',
+                        help="keep one in N successful events of an op, e.g. preview=100,range=10")
+    parser.add_argument('--log-echo', action=argparse.BooleanOptionalAction, default=True,
+                        help="also print log records to the terminal")
+    parser.add_argument('--bandwidth-limit', type=bandwidth.parse_rate,
+                        help="total transfer rate per process in bytes/s, e.g. 100M (default: unlimited)")
+    parser.add_argument('--user-bandwidth', type=bandwidth.parse_rate,
+                        help="default per-user rate, e.g. 10M; 'rate=' in id_passwd.txt overrides it")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="close sessions idle at the command prompt this long, in seconds (0: never)")
+    parser.add_argument('--op-timeout', type=float, default=OP_TIMEOUT,
+                        help="close sessions whose peer makes no progress this long during a command (0: never)")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help="seconds a SIGTERM or SIGHUP (hot restart) lets sessions finish before closing them")
+    parser.add_argument('--keepalive', type=int, default=KEEPALIVE_IDLE,
+                        help="seconds of silence before TCP keepalive probes (0: off)")
+    parser.add_argument('--max-sessions', type=int,
+                        help="sessions served at once (default: --workers for threads, unlimited for asyncio)")
+    parser.add_argument('--max-queue', type=int, default=admission.DEFAULT_MAX_QUEUE,
+                        help="clients that may wait for a session slot before new ones are turned away")
+    parser.add_argument('--quota-bytes', type=quota.parse_size,
+                        help="default per-user storage quota, e.g. 10G; 'quota=' in id_passwd.txt overrides it")
+    parser.add_argument('--quota-files', type=int,
+                        help="default per-user file limit; 'max_files=' in id_passwd.txt overrides it")
+    parser.add_argument('--scrub-interval', type=float, default=quota.SCRUB_INTERVAL,
+                        help="seconds between reconciling stored usage with the disk (0: never)")
+    parser.add_argument('--keep-versions', type=int, default=versions.KEEP_VERSIONS,
+                        help="earlier versions kept per file when it is overwritten or deleted (0: none)")
+    parser.add_argument('--keep-snapshots', type=int, default=versions.KEEP_SNAPSHOTS,
+                        help="snapshots kept per user, oldest dropped first (0: no limit)")
+    parser.add_argument('--keep-days', type=float, default=versions.KEEP_DAYS,
+                        help="drop versions and snapshots older than this many days (0: no age limit)")
+    parser.add_argument('--prune-interval', type=float, default=versions.PRUNE_INTERVAL,
+                        help="seconds between enforcing --keep-days and --keep-snapshots (0: never)")
+    parser.add_argument('--storage-root', default=storage.STORAGE_ROOT,
+                        help="directory holding the users' files and the server's metadata")
+    parser.add_argument('--cluster-nodes',
+                        help="run as cluster coordinator for the storage nodes listed in this file")
+    parser.add_argument('--cluster-state', default='cluster_placement.json',
+                        help="coordinator: file recording which node holds each user's files")
+    parser.add_argument('--cluster-secret', default=os.environ.get('DFOS_CLUSTER_SECRET'),
+                        help="secret shared by the coordinator and its nodes (default: $DFOS_CLUSTER_SECRET)")
+    parser.add_argument('--tls-cert',
+                        help="serve TLS with the certificate chain in this PEM file (plaintext if unset)")
+    parser.add_argument('--tls-key',
+                        help="private key for --tls-cert, if it is not in the same file")
+    return parser.parse_args()
+
+def create_listener(host, port, backlog, reuse_port=False):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('0.0.0.0', 5000))
-    server_socket.listen(5)
-    print("Server is listening on port 5000...")
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    return server_socket
+
+class PendingClient:
+    """An accepted connection on its way to a worker thread."""
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.accepted_at = time.monotonic()
+        self.conn = None
+        self.failed = False
+        # Set once a lobby thread has finished talking to it
+        self.greeted = threading.Event()
+
+def configure_client_socket(sock):
+    if KEEPALIVE_IDLE:
+        protocol.enable_keepalive(sock, KEEPALIVE_IDLE)
+
+def greet_waiting(client, position):
+    """Lobby thread: tell a client that found every worker busy where it is queued, or turn it away."""
+    try:
+        client.conn = protocol.server_handshake(client.sock)
+        log_handshake(client.conn, client.address)
+        client.conn.set_timeout(OP_TIMEOUT)
+        if position is None:
+            performance_tracker.log_session('rejected')
+            logpipe.event("Rejected %(client)s: all workers busy and the queue is full", logging.WARNING,
+                          op='admission', client=client.address, outcome='rejected')
+            client.conn.send_msg(admission.BUSY_REJECTED)
+        else:
+            performance_tracker.log_session('queued')
+            logpipe.event("Queued %(client)s at position %(position)s", op='admission', client=client.address,
+                          position=position, outcome='queued')
+            client.conn.send_msg(admission.BUSY_QUEUED.format(position=position))
+    except Exception as e:
+        logpipe.event("Could not greet waiting client %(client)s: %(error)s", logging.WARNING, op='admission',
+                      client=client.address, error=str(e), outcome='disconnected')
+        client.failed = True
+    finally:
+        if position is None or client.failed:
+            client.sock.close()
+        client.greeted.set()
+
+def run_sessions(client):
+    """Pool worker: serve client, then each waiting client that inherits the slot, until none is left."""
+    while client is not None:
+        client.greeted.wait()
+        if not client.failed:
+            handle_client(client.sock, client.address, client.accepted_at, client.conn)
+        client = admission_controller.release()
+
+def accept_client(server_socket, executor, lobby):
+    try:
+        client_socket, client_address = server_socket.accept()
+    except BlockingIOError:
+        # Taken by the other process sharing the socket during a hot restart
+        return
+    configure_client_socket(client_socket)
+    if TLS_CONTEXT is not None:
+        client_socket = tls.wrap_server(TLS_CONTEXT, client_socket)
+    client = PendingClient(client_socket, client_address)
+    position = admission_controller.admit(client)
+    if position == 0:
+        client.greeted.set()
+        executor.submit(run_sessions, client)
+    else:
+        lobby.submit(greet_waiting, client, position)
+
+def serve_threaded(server_socket, workers, signals=None):
+    lobby = ThreadPoolExecutor(max_workers=LOBBY_WORKERS, thread_name_prefix='dfos-lobby')
+    selector = selectors.DefaultSelector()
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    if signals is not None:
+        selector.register(signals, selectors.EVENT_READ)
+    draining = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         try:
-            while True:
-                client_socket, client_address = server_socket.accept()
-                executor.submit(handle_client, client_socket, client_address)
+            while not draining:
+                for key, _ in selector.select():
+                    if key.fileobj is server_socket:
+                        accept_client(server_socket, executor, lobby)
+                    elif stop_accepting(server_socket, signals.take()):
+                        draining = True
+                        break
+            selector.close()
+            server_socket.close()
+            for client in admission_controller.clear():
+                client.greeted.wait()
+                client.sock.close()
+            drain_sessions()
+            while len(session_registry) and time.monotonic() < drain_deadline:
+                time.sleep(0.1)
+            close_remaining_sessions()
         except KeyboardInterrupt:
             print("\nServer is shutting down.")
         finally:
             server_socket.close()
+            lobby.shutdown(wait=False)
+    if draining:
+        finish_shutdown()
+
+def stop_accepting(server_socket, request):
+    """Act on SIGTERM (request STOP) or SIGHUP (RESTART); True once this process should stop accepting.
+
+    A restart returns True only after the new process has taken over server_socket.
+    """
+    global successor
+    if request == handoff.STOP:
+        logpipe.event("Stopping: no new connections, draining %(sessions)s sessions", op='shutdown',
+                      sessions=len(session_registry))
+        return True
+    if request != handoff.RESTART:
+        return False
+    # The new process binds the metrics port, so it has to be free first
+    metrics_address = metrics_server.server_address if metrics_server else None
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    started = time.monotonic()
+    successor = handoff.start_successor(server_socket)
+    if successor is None:
+        logpipe.event("Hot restart failed: the new server process did not start; still serving", logging.ERROR,
+                      op='restart', outcome='error')
+        if metrics_address:
+            serve_metrics(*metrics_address)
+        return False
+    logpipe.event("Hot restart: pid %(successor)s took over; draining %(sessions)s sessions", op='restart',
+                  successor=successor.process.pid, sessions=len(session_registry),
+                  duration=time.monotonic() - started, outcome='ok')
+    return True
+
+def drain_sessions():
+    """Start draining: close sessions idle at the prompt and let the rest finish their command."""
+    global drain_deadline
+    drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+    session_registry.drain()
+
+def close_remaining_sessions():
+    left = len(session_registry)
+    if left:
+        logpipe.event("Drain deadline passed; closing %(sessions)s sessions", logging.WARNING, op='shutdown',
+                      sessions=left, outcome='timeout')
+        session_registry.close_all()
+
+def finish_shutdown():
+    """After draining: hand the totals to the new process on a restart, else log the shutdown report."""
+    if successor is not None:
+        successor.send_totals(performance_tracker.snapshot())
+        logging.info(f"Handed over to pid {successor.process.pid}.")
+    elif report_totals is not None:
+        report_totals(performance_tracker.snapshot())
+    else:
+        log_shutdown_report(performance_tracker)
+        print("\nServer stopped.")
+
+def inherit_totals(snapshot):
+    """Add the totals of the process this one replaced; its connections and resource use were its own."""
+    performance_tracker.merge(dict(snapshot, active_connections=0, resources={}))
+    logging.info(f"Carried over totals from the previous process: {snapshot['total_connections']} connections, "
+                 f"{snapshot['file_transfers']} file transfers.")
+
+def start_monitoring(args, worker_id=0):
+    """Start the resource sampler and, if asked for, the metrics endpoint of this process."""
+    performance_tracker.start_sampler(args.sample_interval)
+    if args.metrics_port is not None:
+        serve_metrics(args.metrics_host, args.metrics_port + worker_id)
+
+def serve_metrics(host, port):
+    global metrics_server
+    metrics_server = metrics.serve(performance_tracker, host, port)
+
+def configure_sessions(args):
+    global IDLE_TIMEOUT, OP_TIMEOUT, KEEPALIVE_IDLE, DRAIN_TIMEOUT
+    DRAIN_TIMEOUT = args.drain_timeout
+    IDLE_TIMEOUT = args.idle_timeout or None
+    OP_TIMEOUT = args.op_timeout or None
+    KEEPALIVE_IDLE = args.keepalive
+    capacity = args.max_sessions
+    if args.engine == 'threads':
+        # A session holds its worker thread from login to exit
+        capacity = min(capacity or args.workers, args.workers)
+    admission_controller.capacity = capacity
+    admission_controller.max_queue = args.max_queue
+
+def run_engine(server_socket, args, signals=None):
+    if args.engine == 'asyncio':
+        import async_server
+        async_server.run(server_socket, args.io_workers, signals)
+    else:
+        serve_threaded(server_socket, args.workers, signals)
+
+def main():
+    global CLUSTER_SECRET, TLS_CONTEXT
+    args = parse_args()
+    logpipe.start(args)
+    if args.backlog is None:
+        args.backlog = 1024 if args.engine == 'asyncio' or args.cluster_nodes else 5
+    CLUSTER_SECRET = args.cluster_secret
+    if args.tls_cert:
+        TLS_CONTEXT = tls.server_context(args.tls_cert, args.tls_key)
+    if args.cluster_nodes:
+        import cluster
+        cluster.main(args)
+        return
+
+    storage.set_root(args.storage_root)
+    storage.set_backend(args.storage)
+    if args.compress_at_rest != 'none':
+        storage.AT_REST_CODEC = args.compress_at_rest
+    storage.set_cache(args.cache_mb * 1024 * 1024, performance_tracker)
+    storage.set_durability(args.fsync)
+    bandwidth_scheduler.configure(args.bandwidth_limit, args.user_bandwidth, credential_store.options)
+    configure_sessions(args)
+    quota_manager.configure(args.quota_bytes, args.quota_files or None, credential_store.options)
+    if args.scrub_interval:
+        # In the parent only; the index is shared by all worker processes
+        quota.Scrubber(args.scrub_interval).start()
+    storage.set_versioning(max(args.keep_versions, 0))
+    if args.prune_interval:
+        versions.Pruner(versions.RetentionPolicy(args.keep_versions, args.keep_snapshots,
+                                                 args.keep_days * 86400), args.prune_interval).start()
+
+    if args.processes > 1:
+        import prefork
+        prefork.run(args)
+        return
+
+    logging.info("Server started. Initializing performance tracking.")
+    signal.signal(signal.SIGINT, signal_handler)
+    signals = handoff.ShutdownSignals()
+    server_socket = handoff.inherited_listener()
+    if server_socket is None:
+        server_socket = create_listener(args.host, args.port, args.backlog)
+    else:
+        logging.info("Took over the listening socket from the previous server process.")
+    start_monitoring(args)
+    handoff.take_over(inherit_totals)
+    print(f"Server is listening on port {args.port} ({args.engine} engine{', TLS' if TLS_CONTEXT else ''})...")
+    run_engine(server_socket, args, signals)
 
 if __name__ == "__main__":
-    main()
+    # Run through the importable module so engines that `import server`
+    # share this process's performance tracker and state.
+    import server
+    server.main()
@@ -0,0 +1,1121 @@
+import io
+import os
+import re
+import json
+import stat
+import errno
+import shutil
+import time
+import hashlib
+import threading
+
+import cache
+import compress
+import durability
+import metadata
+import versions
+
+# Filesystem layout shared by both server engines.
+#
+#   server_storage/<user>/<filename>            committed files
+#   server_storage/.dfos/partial/<user>/...     uploads in progress
+#
+# Uploads are written to a partial file and only renamed into the user's
+# directory once complete, so a dropped connection never leaves a truncated
+# file behind and a resumed upload can continue from the partial's size.
+# The partial is hashed as it is written; the digest is checked against the
+# one the client sent before the rename, then kept in the metadata index so
+# downloads can hand it out without reading the file again. How far a commit
+# is synced to disk first is up to `durability` (see durability.py).
+#
+#   server_storage/.dfos/versions/<user>/<id>              earlier versions
+#   server_storage/.dfos/snapshots/<user>/<snapshot>/...   point-in-time copies
+#
+# Committed files are never modified in place, only replaced by a rename, so
+# an earlier version or a snapshot can be a hardlink to the same inode: no
+# data is copied until the name moves on to new contents. With the dedup
+# backend they are copies of the manifest instead, holding references to the
+# chunks. Which versions and snapshots exist is kept in the metadata index;
+# versions.py prunes them.
+
+STORAGE_ROOT = "server_storage"
+META_ROOT = os.path.join(STORAGE_ROOT, ".dfos")
+PARTIAL_ROOT = os.path.join(META_ROOT, "partial")
+VERSION_ROOT = os.path.join(META_ROOT, "versions")
+SNAPSHOT_ROOT = os.path.join(META_ROOT, "snapshots")
+
+# Earlier versions kept per file when it is overwritten or deleted (0: none); see set_versioning()
+KEEP_VERSIONS = versions.KEEP_VERSIONS
+SNAPSHOT_NAME = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9._-]{0,63}')
+
+# 'files' keeps every committed file as-is in the user's directory; 'dedup'
+# stores committed files in the shared chunk store (see chunkstore.py).
+BACKEND = 'files'
+_chunk_store = None
+# Codec for storing committed files compressed (files backend), or None
+AT_REST_CODEC = None
+
+_metadata_index = None
+_metadata_lock = threading.Lock()
+
+# Hot file contents and previews (see cache.py); None when disabled
+content_cache = None
+# Files up to this size are cached whole, larger ones only by their preview
+CACHE_MAX_FILE = 4 * 1024 * 1024
+
+# How far commits are synced to disk before they are acknowledged
+commit_durability = durability.Durability()
+
+
+class StorageError(Exception):
+    pass
+
+
+class ChecksumMismatch(StorageError):
+    """The upload's data does not match the digest its sender computed; it was discarded."""
+
+
+def set_root(path):
+    """Keep files and metadata under path instead of ./server_storage."""
+    global STORAGE_ROOT, META_ROOT, PARTIAL_ROOT, VERSION_ROOT, SNAPSHOT_ROOT
+    STORAGE_ROOT = path
+    META_ROOT = os.path.join(STORAGE_ROOT, ".dfos")
+    PARTIAL_ROOT = os.path.join(META_ROOT, "partial")
+    VERSION_ROOT = os.path.join(META_ROOT, "versions")
+    SNAPSHOT_ROOT = os.path.join(META_ROOT, "snapshots")
+
+
+def set_backend(name):
+    global BACKEND, _chunk_store
+    BACKEND = name
+    if name == 'dedup':
+        import chunkstore
+        _chunk_store = chunkstore.ChunkStore(META_ROOT)
+
+
+def chunk_store():
+    return _chunk_store
+
+
+def set_durability(mode):
+    """How commits are synced to disk: 'none', 'file' or 'group' (see durability.py)."""
+    global commit_durability
+    commit_durability = durability.Durability(mode)
+
+
+def set_cache(capacity, tracker=None):
+    """Enable the content cache with capacity bytes (0 disables it)."""
+    global content_cache
+    content_cache = cache.ContentCache(capacity, CACHE_MAX_FILE, tracker) if capacity > 0 else None
+
+
+def metadata_index():
+    global _metadata_index
+    with _metadata_lock:
+        if _metadata_index is None:
+            _metadata_index = metadata.MetadataIndex(os.path.join(META_ROOT, "index.db"))
+        return _metadata_index
+
+
+def user_dir(user):
+    return os.path.join(STORAGE_ROOT, user)
+
+
+def resolve(user, filename):
+    """Path of filename inside the user's directory; rejects names that escape it."""
+    base = os.path.abspath(user_dir(user))
+    path = os.path.abspath(os.path.join(base, filename))
+    if not filename or os.path.commonpath([base, path]) != base or path == base:
+        raise StorageError("Invalid filename.")
+    return path
+
+
+def partial_path(user, filename):
+    resolve(user, filename)
+    return os.path.join(PARTIAL_ROOT, user, filename + ".part")
+
+
+def index_name(user, filename):
+    """Canonical name of a file in the metadata index (so 'a/./b' and 'a/b' agree)."""
+    return os.path.relpath(resolve(user, filename), os.path.abspath(user_dir(user)))
+
+
+def _sha256(file):
+    digest = hashlib.sha256()
+    while chunk := file.read(1024 * 1024):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def partial_size(user, filename):
+    try:
+        return os.path.getsize(partial_path(user, filename))
+    except OSError:
+        return 0
+
+
+class UploadFile:
+    """The partial file of an upload; hashes everything written to it.
+
+    A resumed upload's hash is seeded by reading back the bytes already in
+    the partial, since a hash state cannot be kept between sessions.
+    """
+
+    def __init__(self, file, offset=0):
+        self.file = file
+        self.hasher = hashlib.sha256()
+        if offset:
+            file.seek(0)
+            remaining = offset
+            while remaining and (chunk := file.read(min(remaining, 1024 * 1024))):
+                self.hasher.update(chunk)
+                remaining -= len(chunk)
+            file.seek(offset)
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_upload(user, filename, total=None, token=None):
+    """Open the partial file for an upload and return (UploadFile, offset).
+
+    With a declared total size and a token identifying the source file, an
+    existing partial for the same (total, token) is resumed from its current
+    size; anything else starts again from byte zero.
+    """
+    part = partial_path(user, filename)
+    meta = part + ".meta"
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+
+    identity = f"{total} {token}"
+    offset = 0
+    if total is not None and os.path.exists(part):
+        try:
+            with open(meta, 'r') as file:
+                stored = file.read().strip()
+        except OSError:
+            stored = None
+        size = os.path.getsize(part)
+        if stored == identity and size <= total:
+            offset = size
+
+    if total is not None and offset == 0:
+        with open(meta, 'w') as file:
+            file.write(identity)
+
+    file = open(part, 'r+b' if offset else 'wb')
+    file.seek(offset)
+    file.truncate()
+    return UploadFile(file, offset), offset
+
+
+def commit_upload(user, filename, expected_size=None, digest=None, expected_digest=None):
+    """Move a finished partial into place. Returns False if it is still short.
+
+    digest is the partial's SHA-256 as computed while it was written (it is
+    read back only when not given, as for striped uploads). If the sender's
+    expected_digest differs, the partial is discarded and ChecksumMismatch
+    raised.
+    """
+    part = partial_path(user, filename)
+    size = os.path.getsize(part)
+    if expected_size is not None and size != expected_size:
+        return False
+    target = resolve(user, filename)
+    if digest is None:
+        with open(part, 'rb') as file:
+            digest = _sha256(file)
+    if expected_digest is not None and expected_digest != digest:
+        discard_upload(user, filename)
+        raise ChecksumMismatch("Upload failed: checksum mismatch.")
+    preserve(user, filename)
+    if BACKEND == 'dedup':
+        entries = _chunk_store.ingest(part)
+        _sync_chunks(entries)
+        _chunk_store.commit(user, filename, entries, commit_durability.sync_file)
+        commit_durability.sync_parent(_chunk_store.manifest_path(user, filename))
+        delete_plain_file(user, filename)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        packed = part + ".z"
+        if AT_REST_CODEC and compress.write_compressed(part, packed, AT_REST_CODEC):
+            commit_durability.sync_file(packed)
+            os.replace(packed, target)
+        else:
+            commit_durability.sync_file(part)
+            os.replace(part, target)
+        commit_durability.sync_parent(target)
+    discard_upload(user, filename)
+    _invalidate(user, filename)
+    metadata_index().record(user, index_name(user, filename), size, time.time(), digest)
+    return True
+
+
+def _sync_chunks(entries):
+    """Sync the chunk files a manifest is about to reference (already synced ones cost next to nothing)."""
+    if commit_durability.mode != 'none':
+        paths = {_chunk_store.chunk_path(digest) for digest, _ in entries}
+        commit_durability.sync(list(paths) + [os.path.dirname(path) for path in paths])
+
+
+def commit_chunks(user, filename, entries):
+    """Commit a dedup upload whose chunks are all in the store."""
+    _sync_chunks(entries)
+    preserve(user, filename)
+    _chunk_store.commit(user, filename, entries, commit_durability.sync_file)
+    commit_durability.sync_parent(_chunk_store.manifest_path(user, filename))
+    delete_plain_file(user, filename)
+    _invalidate(user, filename)
+    with _chunk_store.open(user, filename) as reader:
+        digest = _sha256(reader)
+        size = reader.size
+    metadata_index().record(user, index_name(user, filename), size, time.time(), digest)
+
+
+def discard_upload(user, filename):
+    part = partial_path(user, filename)
+    for path in (part, part + ".meta", part + ".ranges", part + ".z"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Committed files. With the dedup backend a file is a chunk-store manifest;
+# plain files left from before the switch are still served and deletable.
+# Files stored compressed at rest are read back through compress.CompressedReader.
+
+def file_exists(user, filename):
+    path = resolve(user, filename)
+    return (BACKEND == 'dedup' and _chunk_store.exists(user, filename)) or os.path.isfile(path)
+
+
+def open_file(user, filename, source=None, zero_copy=False):
+    """Open a committed file for reading; returns (file, size).
+
+    Files small enough for the content cache come back as an in-memory
+    io.BytesIO, read from disk only on a cache miss. With zero_copy, a file
+    stored plainly comes back as the real file anyway, since sendfile() beats
+    copying from the cache. source opens an earlier version or a snapshot's
+    copy instead (see parse_download_request()).
+    """
+    if source is not None:
+        return _open_kept(*_kept(user, filename, source)[:2])
+    key = _cache_key(user, filename)
+    if key is None:
+        return _open_stored(user, filename)
+    if zero_copy:
+        file, size = _open_stored(user, filename)
+        if has_descriptor(file):
+            return file, size
+        file.close()
+    cached = content_cache.get(key + ('file',))
+    if cached is not None:
+        return io.BytesIO(cached[0]), cached[1]
+    file, size = _open_stored(user, filename)
+    if not content_cache.fits(size):
+        return file, size
+    with file:
+        data = file.read()
+    content_cache.put(key + ('file',), data, size)
+    return io.BytesIO(data), size
+
+
+def open_preview(user, filename, count, source=None):
+    """open_file() for a preview of the first count bytes.
+
+    Large files are not cached whole, so their first count bytes are cached
+    on their own.
+    """
+    if source is not None:
+        return _open_kept(*_kept(user, filename, source)[:2])
+    key = _cache_key(user, filename)
+    if key is None:
+        return _open_stored(user, filename)
+    cached = content_cache.get(key + ('file',), key + ('head', count))
+    if cached is not None:
+        return io.BytesIO(cached[0]), cached[1]
+    file, size = _open_stored(user, filename)
+    with file:
+        if content_cache.fits(size):
+            data = file.read()
+            content_cache.put(key + ('file',), data, size)
+        else:
+            data = read_range(file, 0, count)
+            content_cache.put(key + ('head', count), data, size)
+    return io.BytesIO(data), size
+
+
+def _cache_key(user, filename):
+    """(path, mtime_ns, size) of what stores the file, or None if uncached or missing."""
+    path = resolve(user, filename)
+    if content_cache is None:
+        return None
+    paths = [path]
+    if BACKEND == 'dedup':
+        paths.insert(0, _chunk_store.manifest_path(user, filename))
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            return (path, st.st_mtime_ns, st.st_size)
+    return None
+
+
+def _invalidate(user, filename):
+    if content_cache is not None:
+        content_cache.invalidate(resolve(user, filename))
+        if BACKEND == 'dedup':
+            content_cache.invalidate(_chunk_store.manifest_path(user, filename))
+
+
+def _open_stored(user, filename):
+    path = resolve(user, filename)
+    if BACKEND == 'dedup' and _chunk_store.exists(user, filename):
+        reader = _chunk_store.open(user, filename)
+        return reader, reader.size
+    return _open_plain(path)
+
+
+def _open_plain(path):
+    file = compress.open_at_rest(path)
+    if isinstance(file, compress.CompressedReader):
+        return file, file.size
+    return file, os.fstat(file.fileno()).st_size
+
+
+def has_descriptor(file):
+    """Whether file is backed by a real descriptor (for sendfile/mmap/pread)."""
+    try:
+        file.fileno()
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def read_range(file, offset, count):
+    if has_descriptor(file):
+        return os.pread(file.fileno(), count, offset)
+    file.seek(offset)
+    return file.read(count)
+
+
+def delete_file(user, filename, keep=True):
+    """Delete a committed file, keeping it as a version unless keep is False."""
+    resolve(user, filename)
+    if keep:
+        preserve(user, filename)
+    deleted = BACKEND == 'dedup' and _chunk_store.delete(user, filename)
+    deleted = delete_plain_file(user, filename) or deleted
+    if deleted:
+        _invalidate(user, filename)
+        metadata_index().remove(user, index_name(user, filename))
+    return deleted
+
+
+def delete_plain_file(user, filename):
+    try:
+        os.remove(resolve(user, filename))
+        return True
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+
+# Versions and snapshots. A kept copy is a ('file', path) hardlink (or copy,
+# across filesystems) of a plain or compressed file, or a ('manifest', path)
+# copy of a dedup manifest.
+
+def set_versioning(keep):
+    """Keep up to keep earlier versions of each file (0 turns versioning off)."""
+    global KEEP_VERSIONS
+    KEEP_VERSIONS = keep
+
+
+def version_path(user, version):
+    return os.path.join(VERSION_ROOT, user, str(version))
+
+
+def snapshot_path(user, snapshot, name=None):
+    path = os.path.join(SNAPSHOT_ROOT, user, snapshot)
+    return os.path.join(path, name) if name is not None else path
+
+
+def _link(source, dest):
+    """Hardlink source at dest, copying it where links are not possible."""
+    try:
+        os.link(source, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copy2(source, dest)
+
+
+def _keep(user, filename, dest):
+    """Keep what currently stores the user's file at dest; returns its kind, or None if there is no file."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if BACKEND == 'dedup' and _chunk_store.retain_copy(user, filename, dest):
+        return 'manifest'
+    try:
+        _link(resolve(user, filename), dest)
+    except (FileNotFoundError, IsADirectoryError, PermissionError):
+        return None
+    return 'file'
+
+
+def _current(user, name):
+    """(size, sha256) of the user's current file, from the index when it has them."""
+    row = _indexed(user).digest_of(user, name)
+    if row is not None:
+        return row
+    file, size = _open_stored(user, name)
+    file.close()
+    return size, None
+
+
+def preserve(user, filename):
+    """Keep the user's current file as a version before it is overwritten or deleted.
+
+    Only the newest KEEP_VERSIONS versions of the file are kept; older ones
+    are dropped straight away (age limits are left to versions.Pruner).
+    """
+    if not KEEP_VERSIONS:
+        return
+    name = index_name(user, filename)
+    try:
+        size, digest = _current(user, name)
+    except (FileNotFoundError, IsADirectoryError):
+        return
+    version = time.time_ns()
+    while True:
+        try:
+            kind = _keep(user, filename, version_path(user, version))
+            break
+        except FileExistsError:
+            version += 1
+    if kind is None:
+        return
+    index = metadata_index()
+    index.add_version(user, name, version, size, digest, kind)
+    for row in index.expired_versions(KEEP_VERSIONS, user=user, name=name):
+        drop_version(*row)
+
+
+def _drop(path, kind):
+    if kind == 'manifest' and _chunk_store is not None:
+        _chunk_store.release_copy(path)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def drop_version(user, name, version, kind):
+    metadata_index().remove_version(user, name, version)
+    _drop(version_path(user, version), kind)
+
+
+def list_versions(user, filename):
+    """[version, size, sha256, kind] of the kept versions of a file, newest first."""
+    return metadata_index().versions(user, index_name(user, filename))
+
+
+def _kept(user, filename, source):
+    """(path, kind, size, sha256) of a version or snapshot copy of a file; FileNotFoundError if there is none."""
+    name = index_name(user, filename)
+    kind, key = source
+    if kind == 'version':
+        row = metadata_index().version(user, name, key)
+        if row is None:
+            raise FileNotFoundError(filename)
+        return version_path(user, key), row[2], row[0], row[1]
+    rows = metadata_index().snapshot_files(user, key, name)
+    if not rows:
+        raise FileNotFoundError(filename)
+    _, size, _, digest, kind = rows[0]
+    return snapshot_path(user, key, name), kind, size, digest
+
+
+def _open_kept(path, kind):
+    if kind == 'manifest':
+        if _chunk_store is None:
+            raise StorageError("This version needs the dedup storage backend.")
+        reader = _chunk_store.open_copy(path)
+        return reader, reader.size
+    return _open_plain(path)
+
+
+def _restore(user, filename, path, kind, size, digest):
+    """Make a kept copy the user's current file again, keeping the current one as a version."""
+    target = resolve(user, filename)
+    if kind == 'manifest':
+        if _chunk_store is None:
+            raise StorageError("This version needs the dedup storage backend.")
+        entries = _chunk_store.read_copy(path)
+        if entries is None:
+            raise FileNotFoundError(filename)
+        preserve(user, filename)
+        _chunk_store.commit(user, filename, entries, commit_durability.sync_file)
+        commit_durability.sync_parent(_chunk_store.manifest_path(user, filename))
+        delete_plain_file(user, filename)
+    else:
+        temp = partial_path(user, filename) + ".restore"
+        os.makedirs(os.path.dirname(temp), exist_ok=True)
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        _link(path, temp)
+        preserve(user, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        commit_durability.sync_file(temp)
+        os.replace(temp, target)
+        commit_durability.sync_parent(target)
+        if BACKEND == 'dedup':
+            # The manifest would shadow the restored plain file
+            _chunk_store.delete(user, filename)
+    _invalidate(user, filename)
+    metadata_index().record(user, index_name(user, filename), size, time.time(), digest)
+
+
+def restore(user, filename, source):
+    """Bring a file back as it was in a version or snapshot (source as in parse_download_request()).
+
+    Returns False, changing nothing, if the file already has those contents.
+    """
+    path, kind, size, digest = _kept(user, filename, source)
+    current = _current_digest(user, filename, size)
+    if current is not None:
+        if digest is None:
+            # Kept from a file indexed by a scan, which has no hash
+            file, _ = _open_kept(path, kind)
+            with file:
+                digest = _sha256(file)
+        if digest == current:
+            return False
+    _restore(user, filename, path, kind, size, digest)
+    return True
+
+
+def _current_digest(user, filename, size):
+    """SHA-256 of the user's current file if it is size bytes long, else None.
+
+    Files indexed by a scan have no hash yet; they are read and the hash is
+    recorded.
+    """
+    index = metadata_index()
+    name = index_name(user, filename)
+    row = index.digest_of(user, name)
+    if row is not None and row[0] != size:
+        return None
+    if row is not None and row[1] is not None:
+        return row[1]
+    try:
+        file, stored_size = _open_stored(user, filename)
+    except FileNotFoundError:
+        return None
+    with file:
+        if stored_size != size:
+            return None
+        digest = _sha256(file)
+    if row is not None:
+        index.set_digest(user, name, size, digest)
+    return digest
+
+
+def parse_restore_request(text):
+    """{"name": ..., "version": id} or {"snapshot": ..., "name": optional} sent by the restore command."""
+    try:
+        request = json.loads(text)
+        if not isinstance(request, dict) or set(request) - {'name', 'version', 'snapshot'}:
+            raise ValueError
+        if 'version' in request:
+            if 'snapshot' in request or not isinstance(request.get('name'), str):
+                raise ValueError
+            return request['name'], ('version', int(request['version']))
+        _check_snapshot_name(request.get('snapshot'))
+        if not isinstance(request.get('name', ''), str):
+            raise ValueError
+        return request.get('name') or None, ('snapshot', request['snapshot'])
+    except (ValueError, TypeError):
+        raise StorageError("Invalid restore request.")
+
+
+def restore_targets(user, filename, source):
+    """(filename, size) of each file a restore brings back: one, or a whole snapshot's if filename is None."""
+    if filename is None:
+        return [(row[0], row[1]) for row in snapshot_files(user, source[1])]
+    return [(filename, _kept(user, filename, source)[2])]
+
+
+def _check_snapshot_name(snapshot):
+    if not isinstance(snapshot, str) or not SNAPSHOT_NAME.fullmatch(snapshot):
+        raise StorageError("Invalid snapshot name.")
+
+
+def create_snapshot(user, snapshot=None):
+    """Keep every file of the user's as it is now; returns (snapshot, files)."""
+    snapshot = snapshot or time.strftime("%Y%m%d-%H%M%S")
+    _check_snapshot_name(snapshot)
+    index = _indexed(user)
+    if index.has_snapshot(user, snapshot) or os.path.exists(snapshot_path(user, snapshot)):
+        raise StorageError("Snapshot already exists.")
+    kept = []
+    try:
+        for name, size, mtime, digest in index.files(user):
+            kind = _keep(user, name, snapshot_path(user, snapshot, name))
+            if kind is not None:
+                kept.append((name, size, mtime, digest, kind))
+        index.add_snapshot(user, snapshot, time.time(), kept)
+    except BaseException:
+        _remove_snapshot_files(user, snapshot, kept)
+        raise
+    return snapshot, len(kept)
+
+
+def list_snapshots(user):
+    """[snapshot, created, files, bytes] of the user's snapshots, newest first."""
+    return metadata_index().snapshots(user)
+
+
+def snapshot_files(user, snapshot):
+    """[name, size, mtime, sha256, kind] of the files in one of the user's snapshots."""
+    _check_snapshot_name(snapshot)
+    index = metadata_index()
+    if not index.has_snapshot(user, snapshot):
+        raise FileNotFoundError(snapshot)
+    return index.snapshot_files(user, snapshot)
+
+
+def parse_snapshot_request(text):
+    """{"op": "create"|"list"|"files"|"delete", "snapshot": name} sent by the snapshot command."""
+    try:
+        request = json.loads(text)
+        if not isinstance(request, dict) or set(request) - {'op', 'snapshot'}:
+            raise ValueError
+        op, snapshot = request.get('op'), request.get('snapshot')
+        if op not in ('create', 'list', 'files', 'delete') or (op in ('files', 'delete') and not snapshot):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise StorageError("Invalid snapshot request.")
+    if snapshot is not None:
+        _check_snapshot_name(snapshot)
+    return op, snapshot
+
+
+def delete_snapshot(user, snapshot):
+    _check_snapshot_name(snapshot)
+    index = metadata_index()
+    if not index.has_snapshot(user, snapshot):
+        return False
+    rows = index.snapshot_files(user, snapshot)
+    index.remove_snapshot(user, snapshot)
+    _remove_snapshot_files(user, snapshot, rows)
+    return True
+
+
+def purge_user(user):
+    """Delete all of user's files, versions and snapshots, keeping nothing; returns how many of each.
+
+    For cluster nodes a user has moved away from (see cluster.py).
+    """
+    index = metadata_index()
+    files = sum(delete_file(user, row[0], keep=False) for row in index.files(user))
+    kept = index.user_versions(user)
+    for name, version, _, _, kind in kept:
+        drop_version(user, name, version, kind)
+    snapshots = list_snapshots(user)
+    for row in snapshots:
+        delete_snapshot(user, row[0])
+    return files, len(kept), len(snapshots)
+
+
+def _remove_snapshot_files(user, snapshot, rows):
+    for row in rows:
+        if row[-1] == 'manifest':
+            _drop(snapshot_path(user, snapshot, row[0]), 'manifest')
+    shutil.rmtree(snapshot_path(user, snapshot), ignore_errors=True)
+
+
+# Moving a user's history to another cluster node (see cluster.py). The
+# coordinator reads user_history() on both nodes and copies each kept entry
+# the target lacks with the keep command: link_kept() when the target already
+# holds the same contents under that name, else open_kept_upload() and
+# commit_kept() for the bytes it downloads from the source.
+
+def user_history(user):
+    """{"versions": [[name, version, size, sha256]], "snapshots": [[snapshot, created, [[name, size, mtime, sha256]]]]}."""
+    index = metadata_index()
+    return {'versions': [row[:4] for row in index.user_versions(user)],
+            'snapshots': [[snapshot, created, [row[:4] for row in index.snapshot_files(user, snapshot)]]
+                          for snapshot, created, _, _ in sorted(index.snapshots(user),
+                                                                key=lambda row: (row[1], row[0]))]}
+
+
+def parse_keep_header(text):
+    """Check the JSON header of a keep request; returns it as a dict.
+
+    {"name", "size", "sha256", "version"} for a version, or {"snapshot",
+    "created", "name", "size", "mtime", "sha256"} for a snapshot's file; name
+    is null for a snapshot that holds no files. "data" says whether the file's
+    bytes follow if the node cannot link them.
+    """
+    try:
+        entry = json.loads(text)
+        if not isinstance(entry, dict) or set(entry) - {'ticket', 'name', 'size', 'sha256', 'mtime', 'version',
+                                                        'snapshot', 'created', 'data'}:
+            raise ValueError
+        if ('version' in entry) == ('snapshot' in entry):
+            raise ValueError
+        if 'version' in entry:
+            entry['version'] = int(entry['version'])
+        else:
+            _check_snapshot_name(entry['snapshot'])
+            entry['created'] = float(entry['created'])
+        if entry.get('name') is not None:
+            if not isinstance(entry['name'], str):
+                raise ValueError
+            entry['size'] = int(entry['size'])
+            entry['mtime'] = float(entry.get('mtime') or 0)
+            if entry.get('sha256') is not None and not isinstance(entry['sha256'], str):
+                raise ValueError
+        elif 'version' in entry:
+            raise ValueError
+    except (ValueError, TypeError, KeyError):
+        raise StorageError("Invalid keep request.")
+    return entry
+
+
+def _kept_path(user, entry):
+    if 'version' in entry:
+        return version_path(user, entry['version'])
+    return snapshot_path(user, entry['snapshot'], entry['name'])
+
+
+def _record_kept(user, entry, kind):
+    index = metadata_index()
+    if 'version' in entry:
+        index.add_version(user, entry['name'], entry['version'], entry['size'], entry.get('sha256'), kind)
+        return
+    row = None
+    if entry.get('name') is not None:
+        row = (entry['name'], entry['size'], entry['mtime'], entry.get('sha256'), kind)
+    index.add_snapshot_file(user, entry['snapshot'], entry['created'], row)
+
+
+def link_kept(user, entry):
+    """Keep entry from what the node already has; returns False if its bytes must be sent.
+
+    Only copies of the same name with the recorded SHA-256 are linked: the
+    current file, or a plain version or snapshot copy taken in earlier.
+    """
+    name = entry.get('name')
+    if name is None:
+        _record_kept(user, entry, None)
+        return True
+    resolve(user, name)
+    digest = entry.get('sha256')
+    if digest is None:
+        return False
+    dest = _kept_path(user, entry)
+    if metadata_index().digest_of(user, name) == (entry['size'], digest):
+        kind = _keep(user, name, dest)
+        if kind is not None:
+            _record_kept(user, entry, kind)
+            return True
+    for kind, key in metadata_index().copies_of(user, name, digest):
+        source = version_path(user, key) if kind == 'version' else snapshot_path(user, key, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            _link(source, dest)
+        except FileNotFoundError:
+            continue
+        _record_kept(user, entry, 'file')
+        return True
+    return False
+
+
+def open_kept_upload(user, entry):
+    """Open the partial file the bytes of a kept entry are received into."""
+    part = partial_path(user, entry['name']) + ".kept"
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    return UploadFile(open(part, 'wb'))
+
+
+def commit_kept(user, entry, digest, expected_digest=None):
+    """Move a received kept entry into place; ChecksumMismatch if its bytes are not the ones recorded."""
+    part = partial_path(user, entry['name']) + ".kept"
+    try:
+        if os.path.getsize(part) != entry['size']:
+            raise ChecksumMismatch("Keep failed: size mismatch.")
+        if entry.get('sha256') not in (None, digest) or expected_digest not in (None, digest):
+            raise ChecksumMismatch("Keep failed: checksum mismatch.")
+        dest = _kept_path(user, entry)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        commit_durability.sync_file(part)
+        os.replace(part, dest)
+        commit_durability.sync_parent(dest)
+    except BaseException:
+        try:
+            os.remove(part)
+        except FileNotFoundError:
+            pass
+        raise
+    _record_kept(user, entry, 'file')
+
+
+# Listing, served from the metadata index
+
+LIST_FILTERS = {'limit': int, 'after': str, 'prefix': str, 'glob': str,
+                'min_size': int, 'max_size': int, 'since': float}
+
+
+def parse_list_query(text):
+    """JSON object of LIST_FILTERS keys (all optional) sent by the list command."""
+    try:
+        query = json.loads(text) if text else {}
+        if not isinstance(query, dict) or set(query) - set(LIST_FILTERS):
+            raise ValueError
+        return {key: LIST_FILTERS[key](value) for key, value in query.items() if value is not None}
+    except (ValueError, TypeError):
+        raise StorageError("Invalid list query.")
+
+
+def _indexed(user):
+    """The metadata index, after scanning user's files into it if this is the first time they are needed."""
+    index = metadata_index()
+    if not index.is_indexed(user):
+        index.add_scanned(user, _scan_user(user))
+    return index
+
+
+def list_files(user, query):
+    """One page of the user's files: {'files': [[name, size, mtime, sha256], ...], 'next': cursor}."""
+    index = _indexed(user)
+    rows, cursor = index.page(user, query.get('limit', metadata.DEFAULT_PAGE), query.get('after'),
+                              query.get('prefix'), query.get('glob'), query.get('min_size'),
+                              query.get('max_size'), query.get('since'))
+    return {'files': [list(row) for row in rows], 'next': cursor}
+
+
+def manifest(user, prefix=None):
+    """Every file of the user's under prefix as [name, size, mtime, sha256], for sync.
+
+    Files the index has no hash for yet (found by a scan rather than
+    uploaded) are hashed once here and the hash is kept.
+    """
+    index = _indexed(user)
+    rows = index.files(user, prefix)
+    for row in rows:
+        if row[3] is not None:
+            continue
+        try:
+            file, size = _open_stored(user, row[0])
+        except (OSError, StorageError):
+            continue
+        with file:
+            row[3] = _sha256(file)
+        if size == row[1]:
+            index.set_digest(user, row[0], size, row[3])
+        row[1] = size
+    return rows
+
+
+# Usage figures for quota.py, kept by the metadata index
+
+def usage(user):
+    """(bytes, files) stored for user."""
+    return _indexed(user).usage(user)
+
+
+def stored_size(user, filename):
+    """Size of the user's committed file, or None if there is none."""
+    return _indexed(user).size_of(user, index_name(user, filename))
+
+
+def stored_digest(user, filename, size, source=None):
+    """SHA-256 recorded at commit for the user's file, or None if unknown or not for a file of this size."""
+    if source is not None:
+        try:
+            row = _kept(user, filename, source)[2:]
+        except FileNotFoundError:
+            return None
+    else:
+        row = metadata_index().digest_of(user, index_name(user, filename))
+    return row[1] if row and row[0] == size else None
+
+
+def stored_users():
+    """Every user with an index entry or a storage directory."""
+    users = set(metadata_index().indexed_users())
+    roots = [STORAGE_ROOT] + ([_chunk_store.manifest_root] if BACKEND == 'dedup' else [])
+    for root in roots:
+        try:
+            users.update(entry.name for entry in os.scandir(root)
+                         if entry.is_dir() and not entry.name.startswith('.'))
+        except FileNotFoundError:
+            pass
+    return sorted(users)
+
+
+def scrub_user(user):
+    """Re-read user's files from disk into the index; returns their usage before and after."""
+    started = time.time()
+    return metadata_index().reconcile(user, _scan_user(user), started)
+
+
+def _scan_user(user):
+    """(name, size, mtime, None) for every file already stored for user, for the first listing."""
+    rows = []
+    base = user_dir(user)
+    for root, _, files in os.walk(base):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                mtime = os.stat(path).st_mtime
+                with compress.open_at_rest(path) as file:
+                    size = file.size if isinstance(file, compress.CompressedReader) else os.fstat(file.fileno()).st_size
+            except OSError:
+                continue
+            rows.append((os.path.relpath(path, base), size, mtime, None))
+    if BACKEND == 'dedup':
+        base = os.path.join(_chunk_store.manifest_root, user)
+        for root, _, files in os.walk(base):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, base)
+                entries = _chunk_store.read_manifest(user, relative) or []
+                rows.append((relative, sum(length for _, length in entries), os.stat(path).st_mtime, None))
+    return rows
+
+
+# Striped uploads: one connection calls begin_striped_upload() to preallocate
+# the partial, any number of connections then write stripes into it at their
+# offsets, and commit_upload() runs once every byte is covered.
+
+def begin_striped_upload(user, filename, total, token):
+    part = partial_path(user, filename)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    with open(part + ".meta", 'w') as file:
+        file.write(f"{total} {token}")
+    with open(part + ".ranges", 'w'):
+        pass
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if total and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, total)
+        else:
+            os.ftruncate(fd, total)
+    finally:
+        os.close(fd)
+
+
+def striped_upload_total(user, filename, token):
+    """Declared size of a begun striped upload; the token must match the one it began with."""
+    try:
+        with open(partial_path(user, filename) + ".meta", 'r') as file:
+            total, stored_token = file.read().split()
+    except (OSError, ValueError):
+        raise StorageError("No striped upload in progress.")
+    if stored_token != token:
+        raise StorageError("Striped upload token mismatch.")
+    return int(total)
+
+
+def open_stripe(user, filename, token):
+    """Return (fd, total) for writing a stripe into a begun striped upload."""
+    total = striped_upload_total(user, filename, token)
+    return os.open(partial_path(user, filename), os.O_WRONLY), total
+
+
+def record_stripe(user, filename, offset, length):
+    # Single small O_APPEND writes, so concurrent stripes don't interleave
+    with open(partial_path(user, filename) + ".ranges", 'a') as file:
+        file.write(f"{offset} {length}\n")
+
+
+def missing_stripe_bytes(user, filename, total):
+    covered = 0
+    try:
+        with open(partial_path(user, filename) + ".ranges", 'r') as file:
+            ranges = sorted(tuple(map(int, line.split())) for line in file if line.strip())
+    except OSError:
+        return total
+    for offset, length in ranges:
+        if offset > covered:
+            break
+        covered = max(covered, offset + length)
+    return max(total - covered, 0)
+
+
+def parse_download_request(request, preview_size):
+    """Split a download request into (mode, filename, offset, length, source).
+
+    "<filename>"                      whole file
+    "PREVIEW <filename>"              first preview_size bytes
+    "RANGE <offset> <length> <name>"  arbitrary range, length -1 = to the end
+
+    Any of them may be prefixed with "VERSION <id> " or "SNAPSHOT <name> " to
+    read an earlier version or a snapshot's copy; source is then
+    ('version', id) or ('snapshot', name), else None.
+    """
+    source = None
+    if request.startswith(("VERSION ", "SNAPSHOT ")):
+        try:
+            kind, key, request = request.split(' ', 2)
+            source = ('version', int(key)) if kind == "VERSION" else ('snapshot', key)
+        except ValueError:
+            raise StorageError("Invalid download request.")
+    if request.startswith("PREVIEW "):
+        return 'preview', request[8:], 0, preview_size, source
+    if request.startswith("RANGE "):
+        try:
+            _, offset, length, filename = request.split(' ', 3)
+            return 'range', filename, int(offset), int(length), source
+        except ValueError:
+            raise StorageError("Invalid range request.")
+    return 'download', request, 0, -1, source
+
+
+def clamp_range(offset, length, size):
+    """Validate a requested range against the file size; returns the byte count."""
+    if offset < 0 or offset > size:
+        raise StorageError("INVALID_RANGE")
+    if length < 0 or offset + length > size:
+        length = size - offset
+    return length
+
+
+def parse_resume_header(message):
+    """Parse "<total> <token> <filename>" sent by resume_upload and stripe_begin/commit."""
+    try:
+        total, token, filename = message.split(' ', 2)
+        return int(total), token, filename
+    except ValueError:
+        raise StorageError("Invalid upload header.")
+
+
+def parse_stripe_header(message):
+    """Parse "<offset> <token> <filename>" sent by stripe_put."""
+    try:
+        offset, token, filename = message.split(' ', 2)
+        return int(offset), token, filename
+    except ValueError:
+        raise StorageError("Invalid stripe header.")
@@ -0,0 +1,139 @@
+import ssl
+import sys
+import threading
+
+# Optional TLS for server.py (--tls-cert/--tls-key) and the clients (--tls).
+#
+# Reconnects resume. The server issues session tickets and keeps a session-ID
+# cache, and clients offer the last session they got from a server
+# (ClientTLS) when they connect to it again. A resumed handshake skips the
+# certificate exchange and its signature, so the extra connections of a
+# pool, a striped transfer or a reconnect cost about one round trip. Forked
+# worker processes (--processes) inherit the parent's context and with it the
+# ticket keys, so a ticket from any worker resumes on every other. A hot
+# restart starts with fresh keys, and each client does one full handshake
+# again.
+#
+# Bulk transfers keep their throughput. A TLS record holds at most 16 KiB,
+# so the sizes that can grow are the writes around the records. A download
+# body goes out in 1 MiB writes, with its frame header merged into the first
+# one, so OpenSSL emits runs of full records per call (see
+# protocol.FramedConnection.send_file). Socket buffers are left to the
+# kernel's autotuning: setting SO_SNDBUF/SO_RCVBUF turns it off, and
+# rmem_max/wmem_max usually cap them well below what autotuning reaches.
+#
+# sendfile() only stays zero-copy with kernel TLS offload. Where Python and
+# OpenSSL support it (ssl.OP_ENABLE_KTLS, Linux with the tls module loaded),
+# it is enabled, and sockets whose send keys went to the kernel keep using
+# sendfile(). Everywhere else downloads take the buffered path.
+
+# Seconds a client may take to finish the TLS handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+KTLS_AVAILABLE = hasattr(ssl, 'OP_ENABLE_KTLS') and sys.platform.startswith('linux')
+# From linux/tls.h; the crypto info structs are at most 56 bytes
+SOL_TLS = 282
+TLS_TX = 1
+TLS_CRYPTO_INFO_SIZE = 64
+
+
+def _enable_ktls(context):
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+
+
+def server_context(certfile, keyfile=None):
+    """SSLContext for the server, with the certificate chain in certfile (and its key in keyfile)."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.options |= getattr(ssl, 'OP_NO_RENEGOTIATION', 0)
+    _enable_ktls(context)
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    """SSLContext for clients: trusts cafile (default: the system store); verify=False trusts anything."""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    _enable_ktls(context)
+    return context
+
+
+def wrap_server(context, sock):
+    """Wrap an accepted socket. The handshake happens in protocol.server_handshake(), on the session's thread."""
+    return context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+
+def kernel_send(sock):
+    """Whether the kernel encrypts what is sent on sock (kTLS), so sendfile() on it stays zero-copy.
+
+    Python has no call for this, so the socket is asked directly: the TLS_TX
+    option only exists once OpenSSL has handed the send keys to the kernel.
+    """
+    if not isinstance(sock, ssl.SSLSocket) or not KTLS_AVAILABLE:
+        return False
+    try:
+        sock.getsockopt(SOL_TLS, TLS_TX, TLS_CRYPTO_INFO_SIZE)
+    except OSError:
+        return False
+    return True
+
+
+def peer_open(sock):
+    """Session.alive() for a TLS socket, which cannot MSG_PEEK: False once the server has closed it.
+
+    Only called on an idle connection, where anything readable is a
+    close_notify, EOF or a post-handshake message OpenSSL handles itself.
+    """
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return sock.recv(1) != b''
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+class ClientTLS:
+    """A client context plus the latest session from each server, offered again on the next connect."""
+
+    def __init__(self, context):
+        self.context = context
+        self._sessions = {}
+        self._lock = threading.Lock()
+        # Handshakes so far, for benchmarks and logs
+        self.full = 0
+        self.resumed = 0
+
+    def wrap(self, sock, host, port):
+        """Wrap a connected socket and run the handshake, resuming the last session with host:port if any."""
+        with self._lock:
+            session = self._sessions.get((host, port))
+        tls_sock = self.context.wrap_socket(sock, server_hostname=host, session=session)
+        with self._lock:
+            if tls_sock.session_reused:
+                self.resumed += 1
+            else:
+                self.full += 1
+        return tls_sock
+
+    def remember(self, tls_sock, host, port):
+        """Keep tls_sock's session for the next connection.
+
+        Called after the first reply from the server: TLS 1.3 tickets arrive
+        after the handshake, with or before that reply.
+        """
+        session = tls_sock.session
+        if session is not None:
+            with self._lock:
+                self._sessions[(host, port)] = session
+
+    def forget(self, host, port):
+        with self._lock:
+            self._sessions.pop((host, port), None)
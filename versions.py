@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+
+import logpipe
+
+# Retention for the earlier versions and snapshots storage.py keeps.
+#
+# Overwriting or deleting a file keeps what it held as a version (a hardlink,
+# or a manifest copy with the dedup backend, so nothing is copied), and a
+# snapshot keeps all of a user's files at once. The policy bounds both:
+#
+#   keep_last     versions kept per file, and snapshots kept per user
+#   keep_seconds  how long either is kept at most (None: no age limit)
+#
+# The per-file version count is enforced on every overwrite (see
+# storage.preserve()); the age limit and the snapshot count are enforced by a
+# Pruner thread, so expiry costs nothing on the upload path.
+
+# Defaults of the policy; storage.py also starts from KEEP_VERSIONS
+KEEP_VERSIONS = 10
+KEEP_SNAPSHOTS = 10
+KEEP_DAYS = 30
+PRUNE_INTERVAL = 3600
+
+
+class RetentionPolicy:
+    def __init__(self, keep_versions=KEEP_VERSIONS, keep_snapshots=KEEP_SNAPSHOTS, keep_seconds=None):
+        # None or 0: no count limit
+        self.keep_versions = keep_versions or None
+        self.keep_snapshots = keep_snapshots or None
+        self.keep_seconds = keep_seconds or None
+
+    def cutoff(self, now=None):
+        """Oldest time a version or snapshot may date from, or None."""
+        if self.keep_seconds is None:
+            return None
+        return (now or time.time()) - self.keep_seconds
+
+
+class Pruner:
+    """Background thread that drops versions and snapshots the RetentionPolicy no longer keeps."""
+
+    def __init__(self, policy, interval=PRUNE_INTERVAL):
+        self.policy = policy
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='dfos-version-prune', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.prune()
+
+    def prune(self):
+        # Here, since storage.py imports this module for KEEP_VERSIONS
+        import storage
+        started = time.monotonic()
+        index = storage.metadata_index()
+        cutoff = self.policy.cutoff()
+        versions = snapshots = 0
+        # Version ids are time_ns()
+        before = int(cutoff * 1e9) if cutoff is not None else None
+        for user, name, version, kind in index.expired_versions(self.policy.keep_versions, before):
+            try:
+                storage.drop_version(user, name, version, kind)
+                versions += 1
+            except Exception as e:
+                logpipe.event("Dropping version %(version)s of %(file)s failed: %(error)s", logging.ERROR,
+                              user=user, op='prune', file=name, version=version, error=str(e), outcome='error')
+        for user, snapshot in index.expired_snapshots(self.policy.keep_snapshots, cutoff):
+            try:
+                storage.delete_snapshot(user, snapshot)
+                snapshots += 1
+            except Exception as e:
+                logpipe.event("Dropping snapshot %(snapshot)s failed: %(error)s", logging.ERROR, user=user,
+                              op='prune', snapshot=snapshot, error=str(e), outcome='error')
+        logpipe.event("Pruned %(versions)s versions and %(snapshots)s snapshots", op='prune', versions=versions,
+                      snapshots=snapshots, duration=time.monotonic() - started, outcome='ok')
+        return versions, snapshots